@@ -0,0 +1,58 @@
+"""
+Helpers shared by the benchmarks
+
+The benchmarks reuse the settings from ``runtests.py``, but run against their
+own in-memory test database rather than the test suite's file, so they need
+to be run from the repository root:
+
+    python -m benchmarks.roundtrips
+"""
+import atexit
+import time
+
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.base import SessionBase
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+
+def setup():
+    import runtests  # noqa: F401 - configures the test settings
+    import django
+    from django.conf import settings
+
+    # Don't share, or leave behind, the test database of the test suite
+    settings.DATABASES['default']['TEST'] = {'NAME': ':memory:'}
+    django.setup()
+
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    atexit.register(teardown, old_name)
+
+
+def teardown(old_name):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def make_request(user_id=None, path='/'):
+    request = RequestFactory().get(path)
+    # An in-memory session, so loading it doesn't add a database query
+    request.session = SessionBase()
+    if user_id is not None:
+        request.session[SESSION_KEY] = str(user_id)
+        request.session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    return request
+
+
+def get_response(request):
+    return HttpResponse()
+
+
+def timeit(func, iterations):
+    """Return the mean time per call in microseconds"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
@@ -0,0 +1,72 @@
+"""
+Measure the per-request overhead of TOS_EXEMPT_PATHS as the number of rules grows
+
+Times UserAgreementMiddleware.should_skip_request for a path that matches the
+last rule and for a path that matches none of them, with half of the rules
+being prefixes and half regexes:
+
+    python -m benchmarks.exempt_paths --rules 0 10 100 1000
+"""
+import argparse
+import json
+import re
+
+from . import base
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        if i % 2:
+            rules.append(re.compile(rf'/api/v{i}/[a-z]+/'))
+        else:
+            rules.append(f'/static{i}/')
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--rules', type=int, nargs='+', default=[0, 1, 10, 100, 1000])
+    parser.add_argument('--json', action='store_true', help='Output the results as JSON')
+    args = parser.parse_args()
+
+    base.setup()
+
+    from django.test import override_settings
+
+    from tos.middleware import UserAgreementMiddleware
+
+    miss = base.make_request(path='/accounts/profile/')
+
+    results = []
+    for count in args.rules:
+        rules = make_rules(count)
+        with override_settings(TOS_EXEMPT_PATHS=rules):
+            middleware = UserAgreementMiddleware(base.get_response)
+
+        # The rule that is checked last: the last regex, or the last prefix
+        if count > 1:
+            hit = base.make_request(path=f'/api/v{count - 1 - (count % 2 == 0)}/users/')
+        elif count:
+            hit = base.make_request(path='/static0/app.css')
+        else:
+            hit = miss
+
+        results.append({
+            'rules': count,
+            'hit_us': round(base.timeit(lambda: middleware.should_skip_request(hit), args.iterations), 3),
+            'miss_us': round(base.timeit(lambda: middleware.should_skip_request(miss), args.iterations), 3),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'rules':>6}{'hit us':>10}{'miss us':>10}")
+    for result in results:
+        print(f"{result['rules']:>6}{result['hit_us']:>10}{result['miss_us']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Measure the per-request overhead of UserAgreementMiddleware across cache backends
+
+Drives the middleware with RequestFactory requests for each path through it
+(fast skip, staff, cached agreement, cache miss and not agreed), spread over
+``--users`` users, against the local memory, file based and database caches:
+
+    python -m benchmarks.middleware --users 1000 --iterations 2000 --json --output results.json
+
+The JSON output includes the Python and Django versions, so results from
+different releases can be compared.
+"""
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import cycle
+from unittest import mock
+
+from . import base
+
+BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tos-benchmark',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tos_benchmark_cache',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+}
+
+PATHS = ['fast_skip', 'staff', 'agreed_hit', 'miss', 'not_agreed']
+
+
+@contextmanager
+def tos_cache_backend(name):
+    """Use a fresh cache of the given backend as the TOS cache"""
+    from django.core.cache import caches
+    from django.core.management import call_command
+    from django.test import override_settings
+
+    config = dict(BACKENDS[name])
+    tmpdir = None
+    if name == 'file':
+        tmpdir = tempfile.mkdtemp(prefix='tos-benchmark-')
+        config['LOCATION'] = tmpdir
+
+    try:
+        with override_settings(CACHES={'default': config, 'tos': config}, TOS_CACHE_NAME='tos'):
+            if name == 'db':
+                call_command('createcachetable', verbosity=0)
+
+            cache = caches['tos']
+            cache.clear()
+            with mock.patch('tos.utils.cache', cache), \
+                    mock.patch('tos.backends.cache', cache), \
+                    mock.patch('tos.middleware.cache', cache), \
+                    mock.patch('tos.views.cache', cache):
+                yield cache
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def measure(func, iterations, warmup=0):
+    """Call func and return the per-call timings in microseconds, after
+    some untimed warm-up calls"""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    mean = statistics.fmean(timings)
+    return {
+        'mean_us': round(mean, 2),
+        'p50_us': round(timings[len(timings) // 2], 2),
+        'p95_us': round(timings[int(len(timings) * 0.95) - 1], 2),
+        'p99_us': round(timings[int(len(timings) * 0.99) - 1], 2),
+        'requests_per_second': round(1e6 / mean) if mean else None,
+    }
+
+
+def run_backend(backend, users, iterations, warmup):
+    from tos.middleware import UserAgreementMiddleware
+    from tos.utils import invalidate_cached_agreements, stamp
+
+    agreed, not_agreed, staff, tos = users
+
+    results = []
+    with tos_cache_backend(backend) as cache:
+        invalidate_cached_agreements(sender=None)
+        cache.set_many({f'django:tos:skip_tos_check:{user_id}': True for user_id in staff})
+        cache.set_many({f'django:tos:agreed:{user_id}': stamp(True, tos.pk) for user_id in agreed})
+        cache.set_many({f'django:tos:agreed:{user_id}': stamp(False, tos.pk) for user_id in not_agreed})
+
+        middleware = UserAgreementMiddleware(base.get_response)
+
+        requests = {
+            'fast_skip': cycle([base.make_request()]),
+            'staff': cycle([base.make_request(user_id) for user_id in staff]),
+            'agreed_hit': cycle([base.make_request(user_id) for user_id in agreed]),
+            'not_agreed': cycle([base.make_request(user_id) for user_id in not_agreed]),
+        }
+
+        for path in PATHS:
+            if path == 'miss':
+                # Forget each agreement right before the request. Deleting
+                # the key is timed separately and subtracted.
+                agreed_requests = cycle([(user_id, base.make_request(user_id)) for user_id in agreed])
+
+                def forget():
+                    user_id, request = next(agreed_requests)
+                    cache.delete(f'django:tos:agreed:{user_id}')
+                    return request
+
+                delete_timings = measure(forget, iterations, warmup)
+                timings = measure(lambda: middleware(forget()), iterations, warmup)
+                delete_mean = statistics.fmean(delete_timings)
+                timings = [max(timing - delete_mean, 0) for timing in timings]
+            else:
+                path_requests = requests[path]
+                timings = measure(lambda: middleware(next(path_requests)), iterations, warmup)
+
+            results.append({'backend': backend, 'path': path, **summarize(timings)})
+
+    return results
+
+
+def create_users(count):
+    from django.contrib.auth import get_user_model
+
+    from tos.models import TermsOfService, UserAgreement
+
+    User = get_user_model()
+    User.objects.bulk_create([User(username=f'agreed{i}') for i in range(count)])
+    User.objects.bulk_create([User(username=f'not_agreed{i}') for i in range(count)])
+    User.objects.bulk_create([User(username=f'staff{i}', is_staff=True) for i in range(count)])
+
+    agreed = list(User.objects.filter(username__startswith='agreed').values_list('pk', flat=True))
+    not_agreed = list(User.objects.filter(username__startswith='not_agreed').values_list('pk', flat=True))
+    staff = list(User.objects.filter(is_staff=True).values_list('pk', flat=True))
+
+    tos = TermsOfService.objects.create(content='Terms', active=True)
+    UserAgreement.objects.bulk_create([UserAgreement(terms_of_service=tos, user_id=user_id) for user_id in agreed])
+
+    return agreed, not_agreed, staff, tos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=1000, help='Requests per path and backend')
+    parser.add_argument('--warmup', type=int, default=50, help='Untimed requests before each measurement')
+    parser.add_argument('--users', type=int, default=100, help='Users of each kind to spread the requests over')
+    parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=['locmem', 'file', 'db'])
+    parser.add_argument('--json', action='store_true', help='Output the results as JSON')
+    parser.add_argument('--output', help='File to write the results to (defaults to stdout)')
+    args = parser.parse_args()
+
+    base.setup()
+
+    import django
+
+    users = create_users(args.users)
+
+    results = []
+    for backend in args.backends:
+        results.extend(run_backend(backend, users, args.iterations, args.warmup))
+
+    if args.json:
+        output = json.dumps({
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'users': args.users,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'results': results,
+        }, indent=2)
+    else:
+        lines = [f"{'backend':<8}{'path':<12}{'mean us':>10}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'req/s':>10}"]
+        for result in results:
+            lines.append(
+                f"{result['backend']:<8}{result['path']:<12}"
+                f"{result['mean_us']:>10}{result['p50_us']:>10}{result['p95_us']:>10}{result['p99_us']:>10}"
+                f"{result['requests_per_second']:>10}"
+            )
+        output = '\n'.join(lines)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Count the TOS cache round trips made by UserAgreementMiddleware per request
+
+Compares the middleware against the serial lookups it used to make (the key
+version, then the skip flag, then the agreement), optionally adding some
+latency to every cache call to simulate a network cache:
+
+    python -m benchmarks.roundtrips --latency 0.5 --iterations 200
+"""
+import argparse
+import json
+
+from . import base
+
+
+def serial_lookups(cache, user_id):
+    """The lookups the middleware made before they were collapsed, using a
+    global key version counter"""
+    key_version = cache.get('django:tos:key_version')
+    if cache.get(f'django:tos:skip_tos_check:{user_id}', False, version=key_version):
+        return
+    cache.get(f'django:tos:agreed:{user_id}', None, version=key_version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0, help='Simulated latency per cache call, in ms')
+    parser.add_argument('--json', action='store_true', help='Output the results as JSON')
+    args = parser.parse_args()
+
+    base.setup()
+
+    from django.contrib.auth import get_user_model
+
+    from tos.middleware import UserAgreementMiddleware
+    from tos.models import TermsOfService, UserAgreement
+    from tos.tests.utils import count_tos_cache_calls
+    from tos.utils import get_tos_cache, invalidate_cached_agreements, stamp
+
+    cache = get_tos_cache()
+    cache.clear()
+
+    User = get_user_model()
+    staff = User.objects.create_user('staff', is_staff=True)
+    agreed = User.objects.create_user('agreed')
+    not_agreed = User.objects.create_user('not_agreed')
+
+    tos = TermsOfService.objects.create(content='Terms', active=True)
+    UserAgreement.objects.create(terms_of_service=tos, user=agreed)
+    invalidate_cached_agreements(sender=None)
+
+    cache.set(f'django:tos:skip_tos_check:{staff.pk}', True)
+    cache.set(f'django:tos:agreed:{agreed.pk}', stamp(True, tos.pk))
+    cache.set(f'django:tos:agreed:{not_agreed.pk}', stamp(False, tos.pk))
+
+    # The serial lookups read the old versioned key layout. The current keys
+    # use the cache's default version of 1, so use another one.
+    key_version = 2
+    cache.set('django:tos:key_version', key_version)
+    cache.set(f'django:tos:skip_tos_check:{staff.pk}', True, version=key_version)
+    cache.set(f'django:tos:agreed:{agreed.pk}', True, version=key_version)
+    cache.set(f'django:tos:agreed:{not_agreed.pk}', False, version=key_version)
+
+    middleware = UserAgreementMiddleware(base.get_response)
+
+    results = []
+    with count_tos_cache_calls(latency=args.latency / 1000) as counting_cache:
+        for path, user in [('staff', staff), ('agreed', agreed), ('not agreed', not_agreed)]:
+            request = base.make_request(user.pk)
+
+            # Run each scenario once untimed, so first call costs (imports,
+            # settings lookups, cold caches) aren't measured
+            serial_lookups(counting_cache, user.pk)
+            middleware(request)
+
+            counting_cache.reset()
+            serial_us = base.timeit(lambda: serial_lookups(counting_cache, user.pk), args.iterations)
+            serial_round_trips = counting_cache.round_trips / args.iterations
+
+            counting_cache.reset()
+            middleware_us = base.timeit(lambda: middleware(request), args.iterations)
+            round_trips = counting_cache.round_trips / args.iterations
+
+            results.append({
+                'path': path,
+                'serial_round_trips': serial_round_trips,
+                'round_trips': round_trips,
+                'round_trips_saved': serial_round_trips - round_trips,
+                'serial_us': round(serial_us, 1),
+                'middleware_us': round(middleware_us, 1),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'path':<12}{'serial':>8}{'now':>6}{'saved':>7}{'serial us':>12}{'middleware us':>15}")
+    for result in results:
+        print(
+            f"{result['path']:<12}"
+            f"{result['serial_round_trips']:>8g}"
+            f"{result['round_trips']:>6g}"
+            f"{result['round_trips_saved']:>7g}"
+            f"{result['serial_us']:>12}"
+            f"{result['middleware_us']:>15}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import logging
+import os
 import sys
+import tempfile
 
 import django
 
@@ -13,6 +15,11 @@ if not settings.configured:
         'DATABASES': {
             'default': {
                 'ENGINE': 'django.db.backends.sqlite3',
+                # A file rather than an in-memory database, so tests can use
+                # more than one connection at a time
+                'TEST': {
+                    'NAME': os.path.join(tempfile.gettempdir(), 'django_tos_tests.sqlite3'),
+                },
             }
         },
         'DEFAULT_AUTO_FIELD': 'django.db.models.AutoField',
@@ -1,5 +1,10 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
 
+from tos.export import export_user_agreements
 from tos.models import TermsOfService, UserAgreement
 
 
@@ -9,7 +14,83 @@ class TermsOfServiceAdmin(admin.ModelAdmin):
 admin.site.register(TermsOfService, TermsOfServiceAdmin)
 
 
+def estimate_row_count(model, using='default'):
+    """
+    Return the database's estimate of the number of rows in the model's table,
+    or None if the database doesn't keep one
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)"
+    elif connection.vendor == 'mysql':
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+
+    # PostgreSQL reports -1 for tables that have never been analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses the database's row estimate instead of COUNT(*) for
+    large, unfiltered querysets
+
+    Filtered querysets, small tables, and databases without estimates are
+    counted exactly.
+    """
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.exact_count_threshold:
+                return estimate
+        return super().count
+
+
+def _streaming_export_response(queryset, format, content_type):
+    response = StreamingHttpResponse(
+        export_user_agreements(queryset, format),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="user_agreements.{format}"'
+    return response
+
+
+@admin.action(description="Export selected user agreements as CSV")
+def export_as_csv(modeladmin, request, queryset):
+    return _streaming_export_response(queryset, 'csv', 'text/csv')
+
+
+@admin.action(description="Export selected user agreements as JSON Lines")
+def export_as_jsonl(modeladmin, request, queryset):
+    return _streaming_export_response(queryset, 'jsonl', 'application/jsonl')
+
+
 class UserAgreementAdmin(admin.ModelAdmin):
     model = UserAgreement
+    actions = [export_as_csv, export_as_jsonl]
+    list_display = ('user', 'terms_of_service', 'created')
+    list_select_related = ('user', 'terms_of_service')
+    list_filter = ('terms_of_service', 'created')
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    # Don't count the whole table when the changelist is filtered
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # The changelist only shows when each TOS was created, not its content
+        return super().get_queryset(request).defer('terms_of_service__content')
 
 admin.site.register(UserAgreement, UserAgreementAdmin)
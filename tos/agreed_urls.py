@@ -0,0 +1,11 @@
+from django.urls import re_path
+
+from tos.views import agreed_users
+
+
+# Opt-in, as it is meant for other services rather than users:
+# include('tos.agreed_urls') next to tos.urls or tos.async_urls
+urlpatterns = [
+    # Which of a list of users have agreed to the active TOS
+    re_path(r'^agreed/$', agreed_users, name='tos_agreed_users'),
+]
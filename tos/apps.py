@@ -1,9 +1,14 @@
 from django.apps import AppConfig
 from django.conf import settings
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_delete, post_save
 
-from .signal_handlers import invalidate_cached_agreements
-from .utils import initialize_cache_version
+from .signal_handlers import (
+    cache_deleted_user,
+    cache_user_agreement,
+    invalidate_cached_agreements,
+    invalidate_cached_agreements_on_delete,
+)
+from .utils import invalidate_current_tos
 
 
 class TOSConfig(AppConfig):
@@ -13,12 +18,33 @@ class TOSConfig(AppConfig):
     default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
-        MIDDLEWARES = getattr(settings, 'MIDDLEWARE', [])
-        if 'tos.middleware.UserAgreementMiddleware' in MIDDLEWARES:  # pragma: no cover
-            TermsOfService = self.get_model('TermsOfService')
+        TermsOfService = self.get_model('TermsOfService')
+        UserAgreement = self.get_model('UserAgreement')
 
-            initialize_cache_version()
+        # The current TOS is cached whether or not the middleware is used
+        post_save.connect(invalidate_current_tos,
+                          sender=TermsOfService,
+                          dispatch_uid='invalidate_current_tos')
+        post_delete.connect(invalidate_current_tos,
+                            sender=TermsOfService,
+                            dispatch_uid='invalidate_current_tos')
 
-            pre_save.connect(invalidate_cached_agreements,
-                             sender=TermsOfService,
-                             dispatch_uid='invalidate_cached_agreements')
+        # Agreements are written through to the cache wherever they are
+        # created. Deleting them is handled by UserAgreement.delete() and its
+        # queryset's delete() instead of a post_delete receiver, which would
+        # stop agreements being fast-deleted along with their TOS or user.
+        post_save.connect(cache_user_agreement,
+                          sender=UserAgreement,
+                          dispatch_uid='cache_user_agreement')
+        post_delete.connect(cache_deleted_user,
+                            sender=settings.AUTH_USER_MODEL,
+                            dispatch_uid='cache_deleted_user')
+
+        # The active TOS is cached for the middleware and for
+        # users_agreed_latest_tos, which can be used without the middleware
+        post_save.connect(invalidate_cached_agreements,
+                          sender=TermsOfService,
+                          dispatch_uid='invalidate_cached_agreements')
+        post_delete.connect(invalidate_cached_agreements_on_delete,
+                            sender=TermsOfService,
+                            dispatch_uid='invalidate_cached_agreements_on_delete')
@@ -0,0 +1,16 @@
+from django.urls import re_path
+
+from tos.views import acheck_tos, AsyncTosView, metrics
+
+
+# The same URLs as tos.urls, with the async views, for ASGI
+urlpatterns = [
+    # Terms of Service conform
+    re_path(r'^confirm/$', acheck_tos, name='tos_check_tos'),
+
+    # Middleware metrics of the current process, for staff users
+    re_path(r'^metrics/$', metrics, name='tos_metrics'),
+
+    # Terms of service simple display
+    re_path(r'^$', AsyncTosView.as_view(), name='tos'),
+]
@@ -0,0 +1,395 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .utils import (
+    CACHE_MISS_POLL_INTERVAL,
+    _user_state_from_values,
+    _user_state_keys,
+    acache_active_tos,
+    aget_cached_user_state,
+    apoll_cached_value,
+    cache_active_tos,
+    get_cached_user_state,
+    get_tos_cache,
+    poll_cached_value,
+    stamp,
+    unstamp,
+)
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+cache = get_tos_cache()
+
+
+class BaseAgreementBackend:
+    """
+    Keeps track of whether users agreed to each TOS, for
+    UserAgreementMiddleware and the other cached agreement lookups
+
+    The active TOS and the skip flags always live in the TOS cache. Backends
+    only store the agreements, by TOS ID, so activating another TOS simply
+    starts from nothing. ``None`` means the backend doesn't know whether the
+    user agreed, and the database has to be asked.
+
+    Subclasses implement ``get_agreed``, ``get_many_agreed``, ``set_agreed``
+    and ``set_many_agreed``. The async versions run the sync ones in a thread
+    unless they are overridden.
+    """
+    def get_agreed(self, tos_id, user_id):
+        raise NotImplementedError
+
+    def get_many_agreed(self, tos_id, user_ids):
+        """Return a ``{user_id: agreed}`` dict of the users that are known"""
+        raise NotImplementedError
+
+    def set_agreed(self, tos_id, user_id, agreed):
+        raise NotImplementedError
+
+    def set_many_agreed(self, tos_id, agreements, active=None):
+        """
+        Store a ``{user_id: agreed}`` dict of agreements. ``active`` says
+        whether the TOS is the active one, if the caller knows.
+        """
+        raise NotImplementedError
+
+    async def aget_agreed(self, tos_id, user_id):
+        return await sync_to_async(self.get_agreed)(tos_id, user_id)
+
+    async def aset_agreed(self, tos_id, user_id, agreed):
+        await sync_to_async(self.set_agreed)(tos_id, user_id, agreed)
+
+    def get_user_state(self, user_id):
+        """
+        Return the ``(tos_id, can_skip, user_agreed)`` of a user, like
+        tos.utils.get_cached_user_state
+        """
+        values = cache.get_many(_user_state_keys(user_id, agreement=False))
+
+        active_tos = values.get('django:tos:active_tos')
+        if active_tos is None:
+            active_tos = cache_active_tos()
+
+        tos_id, can_skip, user_agreed = _user_state_from_values(values, user_id, active_tos)
+        if not can_skip and tos_id is not None:
+            agreed = self.get_agreed(tos_id, user_id)
+            if agreed is not None:
+                user_agreed = agreed
+        return tos_id, can_skip, user_agreed
+
+    async def aget_user_state(self, user_id):
+        """Async version of get_user_state"""
+        values = await cache.aget_many(_user_state_keys(user_id, agreement=False))
+
+        active_tos = values.get('django:tos:active_tos')
+        if active_tos is None:
+            active_tos = await acache_active_tos()
+
+        tos_id, can_skip, user_agreed = _user_state_from_values(values, user_id, active_tos)
+        if not can_skip and tos_id is not None:
+            agreed = await self.aget_agreed(tos_id, user_id)
+            if agreed is not None:
+                user_agreed = agreed
+        return tos_id, can_skip, user_agreed
+
+    def poll_agreed(self, tos_id, user_id):
+        """
+        Wait up to ``TOS_CACHE_MISS_WAIT`` seconds for another request to
+        store the user's agreement, and return it, or None
+        """
+        deadline = time.monotonic() + getattr(settings, 'TOS_CACHE_MISS_WAIT', 0.5)
+        while True:
+            agreed = self.get_agreed(tos_id, user_id)
+            if agreed is not None or time.monotonic() >= deadline:
+                return agreed
+            time.sleep(CACHE_MISS_POLL_INTERVAL)
+
+    async def apoll_agreed(self, tos_id, user_id):
+        """Async version of poll_agreed"""
+        deadline = time.monotonic() + getattr(settings, 'TOS_CACHE_MISS_WAIT', 0.5)
+        while True:
+            agreed = await self.aget_agreed(tos_id, user_id)
+            if agreed is not None or time.monotonic() >= deadline:
+                return agreed
+            await asyncio.sleep(CACHE_MISS_POLL_INTERVAL)
+
+
+class CacheAgreementBackend(BaseAgreementBackend):
+    """
+    Keep each user's agreement in its own TOS cache key, stamped with the ID
+    of the TOS (the default)
+
+    The active TOS, the skip flag and the agreement are read in a single
+    round trip. A key only holds the agreements to the active TOS, and to the
+    TOS being warmed up ahead of a rollover.
+    """
+    def get_agreed(self, tos_id, user_id):
+        return unstamp(cache.get(f'django:tos:agreed:{user_id}'), tos_id)
+
+    def get_many_agreed(self, tos_id, user_ids):
+        keys = {f'django:tos:agreed:{user_id}': user_id for user_id in user_ids}
+        agreements = {}
+        for key, stamped in cache.get_many(list(keys)).items():
+            agreed = unstamp(stamped, tos_id)
+            if agreed is not None:
+                agreements[keys[key]] = agreed
+        return agreements
+
+    def set_agreed(self, tos_id, user_id, agreed):
+        cache.set(f'django:tos:agreed:{user_id}', stamp(agreed, tos_id))
+
+    def set_many_agreed(self, tos_id, agreements, active=None):
+        if not agreements:
+            return
+
+        keys = {user_id: f'django:tos:agreed:{user_id}' for user_id in agreements}
+
+        if not active:
+            active_tos = cache.get('django:tos:active_tos')
+            if active_tos is None:
+                active_tos = cache_active_tos()
+            active_tos_id = active_tos[0]
+            active = active_tos_id == tos_id
+
+        if active:
+            cache.set_many({keys[user_id]: stamp(agreed, tos_id) for user_id, agreed in agreements.items()})
+            return
+
+        # Keep the agreements to the active TOS next to the new ones, and
+        # drop any others, so stamps don't grow
+        cached = cache.get_many(list(keys.values()))
+        values = {}
+        for user_id, agreed in agreements.items():
+            value = stamp(agreed, tos_id)
+            current = unstamp(cached.get(keys[user_id]), active_tos_id)
+            if current is not None:
+                value[active_tos_id] = current
+            values[keys[user_id]] = value
+        cache.set_many(values)
+
+    async def aget_agreed(self, tos_id, user_id):
+        return unstamp(await cache.aget(f'django:tos:agreed:{user_id}'), tos_id)
+
+    async def aset_agreed(self, tos_id, user_id, agreed):
+        await cache.aset(f'django:tos:agreed:{user_id}', stamp(agreed, tos_id))
+
+    def get_user_state(self, user_id):
+        return get_cached_user_state(user_id)
+
+    async def aget_user_state(self, user_id):
+        return await aget_cached_user_state(user_id)
+
+    def poll_agreed(self, tos_id, user_id):
+        # Can serve the agreement to the previous TOS with
+        # TOS_CACHE_MISS_SERVE_STALE
+        return poll_cached_value(f'django:tos:agreed:{user_id}', tos_id)
+
+    async def apoll_agreed(self, tos_id, user_id):
+        return await apoll_cached_value(f'django:tos:agreed:{user_id}', tos_id)
+
+
+class LocMemAgreementBackend(BaseAgreementBackend):
+    """
+    Keep the agreements in per-process dicts, one per TOS, for tests and
+    single process deployments
+
+    Only the agreements to the ``max_tos`` most recently stored TOS are kept.
+    User IDs are stored as strings, as the middleware reads them from the
+    session.
+    """
+    def __init__(self, max_tos=2):
+        self.max_tos = max_tos
+        self.lock = threading.Lock()
+        self.agreements = OrderedDict()
+
+    def _agreements(self, tos_id):
+        # Must be called with the lock held
+        agreements = self.agreements.get(tos_id)
+        if agreements is None:
+            agreements = self.agreements[tos_id] = {}
+            while len(self.agreements) > self.max_tos:
+                self.agreements.popitem(last=False)
+        return agreements
+
+    def get_agreed(self, tos_id, user_id):
+        with self.lock:
+            return self.agreements.get(tos_id, {}).get(str(user_id))
+
+    def get_many_agreed(self, tos_id, user_ids):
+        with self.lock:
+            agreements = self.agreements.get(tos_id, {})
+            return {
+                user_id: agreements[str(user_id)]
+                for user_id in user_ids if str(user_id) in agreements
+            }
+
+    def set_agreed(self, tos_id, user_id, agreed):
+        with self.lock:
+            self._agreements(tos_id)[str(user_id)] = agreed
+
+    def set_many_agreed(self, tos_id, agreements, active=None):
+        with self.lock:
+            self._agreements(tos_id).update(
+                (str(user_id), agreed) for user_id, agreed in agreements.items()
+            )
+
+    async def aget_agreed(self, tos_id, user_id):
+        return self.get_agreed(tos_id, user_id)
+
+    async def aset_agreed(self, tos_id, user_id, agreed):
+        self.set_agreed(tos_id, user_id, agreed)
+
+    def clear(self, tos_id=None):
+        with self.lock:
+            if tos_id is None:
+                self.agreements.clear()
+            else:
+                self.agreements.pop(tos_id, None)
+
+
+class RedisAgreementBackend(BaseAgreementBackend):
+    """
+    Keep the agreements to each TOS in Redis, as a pair of sets (the users
+    who agreed and the users who didn't) or, with ``bitmap=True``, a pair of
+    bitmaps indexed by user ID (whether the user agreed, and whether that is
+    known)
+
+    A bitmap takes one bit per user ID up to the largest one, so a million
+    users cost 250KB per TOS. It needs non-negative integer user IDs.
+
+    Pass a ``redis.Redis`` (or compatible) ``client``, or the ``url`` to
+    connect to. An optional ``async_client`` (``redis.asyncio.Redis``) is
+    used by the async lookups instead of a thread. Every lookup is a single
+    round trip.
+    """
+    def __init__(self, client=None, url=None, async_client=None, bitmap=False, prefix='django:tos'):
+        if client is None:
+            if redis is None:
+                raise ImproperlyConfigured(
+                    'RedisAgreementBackend needs the redis package, or a client'
+                )
+            if url is None:
+                raise ImproperlyConfigured('RedisAgreementBackend needs a client or a url')
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.async_client = async_client
+        self.bitmap = bitmap
+        self.prefix = prefix
+
+    def keys(self, tos_id):
+        """The keys of the agreed and the not agreed (or known) structures"""
+        if self.bitmap:
+            return f'{self.prefix}:agreed_bits:{tos_id}', f'{self.prefix}:known_bits:{tos_id}'
+        return f'{self.prefix}:agreed_users:{tos_id}', f'{self.prefix}:declined_users:{tos_id}'
+
+    def _offset(self, user_id):
+        offset = int(user_id)
+        if offset < 0:
+            raise ValueError(f'Bitmaps need non-negative user IDs, not {user_id!r}')
+        return offset
+
+    def _queue_get(self, pipe, tos_id, user_id):
+        agreed_key, other_key = self.keys(tos_id)
+        if self.bitmap:
+            offset = self._offset(user_id)
+            pipe.getbit(agreed_key, offset)
+            pipe.getbit(other_key, offset)
+        else:
+            pipe.sismember(agreed_key, str(user_id))
+            pipe.sismember(other_key, str(user_id))
+
+    def _queue_set(self, pipe, tos_id, user_id, agreed):
+        agreed_key, other_key = self.keys(tos_id)
+        if self.bitmap:
+            offset = self._offset(user_id)
+            pipe.setbit(agreed_key, offset, 1 if agreed else 0)
+            pipe.setbit(other_key, offset, 1)
+        elif agreed:
+            pipe.sadd(agreed_key, str(user_id))
+            pipe.srem(other_key, str(user_id))
+        else:
+            pipe.sadd(other_key, str(user_id))
+            pipe.srem(agreed_key, str(user_id))
+
+    def _agreed(self, agreed, other):
+        if self.bitmap:
+            return bool(agreed) if other else None
+        if agreed:
+            return True
+        return False if other else None
+
+    def get_agreed(self, tos_id, user_id):
+        pipe = self.client.pipeline(transaction=False)
+        self._queue_get(pipe, tos_id, user_id)
+        return self._agreed(*pipe.execute())
+
+    def get_many_agreed(self, tos_id, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            self._queue_get(pipe, tos_id, user_id)
+        results = pipe.execute()
+
+        agreements = {}
+        for i, user_id in enumerate(user_ids):
+            agreed = self._agreed(results[2 * i], results[2 * i + 1])
+            if agreed is not None:
+                agreements[user_id] = agreed
+        return agreements
+
+    def set_agreed(self, tos_id, user_id, agreed):
+        self.set_many_agreed(tos_id, {user_id: agreed})
+
+    def set_many_agreed(self, tos_id, agreements, active=None):
+        if not agreements:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, agreed in agreements.items():
+            self._queue_set(pipe, tos_id, user_id, agreed)
+        pipe.execute()
+
+    async def aget_agreed(self, tos_id, user_id):
+        if self.async_client is None:
+            return await super().aget_agreed(tos_id, user_id)
+
+        pipe = self.async_client.pipeline(transaction=False)
+        self._queue_get(pipe, tos_id, user_id)
+        return self._agreed(*await pipe.execute())
+
+    async def aset_agreed(self, tos_id, user_id, agreed):
+        if self.async_client is None:
+            return await super().aset_agreed(tos_id, user_id, agreed)
+
+        pipe = self.async_client.pipeline(transaction=False)
+        self._queue_set(pipe, tos_id, user_id, agreed)
+        await pipe.execute()
+
+    def clear(self, tos_id):
+        """Delete the agreements to a TOS, for instance once it's been replaced"""
+        self.client.delete(*self.keys(tos_id))
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    options = getattr(settings, 'TOS_AGREEMENT_BACKEND_OPTIONS', {})
+    return import_string(path)(**options)
+
+
+def get_agreement_backend():
+    """
+    Return the process-wide agreement backend from ``TOS_AGREEMENT_BACKEND``,
+    created with the ``TOS_AGREEMENT_BACKEND_OPTIONS``
+    """
+    return _load_backend(getattr(settings, 'TOS_AGREEMENT_BACKEND', 'tos.backends.CacheAgreementBackend'))
@@ -0,0 +1,53 @@
+import csv
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+EXPORT_FIELDS = ('id', 'user_id', 'username', 'terms_of_service_id', 'created')
+
+
+class _Echo:
+    """
+    A file-like object that just returns what is written to it, so csv.writer
+    can format one row at a time
+    """
+    def write(self, value):
+        return value
+
+
+def iter_user_agreement_rows(queryset, chunk_size=2000):
+    """
+    Yield a tuple of EXPORT_FIELDS for each user agreement in the queryset
+
+    The username is joined in the same query and no model instances are
+    created, so memory use doesn't depend on the number of agreements.
+    """
+    username_field = get_user_model().USERNAME_FIELD
+
+    return queryset\
+        .order_by('pk')\
+        .values_list('pk', 'user_id', f'user__{username_field}', 'terms_of_service_id', 'created')\
+        .iterator(chunk_size=chunk_size)
+
+
+def export_user_agreements(queryset, format='csv', chunk_size=2000):
+    """
+    Yield the user agreements in the queryset as lines of CSV (with a header)
+    or JSON Lines
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {format}")
+
+    rows = iter_user_agreement_rows(queryset, chunk_size)
+
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + '\n'
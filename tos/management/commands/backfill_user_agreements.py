@@ -0,0 +1,92 @@
+import sys
+import time
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tos.models import TermsOfService
+from tos.utils import add_user_agreements
+
+
+class Command(BaseCommand):
+    help = (
+        "Record that users agreed to a terms of service, for instance when "
+        "migrating from another consent system"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tos',
+            type=int,
+            help='ID of the terms of service the users agreed to (defaults to the active one)',
+        )
+        parser.add_argument(
+            '--file',
+            help='File with one user ID per line, or - to read from stdin (defaults to all users)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of agreements to create at a time',
+        )
+
+    def handle(self, *args, **options):
+        if options['tos'] is None:
+            tos = TermsOfService.objects.get_current_tos()
+        else:
+            try:
+                tos = TermsOfService.objects.get(pk=options['tos'])
+            except TermsOfService.DoesNotExist:
+                raise CommandError(f"Terms of service {options['tos']} does not exist")
+
+        batch_size = options['batch_size']
+
+        if options['file'] is None:
+            user_ids = get_user_model().objects\
+                .order_by('pk')\
+                .values_list('pk', flat=True)\
+                .iterator(chunk_size=batch_size)
+            self.backfill(tos, user_ids, batch_size, check_users=False)
+        elif options['file'] == '-':
+            self.backfill(tos, self.read_user_ids(sys.stdin), batch_size, check_users=True)
+        else:
+            with open(options['file']) as f:
+                self.backfill(tos, self.read_user_ids(f), batch_size, check_users=True)
+
+    def read_user_ids(self, f):
+        for line in f:
+            line = line.strip()
+            if line:
+                yield int(line)
+
+    def backfill(self, tos, user_ids, batch_size, check_users):
+        User = get_user_model()
+
+        total = 0
+        start = time.monotonic()
+        while True:
+            batch = list(islice(user_ids, batch_size))
+            if not batch:
+                break
+
+            if check_users:
+                # Don't trip over foreign key constraints for unknown users
+                batch = list(User.objects.filter(pk__in=batch).values_list('pk', flat=True))
+
+            with transaction.atomic():
+                add_user_agreements(tos, batch)
+
+            total += len(batch)
+            elapsed = time.monotonic() - start
+            self.stdout.write(f"{total} users ({total / elapsed if elapsed else 0:.0f} users/s)")
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Successfully recorded agreements to terms of service {tos.pk} for {total} users "
+                f"in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} users/s)"
+            )
+        )
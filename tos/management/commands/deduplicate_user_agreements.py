@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from tos.utils import deduplicate_user_agreements
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete duplicate user agreements, keeping the oldest agreement of each "
+        "user to each terms of service"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of (user, terms of service) pairs to deduplicate at a time',
+        )
+
+    def handle(self, *args, **options):
+        deleted = deduplicate_user_agreements(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully deleted {deleted} duplicate user agreements")
+        )
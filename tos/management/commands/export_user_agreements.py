@@ -0,0 +1,74 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from tos.export import EXPORT_FORMATS, export_user_agreements
+from tos.models import UserAgreement
+
+
+def parse_date_or_datetime(value):
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            parsed = parse_date(value)
+            if parsed is not None:
+                parsed = datetime.datetime.combine(parsed, datetime.time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise CommandError(f"Invalid date: {value}")
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = "Export who agreed to which terms of service and when, as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument(
+            '--tos',
+            type=int,
+            action='append',
+            help='Only export agreements to this terms of service (can be repeated)',
+        )
+        parser.add_argument(
+            '--since',
+            help='Only export agreements made on or after this date or datetime',
+        )
+        parser.add_argument(
+            '--until',
+            help='Only export agreements made before this date or datetime',
+        )
+        parser.add_argument(
+            '--output',
+            help='File to write to (defaults to stdout)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Number of agreements to fetch from the database at a time',
+        )
+
+    def handle(self, *args, **options):
+        queryset = UserAgreement.objects.all()
+        if options['tos']:
+            queryset = queryset.filter(terms_of_service_id__in=options['tos'])
+        if options['since']:
+            queryset = queryset.filter(created__gte=parse_date_or_datetime(options['since']))
+        if options['until']:
+            queryset = queryset.filter(created__lt=parse_date_or_datetime(options['until']))
+
+        lines = export_user_agreements(queryset, options['format'], options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
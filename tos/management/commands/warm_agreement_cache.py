@@ -0,0 +1,73 @@
+import sys
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from tos.models import TermsOfService
+from tos.utils import get_warm_cache_user_ids, warm_agreement_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Cache whether recently active users agreed to a terms of service, "
+        "for instance before activating it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tos',
+            type=int,
+            help='ID of the terms of service to cache agreements to (defaults to the active one)',
+        )
+        parser.add_argument(
+            '--hours',
+            type=float,
+            default=24,
+            help='Cache the agreements of users who were active in this many hours (defaults to 24)',
+        )
+        parser.add_argument(
+            '--file',
+            help='File with one user ID per line, or - to read from stdin, instead of the recently active users',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of users to look up at a time',
+        )
+
+    def handle(self, *args, **options):
+        if options['tos'] is None:
+            tos = TermsOfService.objects.get_current_tos()
+        else:
+            try:
+                tos = TermsOfService.objects.get(pk=options['tos'])
+            except TermsOfService.DoesNotExist:
+                raise CommandError(f"Terms of service {options['tos']} does not exist")
+
+        start = time.monotonic()
+
+        if options['file'] is None:
+            since = timezone.now() - timedelta(hours=options['hours'])
+            total = warm_agreement_cache(tos, get_warm_cache_user_ids(since), options['chunk_size'])
+        elif options['file'] == '-':
+            total = warm_agreement_cache(tos, self.read_user_ids(sys.stdin), options['chunk_size'])
+        else:
+            with open(options['file']) as f:
+                total = warm_agreement_cache(tos, self.read_user_ids(f), options['chunk_size'])
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Successfully cached agreements to terms of service {tos.pk} for {total} users "
+                f"in {elapsed:.1f}s"
+            )
+        )
+
+    def read_user_ids(self, f):
+        for line in f:
+            line = line.strip()
+            if line:
+                yield int(line)
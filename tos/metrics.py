@@ -0,0 +1,131 @@
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+# Sent by SignalMetrics for every counter increment and timing, with ``kind``
+# ('counter' or 'timing'), ``name`` and ``value`` (seconds for timings)
+metric_recorded = Signal()
+
+# Upper bounds of the timing histogram buckets, in seconds
+TIMING_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class BaseMetrics:
+    """
+    Receives the counters and timings recorded by UserAgreementMiddleware
+
+    The middleware counts:
+
+    * ``fast_skip``: requests skipped without touching the session or cache
+    * ``local_cache_hit``: users found in the per-process cache
+    * ``remembered_hit``: agreements remembered in the session or a cookie
+    * ``staff_skip``: users allowed to skip the check
+    * ``cache_hit`` and ``cache_miss``: agreements found (or not) in the cache
+    * ``db_query``: agreements looked up in the database
+    * ``redirect``: users sent to the confirm page
+
+    and times ``check`` (the whole check, excluding the view) and
+    ``db_query``.
+    """
+    def increment(self, name, value=1):
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Return the current values, if the backend keeps them"""
+        return {}
+
+
+class InMemoryMetrics(BaseMetrics):
+    """
+    Keep the counters and timing histograms in memory, per process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = Counter()
+            self.timings = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def timing(self, name, seconds):
+        bucket = bisect_left(TIMING_BUCKETS, seconds)
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(TIMING_BUCKETS) + 1)}
+            timing['count'] += 1
+            timing['sum'] += seconds
+            timing['buckets'][bucket] += 1
+
+    def snapshot(self):
+        """
+        Return the counters, and for each timing its count, sum and the
+        cumulative number of timings at or below each bucket's upper bound
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {}
+            for name, timing in self.timings.items():
+                buckets = {}
+                total = 0
+                for bound, count in zip(TIMING_BUCKETS + ('+Inf',), timing['buckets']):
+                    total += count
+                    buckets[str(bound)] = total
+                timings[name] = {'count': timing['count'], 'sum': timing['sum'], 'buckets': buckets}
+
+        return {'counters': counters, 'timings': timings}
+
+
+class SignalMetrics(BaseMetrics):
+    """
+    Send the ``metric_recorded`` signal for every counter and timing, for
+    instance to forward them to statsd or Prometheus
+    """
+    def increment(self, name, value=1):
+        metric_recorded.send(sender=self.__class__, kind='counter', name=name, value=value)
+
+    def timing(self, name, seconds):
+        metric_recorded.send(sender=self.__class__, kind='timing', name=name, value=seconds)
+
+
+class LoggingMetrics(BaseMetrics):
+    """
+    Log every counter and timing to the ``tos.metrics`` logger at DEBUG level
+    """
+    logger = logging.getLogger('tos.metrics')
+
+    def increment(self, name, value=1):
+        self.logger.debug("%s +%s", name, value)
+
+    def timing(self, name, seconds):
+        self.logger.debug("%s %.6fs", name, seconds)
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_metrics():
+    """
+    Return the process-wide metrics backend from ``TOS_METRICS_BACKEND``, or
+    None if metrics are disabled, which is the default
+    """
+    path = getattr(settings, 'TOS_METRICS_BACKEND', None)
+    if not path:
+        return None
+    return _load_backend(path)
@@ -1,71 +1,388 @@
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY as session_key
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponseRedirect
 from django.urls import reverse_lazy
 from django.utils.cache import add_never_cache_headers
+from django.utils.functional import cached_property
 
+from .backends import get_agreement_backend
+from .metrics import get_metrics
 from .models import UserAgreement
-from .utils import get_tos_cache
+from .tracing import get_tracer
+from .utils import (
+    acache_miss_lock,
+    aget_session_value,
+    cache_miss_lock,
+    get_agreement_cookie_tos_id,
+    get_local_cache,
+    get_tos_cache,
+    set_agreement_cookie,
+    use_agreement_cookie,
+    use_session_agreement,
+)
 
 
 cache = get_tos_cache()
 tos_check_url = reverse_lazy('tos_check_tos')
 
+# Inline flags that can be scoped to part of a combined pattern
+SCOPED_REGEX_FLAGS = {re.IGNORECASE: 'i', re.MULTILINE: 'm', re.DOTALL: 's', re.VERBOSE: 'x'}
+
+
+def compile_exempt_paths(rules):
+    """
+    Compile ``TOS_EXEMPT_PATHS`` into a tuple of path prefixes (the strings)
+    and a single regex combining the compiled patterns, which are matched
+    against the start of the path
+    """
+    prefixes = []
+    regexes = []
+    patterns = []
+    for rule in rules:
+        if isinstance(rule, str):
+            prefixes.append(rule)
+        elif isinstance(rule, re.Pattern):
+            flags = ''.join(flag for value, flag in SCOPED_REGEX_FLAGS.items() if rule.flags & value)
+            regexes.append(rule)
+            patterns.append(f'(?{flags}:{rule.pattern})' if flags else f'(?:{rule.pattern})')
+        else:
+            raise ImproperlyConfigured(
+                f'TOS_EXEMPT_PATHS entries must be strings or compiled regexes, not {rule!r}'
+            )
+
+    if not patterns:
+        return tuple(prefixes), None
+
+    try:
+        return tuple(prefixes), re.compile('|'.join(patterns))
+    except re.error:
+        pass
+
+    # Some patterns can't be combined, e.g. because of global flags like
+    # (?i) or group names used twice, so find the first one that fails
+    for i, rule in enumerate(regexes):
+        try:
+            re.compile('|'.join(patterns[:i + 1]))
+        except re.error as e:
+            raise ImproperlyConfigured(f'Invalid TOS_EXEMPT_PATHS pattern {rule.pattern!r}: {e}') from e
+
 
 class UserAgreementMiddleware:
     """
     Some middleware to check if users have agreed to the latest TOS
     """
+    sync_capable = True
+    async_capable = True
+
+    # The steps timed when tracing is enabled, by span name
+    TRACED_STEPS = {
+        'tos-check': ('process_request', 'aprocess_request'),
+        'tos-remembered': ('has_remembered_agreement', 'ahas_remembered_agreement'),
+        'tos-cache': ('get_user_state', 'aget_user_state'),
+        'tos-db': ('get_and_cache_agreement_from_db', 'aget_and_cache_agreement_from_db'),
+    }
+
     def __init__(self, get_response):
         self.get_response = get_response
 
+        # Under ASGI, run natively on the event loop instead of being wrapped
+        # in a thread by Django
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+        # Optional per-process cache in front of the TOS cache. It only holds
+        # positive results, so a stale entry can never lock a user out.
+        self.local_cache = get_local_cache()
+
+        # Where the agreements are kept, see TOS_AGREEMENT_BACKEND
+        self.agreements = get_agreement_backend()
+
+        self.exempt_prefixes, self.exempt_pattern = compile_exempt_paths(
+            getattr(settings, 'TOS_EXEMPT_PATHS', ()))
+
+        # Optionally remember which TOS the user agreed to in the session or
+        # a signed cookie
+        self.session_agreement = use_session_agreement()
+        self.agreement_cookie = use_agreement_cookie()
+        self.remember_agreements = self.session_agreement or self.agreement_cookie
+
+        self.metrics = get_metrics()
+
+        # Optional per-request spans. The traced steps are wrapped once here,
+        # so there's nothing to pay per request when tracing is disabled.
+        self.tracer = get_tracer()
+        if self.tracer is not None:
+            for name, attrs in self.TRACED_STEPS.items():
+                for attr in attrs:
+                    setattr(self, attr, self.tracer.wrap(name, getattr(self, attr)))
+
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
         if self.should_fast_skip(request):
+            self.count('fast_skip')
             return self.get_response(request)
 
+        if self.tracer is None:
+            return self.check_and_respond(request)
+
+        token = self.tracer.start()
+        response = None
+        try:
+            response = self.check_and_respond(request)
+            return response
+        finally:
+            self.tracer.finish(token, request, response)
+
+    async def __acall__(self, request):
+        if await self.ashould_fast_skip(request):
+            self.count('fast_skip')
+            return await self.get_response(request)
+
+        if self.tracer is None:
+            return await self.acheck_and_respond(request)
+
+        token = self.tracer.start()
+        response = None
+        try:
+            response = await self.acheck_and_respond(request)
+            return response
+        finally:
+            self.tracer.finish(token, request, response)
+
+    def check_and_respond(self, request):
+        start = time.perf_counter()
+        response, user_id, agreed_tos_id = self.process_request(request)
+        self.record_timing('check', start)
+
+        if response is not None:
+            return response
+
+        response = self.get_response(request)
+        if agreed_tos_id is not None:
+            self.remember_agreement(request, response, user_id, agreed_tos_id)
+        return response
+
+    async def acheck_and_respond(self, request):
+        start = time.perf_counter()
+        response, user_id, agreed_tos_id = await self.aprocess_request(request)
+        self.record_timing('check', start)
+
+        if response is not None:
+            return response
+
+        response = await self.get_response(request)
+        if agreed_tos_id is not None:
+            self.remember_agreement(request, response, user_id, agreed_tos_id)
+        return response
+
+    def process_request(self, request):
+        '''
+        Check the user's agreement
+
+        Returns a redirect to the confirm page or None, the user ID, and the ID
+        of the TOS the user agreed to if it should be remembered in the
+        session or a cookie. The user ID is read here, as the view may log the
+        user out or in as someone else.
+        '''
         # Grab the user ID from the session so we avoid hitting the database
         # for the user object.
         # NOTE: We use the user ID because it's not user-settable and it won't
         #       ever change (usernames and email addresses can change)
         user_id = request.session['_auth_user_id']
 
-        # Get the cache prefix
-        key_version = cache.get('django:tos:key_version')
+        if self.is_locally_cached(user_id):
+            self.count('local_cache_hit')
+            return None, user_id, None
 
-        # Skip if the user is allowed to skip - for instance, if the user is an
-        # admin or a staff member
-        if cache.get(f'django:tos:skip_tos_check:{user_id}', False, version=key_version):
-            return self.get_response(request)
+        if self.remember_agreements and self.has_remembered_agreement(request, user_id):
+            self.count('remembered_hit')
+            return None, user_id, None
 
-        # Ping the cache for the user agreement
-        user_agreed = cache.get(f'django:tos:agreed:{user_id}', None, version=key_version)
+        # Get the active TOS, whether the user can skip the check, and the
+        # user agreement in a single round trip
+        tos_id, can_skip, user_agreed = self.get_user_state(user_id)
 
         # If the cache is missing this user
-        if user_agreed is None:
+        if not can_skip and user_agreed is None:
+            self.count('cache_miss')
             # Check the database and cache the result
-            user_agreed = self.get_and_cache_agreement_from_db(user_id, key_version)
+            user_agreed = self.get_and_cache_agreement_from_db(user_id, tos_id)
+        elif not can_skip:
+            self.count('cache_hit')
+
+        return self.finish_check(request, user_id, tos_id, can_skip, user_agreed)
+
+    async def aprocess_request(self, request):
+        '''Async version of process_request'''
+        # The session has been loaded by ashould_fast_skip
+        user_id = request.session['_auth_user_id']
+
+        if self.is_locally_cached(user_id):
+            self.count('local_cache_hit')
+            return None, user_id, None
+
+        if self.remember_agreements and await self.ahas_remembered_agreement(request, user_id):
+            self.count('remembered_hit')
+            return None, user_id, None
+
+        tos_id, can_skip, user_agreed = await self.aget_user_state(user_id)
+
+        if not can_skip and user_agreed is None:
+            self.count('cache_miss')
+            user_agreed = await self.aget_and_cache_agreement_from_db(user_id, tos_id)
+        elif not can_skip:
+            self.count('cache_hit')
+
+        return self.finish_check(request, user_id, tos_id, can_skip, user_agreed)
+
+    def finish_check(self, request, user_id, tos_id, can_skip, user_agreed):
+        response = self.check_agreement(request, user_id, tos_id, can_skip, user_agreed)
+        if response is None and self.remember_agreements and not can_skip:
+            return None, user_id, tos_id
+        return response, user_id, None
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.increment(name)
+
+    def record_timing(self, name, start):
+        if self.metrics is not None:
+            self.metrics.timing(name, time.perf_counter() - start)
+
+    def get_user_state(self, user_id):
+        '''Get the active TOS ID, the skip flag and the agreement for a user'''
+        return self.agreements.get_user_state(user_id)
+
+    async def aget_user_state(self, user_id):
+        '''Async version of get_user_state'''
+        return await self.agreements.aget_user_state(user_id)
+
+    def is_locally_cached(self, user_id):
+        '''Check if this process already knows the user can continue'''
+        if self.local_cache is None:
+            return False
+
+        if self.local_cache.get(('skip', user_id)):
+            return True
+
+        # The local agreements include the TOS ID, so activating another TOS
+        # orphans them
+        tos_id = self.local_cache.get('django:tos:active_tos')
+        return tos_id is not None and bool(self.local_cache.get(('agreed', tos_id, user_id)))
+
+    def get_remembered_tos_id(self, request, user_id):
+        '''Return the ID of the TOS the session or the signed cookie says the user agreed to'''
+        if self.session_agreement:
+            tos_id = request.session.get('tos_agreed')
+            if tos_id is not None:
+                return tos_id
+
+        if self.agreement_cookie:
+            return get_agreement_cookie_tos_id(request, user_id)
+
+        return None
+
+    def has_remembered_agreement(self, request, user_id):
+        '''Check if the session or the signed cookie says the user agreed to the active TOS'''
+        agreed_tos_id = self.get_remembered_tos_id(request, user_id)
+        if agreed_tos_id is None:
+            return False
+
+        # Only the active TOS ID has to be looked up, and not at all if it is
+        # in the local cache
+        tos_id = self.local_cache.get('django:tos:active_tos') if self.local_cache is not None else None
+        if tos_id is None:
+            active_tos = cache.get('django:tos:active_tos')
+            if active_tos is None:
+                return False
+            tos_id = active_tos[0]
+            if self.local_cache is not None:
+                self.local_cache.set('django:tos:active_tos', tos_id)
+
+        return agreed_tos_id == tos_id
+
+    async def ahas_remembered_agreement(self, request, user_id):
+        '''Async version of has_remembered_agreement'''
+        # The session has already been loaded
+        agreed_tos_id = self.get_remembered_tos_id(request, user_id)
+        if agreed_tos_id is None:
+            return False
+
+        tos_id = self.local_cache.get('django:tos:active_tos') if self.local_cache is not None else None
+        if tos_id is None:
+            active_tos = await cache.aget('django:tos:active_tos')
+            if active_tos is None:
+                return False
+            tos_id = active_tos[0]
+            if self.local_cache is not None:
+                self.local_cache.set('django:tos:active_tos', tos_id)
+
+        return agreed_tos_id == tos_id
+
+    def remember_agreement(self, request, response, user_id, tos_id):
+        '''Remember that the user agreed to the TOS in the session or a signed cookie'''
+        # The view logged the user out, or in as someone else
+        if request.session.get(session_key) != user_id:
+            return
+
+        if self.session_agreement and request.session.get('tos_agreed') != tos_id:
+            request.session['tos_agreed'] = tos_id
+
+        if self.agreement_cookie:
+            set_agreement_cookie(response, user_id, tos_id)
+
+    def check_agreement(self, request, user_id, tos_id, can_skip, user_agreed):
+        '''Return a redirect to the confirm page if the user needs to agree to the TOS'''
+        if self.local_cache is not None:
+            # Another TOS being activated is noticed once this entry expires
+            self.local_cache.set('django:tos:active_tos', tos_id)
+
+        # Skip if the user is allowed to skip - for instance, if the user is an
+        # admin or a staff member
+        if can_skip:
+            self.count('staff_skip')
+            if self.local_cache is not None:
+                self.local_cache.set(('skip', user_id), True)
+            return None
 
         if not user_agreed:
+            self.count('redirect')
             # Confirm view uses these session keys. Non-middleware flow sets them in login view,
             # so we need to set them here.
             request.session['tos_user'] = user_id
             request.session['tos_backend'] = request.session['_auth_user_backend']
 
             response = HttpResponseRedirect('{}?{}={}'.format(
-                tos_check_url,
+                self.check_url,
                 REDIRECT_FIELD_NAME,
                 request.path_info,
             ))
             add_never_cache_headers(response)
             return response
 
-        return self.get_response(request)
+        if self.local_cache is not None:
+            self.local_cache.set(('agreed', tos_id, user_id), True)
 
-    def should_fast_skip(self, request):
-        '''Check if we should skip TOS checks without hitting the cache or database'''
+        return None
+
+    @cached_property
+    def check_url(self):
+        # Comparing against tos_check_url itself would reverse it every time
+        return str(tos_check_url)
+
+    def should_skip_request(self, request):
+        '''Check if we should skip TOS checks based on the request alone'''
         # Don't get in the way of any mutating requests
         if request.method != 'GET':
             return True
@@ -75,7 +392,20 @@ class UserAgreementMiddleware:
             return True
 
         # Don't redirect users when they're trying to get to the confirm page
-        if request.path_info == tos_check_url:
+        if request.path_info == self.check_url:
+            return True
+
+        # Static files, health checks, APIs and so on
+        if self.exempt_prefixes and request.path_info.startswith(self.exempt_prefixes):
+            return True
+        if self.exempt_pattern is not None and self.exempt_pattern.match(request.path_info):
+            return True
+
+        return False
+
+    def should_fast_skip(self, request):
+        '''Check if we should skip TOS checks without hitting the cache or database'''
+        if self.should_skip_request(request):
             return True
 
         # If the user doesn't have a user ID, ignore them - they're anonymous
@@ -84,13 +414,57 @@ class UserAgreementMiddleware:
 
         return False
 
-    def get_and_cache_agreement_from_db(self, user_id, key_version):
-        # Grab the data from the database
-        user_agreed = UserAgreement.objects.filter(
-            user__id=user_id,
-            terms_of_service__active=True).exists()
+    async def ashould_fast_skip(self, request):
+        '''Async version of should_fast_skip'''
+        if self.should_skip_request(request):
+            return True
+
+        # Loading the session can hit the database, so don't block the event loop
+        if not await aget_session_value(request.session, session_key, None):
+            return True
+
+        return False
+
+    def get_and_cache_agreement_from_db(self, user_id, tos_id):
+        agreed_key = f'django:tos:agreed:{user_id}'
+
+        # Only let one request per user ask the database at a time, since
+        # everybody misses at once right after a rollover
+        with cache_miss_lock(agreed_key) as acquired:
+            if not acquired:
+                user_agreed = self.agreements.poll_agreed(tos_id, user_id)
+                if user_agreed is not None:
+                    return user_agreed
+
+            # Grab the data from the database
+            self.count('db_query')
+            start = time.perf_counter()
+            user_agreed = UserAgreement.objects.filter(
+                user__id=user_id,
+                terms_of_service__id=tos_id).exists()
+            self.record_timing('db_query', start)
+
+            # Remember it for next time
+            self.agreements.set_agreed(tos_id, user_id, user_agreed)
+
+        return user_agreed
+
+    async def aget_and_cache_agreement_from_db(self, user_id, tos_id):
+        agreed_key = f'django:tos:agreed:{user_id}'
+
+        async with acache_miss_lock(agreed_key) as acquired:
+            if not acquired:
+                user_agreed = await self.agreements.apoll_agreed(tos_id, user_id)
+                if user_agreed is not None:
+                    return user_agreed
+
+            self.count('db_query')
+            start = time.perf_counter()
+            user_agreed = await UserAgreement.objects.filter(
+                user__id=user_id,
+                terms_of_service__id=tos_id).aexists()
+            self.record_timing('db_query', start)
 
-        # Set the value in the cache
-        cache.set(f'django:tos:agreed:{user_id}', user_agreed, version=key_version)
+            await self.agreements.aset_agreed(tos_id, user_id, user_agreed)
 
         return user_agreed
@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-18 13:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def deduplicate_user_agreements(apps, schema_editor):
+    # Keep the oldest agreement of each user to each TOS. On large tables, run
+    # the deduplicate_user_agreements management command before migrating, so
+    # this has nothing left to do
+    UserAgreement = apps.get_model('tos', 'UserAgreement')
+
+    while True:
+        duplicates = list(
+            UserAgreement.objects
+            .values('user_id', 'terms_of_service_id')
+            .annotate(keep_id=models.Min('pk'), count=models.Count('pk'))
+            .filter(count__gt=1)
+            .order_by()[:1000]
+        )
+        if not duplicates:
+            return
+
+        for i in range(0, len(duplicates), 200):
+            rows = models.Q()
+            for duplicate in duplicates[i:i + 200]:
+                rows |= models.Q(
+                    user_id=duplicate['user_id'],
+                    terms_of_service_id=duplicate['terms_of_service_id'],
+                    pk__gt=duplicate['keep_id'],
+                )
+
+            UserAgreement.objects.filter(rows).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tos', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_user_agreements, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='useragreement',
+            constraint=models.UniqueConstraint(fields=('user', 'terms_of_service'), name='tos_useragreement_unique_user_tos'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 13:54
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tos', '0002_useragreement_unique_user_tos'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='useragreement',
+            index=models.Index(fields=['terms_of_service', 'created'], name='tos_useragreement_tos_created'),
+        ),
+        migrations.AddIndex(
+            model_name='useragreement',
+            index=models.Index(fields=['created'], name='tos_useragreement_created'),
+        ),
+    ]
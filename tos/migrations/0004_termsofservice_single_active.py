@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+def deactivate_extra_terms_of_service(apps, schema_editor):
+    # Keep the most recently created active terms of service, like
+    # get_latest_by does
+    TermsOfService = apps.get_model('tos', 'TermsOfService')
+
+    latest = TermsOfService.objects.filter(active=True).order_by('-created', '-pk').first()
+    if latest is not None:
+        TermsOfService.objects.filter(active=True).exclude(pk=latest.pk).update(active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tos', '0003_useragreement_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(deactivate_extra_terms_of_service, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='termsofservice',
+            constraint=models.UniqueConstraint(condition=models.Q(('active', True)), fields=('active',), name='tos_termsofservice_single_active'),
+        ),
+    ]
@@ -1,10 +1,27 @@
+import time
 import warnings
+from itertools import islice
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
 from django.utils.translation import gettext_lazy as _
 
+from .backends import get_agreement_backend
+from .utils import (
+    acache_current_tos,
+    aget_cached_current_tos,
+    cache_active_tos,
+    cache_current_tos,
+    cache_user_agreements,
+    get_cached_active_tos_id,
+    get_cached_current_tos,
+    get_tos_cache,
+)
+
+
+cache = get_tos_cache()
+
 
 class NoActiveTermsOfService(ValidationError):
     pass
@@ -20,8 +37,34 @@ class BaseModel(models.Model):
 
 class TermsOfServiceManager(models.Manager):
     def get_current_tos(self):
+        tos = get_cached_current_tos()
+        if tos is not None:
+            return tos
+
+        try:
+            tos = self.get(active=True)
+        except self.model.DoesNotExist:
+            if settings.DEBUG:
+                warnings.warn("There is no active Terms-of-Service")
+            else:
+                raise NoActiveTermsOfService(
+                    'Please create an active Terms-of-Service'
+                )
+        else:
+            cache_current_tos(tos)
+            cache_current_tos((tos.pk, tos.modified), 'django:tos:current_tos_version')
+            return tos
+
+    async def aget_current_tos(self):
+        """
+        Async version of get_current_tos
+        """
+        tos = await aget_cached_current_tos()
+        if tos is not None:
+            return tos
+
         try:
-            return self.get(active=True)
+            tos = await self.aget(active=True)
         except self.model.DoesNotExist:
             if settings.DEBUG:
                 warnings.warn("There is no active Terms-of-Service")
@@ -29,6 +72,37 @@ class TermsOfServiceManager(models.Manager):
                 raise NoActiveTermsOfService(
                     'Please create an active Terms-of-Service'
                 )
+        else:
+            await acache_current_tos(tos)
+            await acache_current_tos((tos.pk, tos.modified), 'django:tos:current_tos_version')
+            return tos
+
+    def get_current_tos_version(self):
+        """
+        Return the ``(pk, modified)`` of the active TOS without loading its
+        content, or None if there is no active TOS
+        """
+        version = get_cached_current_tos('django:tos:current_tos_version')
+        if version is not None:
+            return version
+
+        version = self.filter(active=True).values_list('pk', 'modified').first()
+        if version is not None:
+            cache_current_tos(version, 'django:tos:current_tos_version')
+        return version
+
+    async def aget_current_tos_version(self):
+        """
+        Async version of get_current_tos_version
+        """
+        version = await aget_cached_current_tos('django:tos:current_tos_version')
+        if version is not None:
+            return version
+
+        version = await self.filter(active=True).values_list('pk', 'modified').afirst()
+        if version is not None:
+            await acache_current_tos(version, 'django:tos:current_tos_version')
+        return version
 
 
 class TermsOfService(BaseModel):
@@ -47,17 +121,31 @@ class TermsOfService(BaseModel):
         ordering = ('-created',)
         verbose_name = _('Terms of Service')
         verbose_name_plural = _('Terms of Service')
+        constraints = [
+            # Not enforced on databases without partial indexes (MySQL), where
+            # _activate() serializes activations by locking the active row
+            models.UniqueConstraint(
+                fields=['active'],
+                condition=models.Q(active=True),
+                name='tos_termsofservice_single_active',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.created}: {"active" if self.active else "inactive"}'
 
+    # How many times to retry activating a TOS when another one is activated
+    # concurrently
+    ACTIVATION_ATTEMPTS = 5
+
     def save(self, *args, **kwargs):
         """ Ensure we're being saved properly """
 
         if self.active:
-            TermsOfService.objects.exclude(id=self.id).update(active=False)
+            self._activate(*args, **kwargs)
+            return
 
-        else:
+        with transaction.atomic():
             if not TermsOfService.objects\
                     .exclude(id=self.id)\
                     .filter(active=True)\
@@ -69,19 +157,165 @@ class TermsOfService(BaseModel):
                         'One of the terms of service must be marked active'
                     )
 
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
+
+    def _activate(self, *args, **kwargs):
+        """
+        Deactivate the currently active TOS and save this one as active
+
+        The tos_termsofservice_single_active constraint makes a concurrent
+        activation fail instead of leaving two active rows, in which case this
+        is retried and the last activation wins. Databases that can't enforce
+        the constraint lock the active row instead, so concurrent activations
+        wait for each other.
+        """
+        using = kwargs.get('using') or router.db_for_write(TermsOfService, instance=self)
+        lock_active = not connections[using].features.supports_partial_indexes
+
+        for attempt in range(self.ACTIVATION_ATTEMPTS):
+            try:
+                with transaction.atomic(using=using):
+                    if lock_active:
+                        list(
+                            TermsOfService.objects.using(using)
+                            .select_for_update()
+                            .filter(active=True)
+                            .values_list('pk', flat=True)
+                        )
+                    # Only the active row is updated, not the whole table
+                    TermsOfService.objects.using(using)\
+                        .filter(active=True)\
+                        .exclude(id=self.id)\
+                        .update(active=False)
+                    super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == self.ACTIVATION_ATTEMPTS - 1:
+                    raise
+            else:
+                return
+
+
+class UserAgreementQuerySet(models.QuerySet):
+    # How many removed agreements to write to the agreement backend at once
+    CACHE_CHUNK_SIZE = 1000
+
+    def delete(self):
+        """
+        Delete the agreements, and write the removal of the ones to the active
+        TOS through to the agreement backend
+        """
+        tos_id = get_cached_active_tos_id()
+        user_ids = []
+        if tos_id is not None:
+            user_ids = list(self.filter(terms_of_service_id=tos_id).values_list('user_id', flat=True))
+
+        deleted = super().delete()
+
+        for i in range(0, len(user_ids), self.CACHE_CHUNK_SIZE):
+            cache_user_agreements(tos_id, user_ids[i:i + self.CACHE_CHUNK_SIZE], False, active=True)
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
 
 class UserAgreement(BaseModel):
     terms_of_service = models.ForeignKey(TermsOfService, related_name='terms', on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='user_agreement', on_delete=models.CASCADE)
+    objects = UserAgreementQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # Also serves as the composite (user, terms_of_service) index for
+            # the agreement lookups
+            models.UniqueConstraint(
+                fields=['user', 'terms_of_service'],
+                name='tos_useragreement_unique_user_tos',
+            ),
+        ]
+        indexes = [
+            # For the admin's list filters
+            models.Index(fields=['terms_of_service', 'created'], name='tos_useragreement_tos_created'),
+            models.Index(fields=['created'], name='tos_useragreement_created'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} agreed to TOS: {self.terms_of_service}'
 
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        # Agreements are unique per user and TOS, so the user no longer
+        # agrees. Only agreements to the active TOS are cached.
+        if self.terms_of_service_id == get_cached_active_tos_id():
+            cache_user_agreements(self.terms_of_service_id, [self.user_id], False, active=True)
+        return deleted
+
 
 def has_user_agreed_latest_tos(user):
+    # Join the active TOS rather than looking it up first, so this is always
+    # a single query
     return UserAgreement.objects.filter(
-        terms_of_service=TermsOfService.objects.get_current_tos(),
+        terms_of_service__active=True,
         user=user,
     ).exists()
+
+
+async def ahas_user_agreed_latest_tos(user):
+    """
+    Async version of has_user_agreed_latest_tos
+    """
+    return await UserAgreement.objects.filter(
+        terms_of_service__active=True,
+        user=user,
+    ).aexists()
+
+
+def users_agreed_latest_tos(user_ids, chunk_size=1000):
+    """
+    Return the set of the given user IDs whose users have agreed to the
+    active TOS
+
+    For each chunk of ``chunk_size`` users, the stored agreements are read
+    from the agreement backend at once (one ``get_many`` with the default
+    backend), and only the users missing from it are looked up, with a
+    single ``IN`` query, and stored with one write. The IDs have to be of
+    the type of the user model's primary key.
+    """
+    active_tos = cache.get('django:tos:active_tos')
+    if active_tos is None:
+        active_tos = cache_active_tos()
+
+    tos_id, no_agreements_until = active_tos
+    if tos_id is None:
+        return set()
+
+    backend = get_agreement_backend()
+
+    # Right after a new TOS is activated nobody has agreed to it yet
+    rolling_over = no_agreements_until is not None and time.time() < no_agreements_until
+
+    agreed = set()
+    user_ids = iter(dict.fromkeys(user_ids))
+    while True:
+        chunk = list(islice(user_ids, chunk_size))
+        if not chunk:
+            return agreed
+
+        cached = backend.get_many_agreed(tos_id, chunk)
+
+        misses = []
+        for user_id in chunk:
+            user_agreed = cached.get(user_id)
+            if user_agreed is None and not rolling_over:
+                misses.append(user_id)
+            elif user_agreed:
+                agreed.add(user_id)
+
+        if misses:
+            found = set(
+                UserAgreement.objects
+                .filter(terms_of_service_id=tos_id, user_id__in=misses)
+                .values_list('user_id', flat=True)
+            )
+            backend.set_many_agreed(tos_id, {user_id: user_id in found for user_id in misses}, active=True)
+            agreed |= found
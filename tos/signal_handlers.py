@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.core.cache import caches
 
+from tos.utils import cache_user_agreements, get_cached_active_tos_id
 from tos.utils import invalidate_cached_agreements as invalidate_cached_agreements_func
 
 
@@ -8,4 +9,31 @@ def invalidate_cached_agreements(sender, **kwargs):
     if kwargs.get('raw', False):
         return
 
+    invalidate_cached_agreements_func(sender, **kwargs)
+
+
+def invalidate_cached_agreements_on_delete(sender, **kwargs):
+    # The deleted TOS can't be the active one anymore, so look it up again
     invalidate_cached_agreements_func(sender)
+
+
+def _is_active(agreement):
+    # Only use the TOS if it is already loaded, so saving an agreement
+    # doesn't cost another query
+    if type(agreement).terms_of_service.is_cached(agreement):
+        return agreement.terms_of_service.active
+    return None
+
+
+def cache_user_agreement(sender, instance, **kwargs):
+    if kwargs.get('raw', False):
+        return
+
+    cache_user_agreements(instance.terms_of_service_id, [instance.user_id], True, active=_is_active(instance))
+
+
+def cache_deleted_user(sender, instance, **kwargs):
+    # The user's agreements are deleted along with them, without signals
+    tos_id = get_cached_active_tos_id()
+    if tos_id is not None:
+        cache_user_agreements(tos_id, [instance.pk], False, active=True)
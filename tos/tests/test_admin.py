@@ -1,8 +1,11 @@
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.urls import reverse
 
+from tos.admin import EstimatedCountPaginator
 from tos.models import TermsOfService, UserAgreement, has_user_agreed_latest_tos
 
 
@@ -60,3 +63,102 @@ class TestAdmin(TestCase):
         # search for each one we have created
         for ua in self.uas:
             self.assertIsNotNone(find_ua(response.context['cl'].result_list, ua.user, ua.terms_of_service))
+
+    def test_useragreement_export_actions(self):
+        self.client.force_login(self.user1)
+
+        changelist_url = reverse('admin:tos_useragreement_changelist')
+        selected = [ua.pk for ua in UserAgreement.objects.filter(terms_of_service=self.tos2)]
+
+        response = self.client.post(changelist_url, {
+            'action': 'export_as_csv',
+            'select_across': 0,
+            '_selected_action': selected,
+        })
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,username,terms_of_service_id,created')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            [line.split(',')[2] for line in lines[1:]],
+            ['user1', 'user2'],
+        )
+
+        response = self.client.post(changelist_url, {
+            'action': 'export_as_jsonl',
+            'select_across': 1,
+            '_selected_action': selected,
+        })
+
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), len(self.uas))
+
+    def test_useragreement_changelist_queries(self):
+        self.client.force_login(self.user1)
+        changelist_url = reverse('admin:tos_useragreement_changelist')
+
+        # The session, the logged in user, the TOS list filter, the count, and
+        # the page of agreements with their users and TOS
+        with self.assertNumQueries(5):
+            response = self.client.get(changelist_url)
+        self.assertContains(response, 'user3')
+
+        UserAgreement.objects.bulk_create([
+            UserAgreement(terms_of_service=self.tos2, user=get_user_model().objects.create_user(f'extra{i}'))
+            for i in range(20)
+        ])
+
+        # Doesn't grow with the number of rows
+        with self.assertNumQueries(5):
+            response = self.client.get(changelist_url)
+        self.assertContains(response, 'extra19')
+
+        # Filtering doesn't count the whole table as well
+        with self.assertNumQueries(5):
+            response = self.client.get(changelist_url, {'terms_of_service__id__exact': self.tos1.pk})
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_useragreement_change_form_uses_raw_id_widget(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('admin:tos_useragreement_change', args=[self.uas[0].pk]))
+
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        self.assertNotContains(response, f'<option value="{self.user3.pk}"')
+
+
+class TestEstimatedCountPaginator(TestCase):
+    def setUp(self):
+        tos = TermsOfService.objects.create(content="terms", active=True)
+        users = [get_user_model().objects.create_user(f'user{i}') for i in range(3)]
+        UserAgreement.objects.bulk_create([
+            UserAgreement(terms_of_service=tos, user=user) for user in users
+        ])
+
+    def test_no_estimate(self):
+        # SQLite doesn't keep estimates, so the table is counted
+        paginator = EstimatedCountPaginator(UserAgreement.objects.order_by('pk'), 100)
+        self.assertEqual(paginator.count, 3)
+
+    @mock.patch('tos.admin.estimate_row_count', return_value=25000000)
+    def test_large_table(self, estimate_row_count):
+        paginator = EstimatedCountPaginator(UserAgreement.objects.order_by('pk'), 100)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 25000000)
+        self.assertEqual(paginator.num_pages, 250000)
+
+    @mock.patch('tos.admin.estimate_row_count', return_value=500)
+    def test_small_table(self, estimate_row_count):
+        paginator = EstimatedCountPaginator(UserAgreement.objects.order_by('pk'), 100)
+        self.assertEqual(paginator.count, 3)
+
+    @mock.patch('tos.admin.estimate_row_count', return_value=25000000)
+    def test_filtered(self, estimate_row_count):
+        paginator = EstimatedCountPaginator(UserAgreement.objects.filter(user__username='user1').order_by('pk'), 100)
+
+        self.assertEqual(paginator.count, 1)
+        estimate_row_count.assert_not_called()
@@ -0,0 +1,304 @@
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, modify_settings, override_settings
+from django.urls import reverse
+
+from tos.backends import (
+    CacheAgreementBackend,
+    LocMemAgreementBackend,
+    RedisAgreementBackend,
+    _load_backend,
+    get_agreement_backend,
+)
+from tos.middleware import UserAgreementMiddleware
+from tos.models import TermsOfService, UserAgreement, users_agreed_latest_tos
+from tos.signal_handlers import invalidate_cached_agreements
+from tos.utils import get_tos_cache, warm_agreement_cache
+
+from .utils import FakeRedis
+
+
+class AgreementBackendTests:
+    """Tests shared by the agreement backends"""
+    def make_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        super().setUp()
+        self.backend = self.make_backend()
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.backend.get_agreed(1, 10))
+
+        self.backend.set_agreed(1, 10, True)
+        self.backend.set_agreed(1, 11, False)
+
+        self.assertIs(self.backend.get_agreed(1, 10), True)
+        self.assertIs(self.backend.get_agreed(1, 11), False)
+        self.assertIsNone(self.backend.get_agreed(1, 12))
+
+        # Changing your mind
+        self.backend.set_agreed(1, 10, False)
+        self.assertIs(self.backend.get_agreed(1, 10), False)
+
+    def test_get_and_set_many(self):
+        self.backend.set_many_agreed(1, {10: True, 11: False, 12: True})
+
+        self.assertEqual(self.backend.get_many_agreed(1, [10, 11, 13]), {10: True, 11: False})
+
+    def test_string_and_int_ids(self):
+        # The middleware passes the ID from the session, the views the pk
+        self.backend.set_agreed(1, 10, True)
+        self.backend.set_many_agreed(1, {'11': False})
+
+        self.assertIs(self.backend.get_agreed(1, '10'), True)
+        self.assertIs(self.backend.get_agreed(1, 11), False)
+        self.assertEqual(self.backend.get_many_agreed(1, ['10', 11]), {'10': True, 11: False})
+
+    def test_per_tos(self):
+        self.backend.set_agreed(1, 10, True)
+
+        # Another TOS starts from nothing
+        self.assertIsNone(self.backend.get_agreed(2, 10))
+        self.assertEqual(self.backend.get_many_agreed(2, [10]), {})
+
+    async def test_async(self):
+        self.assertIsNone(await self.backend.aget_agreed(1, 10))
+
+        await self.backend.aset_agreed(1, 10, True)
+
+        self.assertIs(await self.backend.aget_agreed(1, 10), True)
+
+
+class TestLocMemAgreementBackend(AgreementBackendTests, SimpleTestCase):
+    def make_backend(self):
+        return LocMemAgreementBackend()
+
+    def test_old_tos_are_dropped(self):
+        self.backend.set_agreed(1, 10, True)
+        self.backend.set_agreed(2, 10, True)
+        self.backend.set_agreed(3, 10, True)
+
+        self.assertIsNone(self.backend.get_agreed(1, 10))
+        self.assertIs(self.backend.get_agreed(3, 10), True)
+
+    def test_clear(self):
+        self.backend.set_agreed(1, 10, True)
+        self.backend.clear(1)
+
+        self.assertIsNone(self.backend.get_agreed(1, 10))
+
+
+class TestRedisSetAgreementBackend(AgreementBackendTests, SimpleTestCase):
+    def make_backend(self):
+        self.client = FakeRedis()
+        return RedisAgreementBackend(client=self.client)
+
+    def test_single_round_trip(self):
+        self.backend.set_many_agreed(1, {10: True, 11: False})
+        self.backend.get_many_agreed(1, [10, 11, 12])
+        self.backend.get_agreed(1, 10)
+
+        self.assertEqual(self.client.round_trips, 3)
+
+    def test_structures(self):
+        self.backend.set_many_agreed(1, {10: True, 11: False})
+
+        self.assertEqual(self.client.data['django:tos:agreed_users:1'], {'10'})
+        self.assertEqual(self.client.data['django:tos:declined_users:1'], {'11'})
+
+    def test_clear(self):
+        self.backend.set_agreed(1, 10, True)
+        self.backend.clear(1)
+
+        self.assertEqual(self.client.data, {})
+
+    def test_needs_a_client(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RedisAgreementBackend()
+
+
+class TestRedisBitmapAgreementBackend(AgreementBackendTests, SimpleTestCase):
+    def make_backend(self):
+        self.client = FakeRedis()
+        return RedisAgreementBackend(client=self.client, bitmap=True, prefix='tos')
+
+    def test_structures(self):
+        self.backend.set_many_agreed(1, {0: True, 9: False})
+
+        # One bit per user ID
+        self.assertEqual(self.client.data['tos:agreed_bits:1'], bytearray([0b10000000, 0]))
+        self.assertEqual(self.client.data['tos:known_bits:1'], bytearray([0b10000000, 0b01000000]))
+
+    def test_negative_user_id(self):
+        with self.assertRaises(ValueError):
+            self.backend.set_agreed(1, -1, True)
+
+
+class TestGetAgreementBackend(SimpleTestCase):
+    def setUp(self):
+        _load_backend.cache_clear()
+        self.addCleanup(_load_backend.cache_clear)
+
+    def test_default(self):
+        self.assertIsInstance(get_agreement_backend(), CacheAgreementBackend)
+        self.assertIs(get_agreement_backend(), get_agreement_backend())
+
+    def test_options(self):
+        client = FakeRedis()
+        with override_settings(
+            TOS_AGREEMENT_BACKEND='tos.backends.RedisAgreementBackend',
+            TOS_AGREEMENT_BACKEND_OPTIONS={'client': client, 'bitmap': True},
+        ):
+            backend = get_agreement_backend()
+
+        self.assertIsInstance(backend, RedisAgreementBackend)
+        self.assertIs(backend.client, client)
+        self.assertTrue(backend.bitmap)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_AGREEMENT_BACKEND='tos.backends.RedisAgreementBackend')
+class TestMiddlewareWithRedisBackend(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.client_ = FakeRedis()
+        _load_backend.cache_clear()
+        self.addCleanup(_load_backend.cache_clear)
+        options = override_settings(TOS_AGREEMENT_BACKEND_OPTIONS={'client': self.client_, 'bitmap': True})
+        options.enable()
+        self.addCleanup(options.disable)
+        self.backend = get_agreement_backend()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_agreement_is_stored_in_the_backend(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+        # Nothing is cached per user
+        self.assertIsNone(self.cache.get(f'django:tos:agreed:{self.user1.pk}'))
+        self.assertIs(self.backend.get_agreed(self.tos1.pk, self.user1.pk), True)
+
+        # Only the session is loaded
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_agreed(self):
+        self.client.force_login(self.user2)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIs(self.backend.get_agreed(self.tos1.pk, self.user2.pk), False)
+
+        # Agreeing stores it once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        self.assertIs(self.backend.get_agreed(self.tos1.pk, self.user2.pk), True)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_rollover(self):
+        self.backend.set_agreed(self.tos1.pk, self.user1.pk, True)
+
+        tos2 = TermsOfService.objects.create(content="second edition", active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=tos2)
+
+        self.client.force_login(self.user1)
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_write_through(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user2)
+
+        self.assertIs(self.backend.get_agreed(self.tos1.pk, self.user2.pk), True)
+
+    def test_users_agreed_latest_tos(self):
+        user_ids = [self.user1.pk, self.user2.pk]
+
+        self.assertEqual(users_agreed_latest_tos(user_ids), {self.user1.pk})
+
+        self.assertEqual(
+            self.backend.get_many_agreed(self.tos1.pk, user_ids),
+            {self.user1.pk: True, self.user2.pk: False},
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(users_agreed_latest_tos(user_ids), {self.user1.pk})
+
+    def test_warm(self):
+        tos2 = TermsOfService.objects.create(content="second edition", active=False)
+
+        warm_agreement_cache(tos2, [self.user1.pk, self.user2.pk])
+
+        self.assertEqual(self.backend.get_many_agreed(tos2.pk, [self.user1.pk, self.user2.pk]), {
+            self.user1.pk: False,
+            self.user2.pk: False,
+        })
+
+    async def test_async(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        await self.backend.aset_agreed(self.tos1.pk, self.user1.pk, True)
+
+        middleware = UserAgreementMiddleware(get_response)
+        request = AsyncRequestFactory().get('/')
+        request.session = {SESSION_KEY: str(self.user1.pk), BACKEND_SESSION_KEY: 'backend'}
+
+        response = await middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_AGREEMENT_BACKEND='tos.backends.LocMemAgreementBackend')
+class TestMiddlewareWithLocMemBackend(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+        _load_backend.cache_clear()
+        self.addCleanup(_load_backend.cache_clear)
+        self.backend = get_agreement_backend()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_not_agreed(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 302)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        self.assertIs(self.backend.get_agreed(self.tos1.pk, self.user1.pk), True)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
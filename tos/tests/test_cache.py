@@ -1,24 +1,44 @@
+import time
 from io import StringIO
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import connection, models, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from tos.models import TermsOfService, UserAgreement, has_user_agreed_latest_tos
 from tos.utils import (
+    LocalCache,
     add_staff_users_to_tos_cache,
+    add_user_agreements,
+    cache_active_tos,
+    get_cached_user_state,
+    get_local_cache,
     get_tos_cache,
-    initialize_cache_version,
+    invalidate_cached_agreements,
+    _user_state_keys,
+    pack_user_ids,
     set_staff_in_cache_for_tos,
+    staff_ids_local_cache,
+    stamp,
+    unpack_user_ids,
+    unstamp,
 )
 
+from .utils import count_tos_cache_calls
+
 
 class CacheTestCase(TestCase):
     def setUp(self):
         self.cache = get_tos_cache()
         self.cache.clear()
+        staff_ids_local_cache.clear()
 
         User = get_user_model()
         User.objects.bulk_create([
@@ -32,11 +52,7 @@ class CacheTestCase(TestCase):
         ])
 
     def get_skip_tos_check(self, i: int):
-        return self.cache.get(
-            f"django:tos:skip_tos_check:{i}",
-            None,
-            version=self.cache.get('django:tos:key_version'),
-        )
+        return self.cache.get(f"django:tos:skip_tos_check:{i}", None)
 
     def call_command(self, cmd, *args, **kwargs):
         out = StringIO()
@@ -65,18 +81,180 @@ class CacheTestCase(TestCase):
         for i in range(3, 10, 2):
             self.assertIsNone(self.get_skip_tos_check(i))
 
-    def test_initialize_cache_version(self):
-        self.assertIsNone(self.cache.get('django:tos:key_version'))
+    def test_command_chunked(self):
+        with mock.patch('tos.utils.STAFF_CACHE_CHUNK_SIZE', 2), count_tos_cache_calls() as counting_cache:
+            self.call_command("add_staff_users_to_tos_cache")
+
+        # Users 1, 2, 4, 6 and 8 are staff or superusers
+        self.assertEqual(counting_cache.calls['set_many'], 3)
+        for i in [1, 2, 4, 6, 8]:
+            self.assertTrue(self.get_skip_tos_check(i))
+
+    @override_settings(TOS_STAFF_CACHE_COMPACT=True)
+    def test_compact_staff_cache(self):
+        tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        # Outside the rollover window, so agreements aren't known
+        self.cache.delete('django:tos:active_tos')
+
+        self.call_command("add_staff_users_to_tos_cache")
+
+        # A single key instead of one per staff user
+        self.assertIsNone(self.get_skip_tos_check(1))
+        self.assertEqual(len(self.cache.get('django:tos:staff_ids')), 5 * 8)
+
+        for i in range(1, 10):
+            # User IDs come from the session as strings
+            self.assertEqual(get_cached_user_state(str(i)), (tos1.pk, i in [1, 2, 4, 6, 8], None))
+
+        User = get_user_model()
+        user1 = User.objects.get(pk=1)
+        user1.is_staff = False
+        set_staff_in_cache_for_tos(instance=user1)
+        user3 = User.objects.get(pk=3)
+        user3.is_staff = True
+        set_staff_in_cache_for_tos(instance=user3)
+
+        self.assertEqual(get_cached_user_state('1')[1], False)
+        self.assertEqual(get_cached_user_state('3')[1], True)
+
+        # The set is rebuilt from the database if it isn't cached
+        self.cache.delete('django:tos:staff_ids')
+        set_staff_in_cache_for_tos(instance=user3)
+
+        self.assertEqual(get_cached_user_state('2')[1], True)
+
+    @override_settings(TOS_STAFF_CACHE_COMPACT=True)
+    def test_compact_staff_cache_kept_in_process(self):
+        TermsOfService.objects.create(content="first edition", active=True)
+        self.call_command("add_staff_users_to_tos_cache")
+        staff_ids_local_cache.clear()
+
+        # Fetched along with the rest of the user's state once
+        self.assertIn('django:tos:staff_ids', _user_state_keys('1'))
+        self.assertTrue(get_cached_user_state('1')[1])
+
+        # And then served from this process until it is stale
+        self.assertNotIn('django:tos:staff_ids', _user_state_keys('1'))
+        self.cache.delete('django:tos:staff_ids')
+        self.assertTrue(get_cached_user_state('1')[1])
+        self.assertFalse(get_cached_user_state('3')[1])
+        self.assertFalse(get_cached_user_state('not-an-int')[1])
+
+        staff_ids_local_cache.delete('fresh')
+        self.assertIn('django:tos:staff_ids', _user_state_keys('1'))
+
+    @override_settings(TOS_STAFF_CACHE_COMPACT=True)
+    def test_compact_staff_cache_needs_integer_pks(self):
+        user_model = mock.Mock()
+        user_model._meta.pk = models.UUIDField(primary_key=True)
+
+        with mock.patch('tos.utils.get_user_model', return_value=user_model):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'integer primary key, not a UUIDField'):
+                add_staff_users_to_tos_cache()
+            with self.assertRaises(ImproperlyConfigured):
+                set_staff_in_cache_for_tos(instance=get_user_model().objects.get(pk=1))
+
+    def test_packed_user_ids(self):
+        packed = pack_user_ids([3, 10, 2 ** 40])
+
+        self.assertEqual(unpack_user_ids(packed), {3, 10, 2 ** 40})
+        self.assertEqual(unpack_user_ids(pack_user_ids([])), set())
+
+    def test_invalidate_cached_agreements(self):
+        self.assertIsNone(self.cache.get('django:tos:active_tos'))
+
+        tos1 = TermsOfService.objects.create(content="first edition", active=True)
+
+        before = time.time()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(sender=TermsOfService, instance=tos1)
+        after = time.time()
+
+        # Nobody has agreed to the TOS yet
+        tos_id, no_agreements_until = self.cache.get('django:tos:active_tos')
+        self.assertEqual(tos_id, tos1.pk)
+        self.assertGreaterEqual(no_agreements_until, before + 300)
+        self.assertLessEqual(no_agreements_until, after + 300)
+
+        UserAgreement.objects.create(terms_of_service=tos1, user_id=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(sender=TermsOfService, instance=tos1)
+
+        self.assertEqual(self.cache.get('django:tos:active_tos'), (tos1.pk, None))
 
-        initialize_cache_version()
+        # Saving an inactive TOS looks up the active one
+        tos2 = TermsOfService.objects.create(content="second edition", active=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(sender=TermsOfService, instance=tos2)
 
-        self.assertIsNotNone(self.cache.get('django:tos:key_version', None))
-        self.assertEqual(self.cache.get('django:tos:key_version'), 1)
+        self.assertEqual(self.cache.get('django:tos:active_tos'), (tos1.pk, None))
 
-        initialize_cache_version()
+        with override_settings(TOS_ROLLOVER_WINDOW=0):
+            tos2.active = True
+            tos2.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                invalidate_cached_agreements(sender=TermsOfService, instance=tos2)
 
-        self.assertIsNotNone(self.cache.get('django:tos:key_version', None))
-        self.assertEqual(self.cache.get('django:tos:key_version'), 1)
+        self.assertEqual(self.cache.get('django:tos:active_tos'), (tos2.pk, None))
+
+    def test_invalidate_cached_agreements_rolled_back(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    tos1 = TermsOfService.objects.create(content="first edition", active=True)
+                    invalidate_cached_agreements(sender=TermsOfService, instance=tos1)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        self.assertIsNone(self.cache.get('django:tos:active_tos'))
+
+    def test_cache_active_tos(self):
+        self.assertEqual(cache_active_tos(), (None, None))
+
+        tos1 = TermsOfService.objects.create(content="first edition", active=True)
+
+        self.assertEqual(cache_active_tos(), (tos1.pk, None))
+        self.assertEqual(self.cache.get('django:tos:active_tos'), (tos1.pk, None))
+
+    def test_stamp(self):
+        self.assertEqual(unstamp(stamp(True, 3), 3), True)
+        self.assertEqual(unstamp(stamp(False, 3), 3), False)
+        self.assertIsNone(unstamp(stamp(True, 2), 3))
+        self.assertIsNone(unstamp(None, 3))
+        # Values cached before the values were stamped
+        self.assertIsNone(unstamp(True, 3))
+
+    def test_get_cached_user_state(self):
+        tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        UserAgreement.objects.create(terms_of_service=tos1, user_id=1)
+        self.cache.delete('django:tos:active_tos')
+
+        # The active TOS is looked up when it isn't cached
+        self.assertEqual(get_cached_user_state(1), (tos1.pk, False, None))
+
+        self.cache.set_many({
+            'django:tos:skip_tos_check:1': True,
+            'django:tos:agreed:1': stamp(False, tos1.pk),
+            'django:tos:agreed:2': stamp(True, tos1.pk - 1),
+        })
+
+        self.assertEqual(get_cached_user_state(1), (tos1.pk, True, False))
+        self.assertEqual(get_cached_user_state(2), (tos1.pk, False, None))
+
+    def test_get_cached_user_state_after_rollover(self):
+        tos1 = TermsOfService.objects.create(content="first edition", active=True)
+
+        self.cache.set('django:tos:active_tos', (tos1.pk, time.time() + 300))
+        self.cache.set('django:tos:agreed:2', stamp(True, tos1.pk))
+
+        # Within the rollover window users who haven't agreed are known
+        self.assertEqual(get_cached_user_state(1), (tos1.pk, False, False))
+        self.assertEqual(get_cached_user_state(2), (tos1.pk, False, True))
+
+        self.cache.set('django:tos:active_tos', (tos1.pk, time.time() - 1))
+
+        self.assertEqual(get_cached_user_state(1), (tos1.pk, False, None))
 
     def test_add_staff_users_to_tos_cache(self):
         self.assertIsNone(add_staff_users_to_tos_cache(raw=True))
@@ -106,6 +284,203 @@ class CacheTestCase(TestCase):
                 # Set it manually again, then run set again to ensure it
                 # removes the user from the skip cache when they are removed as
                 # a staff and superuser
-                self.cache.set(f"django:tos:skip_tos_check:{i}", True, version=self.cache.get("django:tos:key_version"))
+                self.cache.set(f"django:tos:skip_tos_check:{i}", True)
                 set_staff_in_cache_for_tos(instance=User.objects.get(id=i))
                 self.assertIsNone(self.get_skip_tos_check(i))
+
+
+class AgreementWriteThroughTestCase(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        User = get_user_model()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        self.tos2 = TermsOfService.objects.create(content="second edition", active=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def get_agreed(self, user):
+        return self.cache.get(f'django:tos:agreed:{user.pk}')
+
+    def test_created(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+
+        self.assertEqual(self.get_agreed(self.user1), stamp(True, self.tos1.pk))
+        self.assertIsNone(self.get_agreed(self.user2))
+
+    def test_created_without_loading_the_tos(self):
+        # The cached active TOS says whether to cache the agreement
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(1):
+            UserAgreement.objects.create(terms_of_service_id=self.tos1.pk, user_id=self.user1.pk)
+
+        self.assertEqual(self.get_agreed(self.user1), stamp(True, self.tos1.pk))
+
+    def test_created_for_inactive_tos(self):
+        # Warmed ahead of activating tos2
+        self.cache.set(f'django:tos:agreed:{self.user1.pk}', {self.tos1.pk: True, self.tos2.pk: False})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(terms_of_service=self.tos2, user=self.user1)
+
+        # The agreement to the active TOS is kept
+        self.assertEqual(self.get_agreed(self.user1), {self.tos1.pk: True, self.tos2.pk: True})
+
+    def test_not_cached_until_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+
+        self.assertIsNone(self.get_agreed(self.user1))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_raw(self):
+        # As loaded from a fixture
+        now = timezone.now()
+        agreement = UserAgreement(terms_of_service=self.tos1, user=self.user1, created=now, modified=now)
+        with self.captureOnCommitCallbacks(execute=True):
+            agreement.save_base(raw=True)
+
+        self.assertIsNone(self.get_agreed(self.user1))
+
+    def test_deleted(self):
+        agreement = UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        self.cache.set(f'django:tos:agreed:{self.user1.pk}', stamp(True, self.tos1.pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            agreement.delete()
+
+        self.assertEqual(self.get_agreed(self.user1), stamp(False, self.tos1.pk))
+
+    def test_deleted_for_inactive_tos(self):
+        agreement = UserAgreement.objects.create(terms_of_service=self.tos2, user=self.user1)
+        self.cache.set(f'django:tos:agreed:{self.user1.pk}', stamp(True, self.tos1.pk))
+
+        with count_tos_cache_calls() as counting_cache, self.captureOnCommitCallbacks(execute=True):
+            agreement.delete()
+
+        # Only the active TOS is looked up
+        self.assertEqual(dict(counting_cache.calls), {'get': 1})
+        self.assertEqual(self.get_agreed(self.user1), stamp(True, self.tos1.pk))
+
+    def test_user_deleted(self):
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        self.cache.set(f'django:tos:agreed:{self.user1.pk}', stamp(True, self.tos1.pk))
+        user_id = self.user1.pk
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user1.delete()
+
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{user_id}'), stamp(False, self.tos1.pk))
+
+    def test_tos_with_many_agreements_deleted(self):
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'many{i}') for i in range(2000)])
+        UserAgreement.objects.bulk_create([
+            UserAgreement(terms_of_service=self.tos2, user_id=user_id)
+            for user_id in User.objects.filter(username__startswith='many').values_list('pk', flat=True)
+        ])
+
+        # The agreements are deleted in one query, without being loaded, and
+        # their cached values are left alone as they are stamped with the
+        # TOS ID. The rest points the caches at the active TOS again.
+        tos_id = self.tos2.pk
+        with count_tos_cache_calls() as counting_cache, \
+                self.captureOnCommitCallbacks(execute=True), \
+                CaptureQueriesContext(connection) as ctx:
+            self.tos2.delete()
+
+        self.assertEqual(len(ctx.captured_queries), 4)
+        self.assertEqual(
+            ctx.captured_queries[0]['sql'],
+            f'DELETE FROM "tos_useragreement" WHERE "tos_useragreement"."terms_of_service_id" IN ({tos_id})',
+        )
+        self.assertEqual(dict(counting_cache.calls), {'delete_many': 2, 'set': 1})
+        self.assertFalse(UserAgreement.objects.filter(terms_of_service_id=tos_id).exists())
+
+    def test_bulk_deleted(self):
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.filter(terms_of_service=self.tos1).delete()
+
+        self.assertEqual(self.get_agreed(self.user1), stamp(False, self.tos1.pk))
+        self.assertEqual(self.get_agreed(self.user2), stamp(False, self.tos1.pk))
+
+    def test_bulk_created(self):
+        with count_tos_cache_calls() as counting_cache, self.captureOnCommitCallbacks(execute=True):
+            add_user_agreements(self.tos1, [self.user1.pk, self.user2.pk])
+
+        self.assertEqual(dict(counting_cache.calls), {'set_many': 1})
+        self.assertEqual(self.get_agreed(self.user1), stamp(True, self.tos1.pk))
+        self.assertEqual(self.get_agreed(self.user2), stamp(True, self.tos1.pk))
+
+    def test_bulk_created_for_inactive_tos(self):
+        self.cache.set(f'django:tos:agreed:{self.user1.pk}', stamp(True, self.tos1.pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            add_user_agreements(self.tos2, [self.user1.pk, self.user2.pk])
+
+        self.assertEqual(self.get_agreed(self.user1), {self.tos1.pk: True, self.tos2.pk: True})
+        self.assertEqual(self.get_agreed(self.user2), stamp(True, self.tos2.pk))
+
+
+class LocalCacheTestCase(SimpleTestCase):
+    def test_get_and_set(self):
+        local_cache = LocalCache(max_size=10, timeout=5)
+
+        self.assertIsNone(local_cache.get('missing'))
+        self.assertFalse(local_cache.get('missing', False))
+
+        local_cache.set('key', 'value')
+        self.assertEqual(local_cache.get('key'), 'value')
+
+        local_cache.delete('key')
+        self.assertIsNone(local_cache.get('key'))
+
+    def test_entries_expire(self):
+        local_cache = LocalCache(max_size=10, timeout=5)
+
+        with mock.patch('tos.utils.time.monotonic', return_value=100):
+            local_cache.set('key', 'value')
+
+        with mock.patch('tos.utils.time.monotonic', return_value=104):
+            self.assertEqual(local_cache.get('key'), 'value')
+
+        with mock.patch('tos.utils.time.monotonic', return_value=105):
+            self.assertIsNone(local_cache.get('key'))
+
+        self.assertEqual(len(local_cache), 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        local_cache = LocalCache(max_size=2, timeout=5)
+
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+
+        # Touch 'a' so 'b' is the least recently used entry
+        self.assertEqual(local_cache.get('a'), 1)
+
+        local_cache.set('c', 3)
+
+        self.assertEqual(len(local_cache), 2)
+        self.assertEqual(local_cache.get('a'), 1)
+        self.assertIsNone(local_cache.get('b'))
+        self.assertEqual(local_cache.get('c'), 3)
+
+        local_cache.clear()
+        self.assertEqual(len(local_cache), 0)
+
+    def test_get_local_cache(self):
+        self.assertIsNone(get_local_cache())
+
+        with override_settings(TOS_LOCAL_CACHE_SIZE=10, TOS_LOCAL_CACHE_TIMEOUT=2):
+            local_cache = get_local_cache()
+
+        self.assertEqual(local_cache.max_size, 10)
+        self.assertEqual(local_cache.timeout, 2)
@@ -0,0 +1,212 @@
+import csv
+import datetime
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from tos.models import TermsOfService, UserAgreement
+from tos.utils import get_cached_user_state, get_tos_cache, stamp
+
+
+class CommandTestCase(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        User = get_user_model()
+        User.objects.bulk_create([
+            User(username=f"user{i}", email=f"user{i}@example.com")
+            for i in range(1, 8)
+        ])
+        self.users = list(User.objects.order_by('pk'))
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True  # Will be marked as inactive as soon as tos2 is saved
+        )
+        self.tos2 = TermsOfService.objects.create(
+            content="second edition of the terms of service",
+            active=True
+        )
+        self.tos1.refresh_from_db()
+
+    def call_command(self, cmd, *args, **kwargs):
+        out = StringIO()
+        call_command(cmd, *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def agreed_user_ids(self, tos):
+        return sorted(UserAgreement.objects.filter(terms_of_service=tos).values_list('user_id', flat=True))
+
+
+class TestBackfillUserAgreements(CommandTestCase):
+    def test_all_users(self):
+        # Already agreed, so it's skipped
+        UserAgreement.objects.create(terms_of_service=self.tos2, user=self.users[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            out = self.call_command('backfill_user_agreements', batch_size=3)
+
+        self.assertIn(f"Successfully recorded agreements to terms of service {self.tos2.pk} for 7 users", out)
+        self.assertIn("3 users (", out)
+        self.assertIn("6 users (", out)
+        self.assertEqual(self.agreed_user_ids(self.tos2), [user.pk for user in self.users])
+
+        # The agreements are written through to the cache
+        for user in self.users:
+            self.assertEqual(self.cache.get(f'django:tos:agreed:{user.pk}'), stamp(True, self.tos2.pk))
+
+    def test_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            # Unknown users are ignored
+            f.write(f"{self.users[1].pk}\n\n{self.users[3].pk}\n999999\n")
+        self.addCleanup(os.unlink, f.name)
+
+        out = self.call_command('backfill_user_agreements', file=f.name, tos=self.tos1.pk)
+
+        self.assertIn(f"Successfully recorded agreements to terms of service {self.tos1.pk} for 2 users", out)
+        self.assertEqual(self.agreed_user_ids(self.tos1), [self.users[1].pk, self.users[3].pk])
+        self.assertEqual(self.agreed_user_ids(self.tos2), [])
+
+        # Agreements to an inactive TOS aren't cached
+        self.assertIsNone(self.cache.get(f'django:tos:agreed:{self.users[1].pk}'))
+
+    def test_stdin(self):
+        with mock.patch('sys.stdin', StringIO(f"{self.users[2].pk}\n")):
+            self.call_command('backfill_user_agreements', file='-')
+
+        self.assertEqual(self.agreed_user_ids(self.tos2), [self.users[2].pk])
+
+    def test_unknown_tos(self):
+        with self.assertRaises(CommandError):
+            self.call_command('backfill_user_agreements', tos=999999)
+
+
+class TestExportUserAgreements(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        UserAgreement.objects.bulk_create(
+            [UserAgreement(terms_of_service=self.tos1, user=user) for user in self.users] +
+            [UserAgreement(terms_of_service=self.tos2, user=user) for user in self.users[:2]]
+        )
+        # Backdate the agreements to the first edition
+        UserAgreement.objects.filter(terms_of_service=self.tos1).update(
+            created=timezone.now() - datetime.timedelta(days=30),
+        )
+
+    def test_csv(self):
+        out = self.call_command('export_user_agreements', chunk_size=2)
+
+        rows = list(csv.DictReader(StringIO(out)))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[0]['username'], self.users[0].username)
+        self.assertEqual(rows[0]['user_id'], str(self.users[0].pk))
+        self.assertEqual(rows[0]['terms_of_service_id'], str(self.tos1.pk))
+
+    def test_jsonl_filtered_by_tos(self):
+        out = self.call_command('export_user_agreements', format='jsonl', tos=[self.tos2.pk])
+
+        records = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(
+            [record['username'] for record in records],
+            [user.username for user in self.users[:2]],
+        )
+        self.assertEqual({record['terms_of_service_id'] for record in records}, {self.tos2.pk})
+
+    def test_date_range(self):
+        since = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        out = self.call_command('export_user_agreements', format='jsonl', since=since)
+        self.assertEqual(len(out.splitlines()), 2)
+
+        out = self.call_command('export_user_agreements', format='jsonl', until=since)
+        self.assertEqual(len(out.splitlines()), 7)
+
+        with self.assertRaises(CommandError):
+            self.call_command('export_user_agreements', since='yesterday')
+
+    def test_output_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as f:
+            pass
+        self.addCleanup(os.unlink, f.name)
+
+        self.call_command('export_user_agreements', output=f.name)
+
+        with open(f.name, newline='') as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 9)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.call_command('export_user_agreements', chunk_size=100)
+
+
+def first_two_users(since):
+    return get_user_model().objects.order_by('pk').values_list('pk', flat=True)[:2]
+
+
+class TestWarmAgreementCache(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tos3 = TermsOfService.objects.create(content="third edition of the terms of service")
+
+        # Agreed to the next TOS ahead of time
+        UserAgreement.objects.create(terms_of_service=self.tos3, user=self.users[0])
+        # Agreed to the active TOS
+        self.cache.set(f'django:tos:agreed:{self.users[1].pk}', stamp(True, self.tos2.pk))
+
+        now = timezone.now()
+        get_user_model().objects.filter(pk__in=[user.pk for user in self.users[:3]]).update(last_login=now)
+        get_user_model().objects.filter(pk=self.users[3].pk).update(last_login=now - datetime.timedelta(days=3))
+
+    def agreement(self, user):
+        return self.cache.get(f'django:tos:agreed:{user.pk}')
+
+    def test_recently_active_users(self):
+        out = self.call_command('warm_agreement_cache', tos=self.tos3.pk, chunk_size=2)
+
+        self.assertIn(f"Successfully cached agreements to terms of service {self.tos3.pk} for 3 users", out)
+        self.assertEqual(self.agreement(self.users[0]), {self.tos3.pk: True})
+        # The agreement to the active TOS is kept
+        self.assertEqual(self.agreement(self.users[1]), {self.tos3.pk: False, self.tos2.pk: True})
+        self.assertEqual(self.agreement(self.users[2]), {self.tos3.pk: False})
+        # Not active recently
+        self.assertIsNone(self.agreement(self.users[3]))
+
+        # Once the TOS is activated, the warmed agreements are used
+        self.tos3.active = True
+        self.tos3.save()
+        self.cache.set('django:tos:active_tos', (self.tos3.pk, None))
+
+        self.assertEqual(get_cached_user_state(self.users[0].pk), (self.tos3.pk, False, True))
+        self.assertEqual(get_cached_user_state(self.users[1].pk), (self.tos3.pk, False, False))
+
+    def test_queries_per_chunk(self):
+        self.call_command('warm_agreement_cache', tos=self.tos3.pk, hours=100, chunk_size=2)
+
+        # The TOS, the users and one query for each chunk of two of the four
+        # users. The active TOS was cached by the first run.
+        with self.assertNumQueries(4):
+            self.call_command('warm_agreement_cache', tos=self.tos3.pk, hours=100, chunk_size=2)
+
+    @override_settings(TOS_WARM_CACHE_USERS='tos.tests.test_commands.first_two_users')
+    def test_hook(self):
+        out = self.call_command('warm_agreement_cache')
+
+        self.assertIn(f"Successfully cached agreements to terms of service {self.tos2.pk} for 2 users", out)
+        self.assertEqual(self.agreement(self.users[0]), {self.tos2.pk: False})
+        # The cache is corrected from the database
+        self.assertEqual(self.agreement(self.users[1]), {self.tos2.pk: False})
+        self.assertIsNone(self.agreement(self.users[2]))
+
+    def test_stdin(self):
+        with mock.patch('sys.stdin', StringIO(f"{self.users[5].pk}\n")):
+            self.call_command('warm_agreement_cache', tos=self.tos3.pk, file='-')
+
+        self.assertEqual(self.agreement(self.users[5]), {self.tos3.pk: False})
+        self.assertIsNone(self.agreement(self.users[0]))
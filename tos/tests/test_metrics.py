@@ -0,0 +1,165 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import modify_settings
+from django.urls import reverse
+
+from tos.metrics import (
+    InMemoryMetrics,
+    LoggingMetrics,
+    SignalMetrics,
+    get_metrics,
+    metric_recorded,
+)
+from tos.models import TermsOfService, UserAgreement
+from tos.utils import get_tos_cache, invalidate_cached_agreements
+
+
+class TestMetricsBackends(SimpleTestCase):
+    def test_in_memory(self):
+        metrics = InMemoryMetrics()
+
+        metrics.increment('cache_hit')
+        metrics.increment('cache_hit', 2)
+        metrics.timing('check', 0.0002)
+        metrics.timing('check', 0.003)
+        metrics.timing('check', 5)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'cache_hit': 3})
+
+        check = snapshot['timings']['check']
+        self.assertEqual(check['count'], 3)
+        self.assertAlmostEqual(check['sum'], 5.0032)
+        self.assertEqual(check['buckets']['0.0001'], 0)
+        self.assertEqual(check['buckets']['0.00025'], 1)
+        self.assertEqual(check['buckets']['0.005'], 2)
+        self.assertEqual(check['buckets']['1'], 2)
+        self.assertEqual(check['buckets']['+Inf'], 3)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'timings': {}})
+
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((kwargs['kind'], kwargs['name'], kwargs['value']))
+
+        metric_recorded.connect(receiver)
+        self.addCleanup(metric_recorded.disconnect, receiver)
+
+        metrics = SignalMetrics()
+        metrics.increment('redirect')
+        metrics.timing('db_query', 0.01)
+
+        self.assertEqual(received, [('counter', 'redirect', 1), ('timing', 'db_query', 0.01)])
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_logging(self):
+        metrics = LoggingMetrics()
+
+        with mock.patch.object(LoggingMetrics.logger, 'debug') as debug:
+            metrics.increment('redirect')
+            metrics.timing('db_query', 0.01)
+
+        debug.assert_has_calls([
+            mock.call("%s +%s", 'redirect', 1),
+            mock.call("%s %.6fs", 'db_query', 0.01),
+        ])
+
+    def test_get_metrics(self):
+        # Disabled by default
+        self.assertIsNone(get_metrics())
+
+        with override_settings(TOS_METRICS_BACKEND='tos.metrics.InMemoryMetrics'):
+            self.assertIsInstance(get_metrics(), InMemoryMetrics)
+            # The same instance for the whole process
+            self.assertIs(get_metrics(), get_metrics())
+
+        with override_settings(TOS_METRICS_BACKEND='tos.metrics.SignalMetrics'):
+            self.assertIsInstance(get_metrics(), SignalMetrics)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_METRICS_BACKEND='tos.metrics.InMemoryMetrics')
+class TestMiddlewareMetrics(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+        self.metrics = get_metrics()
+        self.metrics.reset()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+        self.staff = get_user_model().objects.create_user('staff', 'staff@example.com', 'staffpass', is_staff=True)
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+        get_tos_cache().set(f'django:tos:skip_tos_check:{self.staff.pk}', True)
+
+    def test_counters(self):
+        # Anonymous
+        self.client.get(reverse('index'))
+
+        self.client.force_login(self.user1)
+        self.client.get(reverse('index'))
+        self.client.get(reverse('index'))
+
+        self.client.force_login(self.user2)
+        self.client.get(reverse('index'))
+
+        self.client.force_login(self.staff)
+        self.client.get(reverse('index'))
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'fast_skip': 1,
+            'cache_miss': 2,
+            'db_query': 2,
+            'cache_hit': 1,
+            'redirect': 1,
+            'staff_skip': 1,
+        })
+        # Fast skips aren't timed
+        self.assertEqual(snapshot['timings']['check']['count'], 4)
+        self.assertEqual(snapshot['timings']['db_query']['count'], 2)
+
+    @override_settings(TOS_METRICS_BACKEND=None)
+    def test_disabled(self):
+        self.client.force_login(self.user1)
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.metrics.snapshot(), {'counters': {}, 'timings': {}})
+
+    def test_metrics_view(self):
+        self.metrics.increment('redirect')
+
+        self.client.force_login(self.user1)
+        response = self.client.get(reverse('tos_metrics'))
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('tos_metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['backend'], 'tos.metrics.InMemoryMetrics')
+        self.assertEqual(response.json()['metrics']['counters']['redirect'], 1)
+
+    @override_settings(TOS_METRICS_BACKEND=None)
+    def test_metrics_view_disabled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('tos_metrics'))
+
+        self.assertEqual(response.json(), {'backend': None, 'metrics': {}})
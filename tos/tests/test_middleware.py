@@ -1,15 +1,28 @@
+import asyncio
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.conf import settings
-from django.contrib.auth import REDIRECT_FIELD_NAME, get_user_model
+from django.contrib.auth import BACKEND_SESSION_KEY, REDIRECT_FIELD_NAME, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
 from django.core.cache import caches
-from django.db.models.signals import pre_save
-from django.test import TestCase
-from django.test.utils import modify_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, modify_settings, override_settings
 from django.urls import reverse
 
-from tos.middleware import UserAgreementMiddleware
+from tos.middleware import UserAgreementMiddleware, compile_exempt_paths
 from tos.models import TermsOfService, UserAgreement
 from tos.signal_handlers import invalidate_cached_agreements
-from tos.utils import get_tos_cache
+from tos.utils import get_tos_cache, stamp
+
+from .utils import count_tos_cache_calls
 
 
 @modify_settings(
@@ -41,10 +54,11 @@ class TestMiddleware(TestCase):
         )
         self.login_url = getattr(settings, 'LOGIN_URL', '/login/')
 
-        UserAgreement.objects.create(
-            terms_of_service=self.tos1,
-            user=self.user1
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(
+                terms_of_service=self.tos1,
+                user=self.user1
+            )
 
         self.redirect_page = '{}?{}={}'.format(
             reverse('tos_check_tos'),
@@ -62,7 +76,8 @@ class TestMiddleware(TestCase):
         self.assertRedirects(response, self.redirect_page)
 
         # Make sure confirm works after middleware redirect.
-        response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
 
         # Confirm redirects.
         self.assertEqual(response.status_code, 302)
@@ -78,7 +93,8 @@ class TestMiddleware(TestCase):
         self.assertRedirects(response, self.redirect_page)
 
         # Make sure confirm works after middleware redirect.
-        response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
 
         self.assertTrue(UserAgreement.objects.filter(terms_of_service=self.tos1, user=self.user2).exists())
 
@@ -119,6 +135,9 @@ class TestMiddleware(TestCase):
 )
 class BumpCoverage(TestCase):
     def setUp(self):
+        # Clear cache between tests
+        get_tos_cache().clear()
+
         # User that has agreed to TOS
         self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
         # User that has not aggreed to TOS
@@ -134,10 +153,11 @@ class BumpCoverage(TestCase):
         )
         self.login_url = getattr(settings, 'LOGIN_URL', '/login/')
 
-        UserAgreement.objects.create(
-            terms_of_service=self.tos1,
-            user=self.user1
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(
+                terms_of_service=self.tos1,
+                user=self.user1
+            )
 
     def test_ajax_request(self):
         self.client.force_login(self.user2)
@@ -148,9 +168,7 @@ class BumpCoverage(TestCase):
     def test_skip_for_user(self):
         cache = get_tos_cache()
 
-        key_version = cache.get('django:tos:key_version')
-
-        cache.set(f'django:tos:skip_tos_check:{self.user1.id}', True, version=key_version)
+        cache.set(f'django:tos:skip_tos_check:{self.user1.id}', True)
 
         self.client.login(username='user1', password='user1pass')
         response = self.client.get(reverse('index'))
@@ -160,9 +178,7 @@ class BumpCoverage(TestCase):
     def test_use_cache(self):
         cache = caches[getattr(settings, 'TOS_CACHE_NAME', 'default')]
 
-        key_version = cache.get('django:tos:key_version')
-
-        cache.set(f'django:tos:agreed:{self.user2.id}', True, version=key_version)
+        cache.set(f'django:tos:agreed:{self.user2.id}', stamp(True, self.tos1.pk))
 
         self.client.force_login(self.user2)
 
@@ -177,33 +193,619 @@ class BumpCoverage(TestCase):
         # just redirect to the agree page
         self.assertEqual(response.request['PATH_INFO'], '/')
 
-    def test_invalidate_cached_agreements(self):
+    def test_single_cache_round_trip(self):
         cache = get_tos_cache()
 
-        invalidate_cached_agreements(TermsOfService)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+        cache.set(f'django:tos:agreed:{self.user1.id}', stamp(True, self.tos1.pk))
+
+        self.client.force_login(self.user1)
+
+        with count_tos_cache_calls() as counting_cache:
+            response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(counting_cache.calls), {'get_many': 1})
+
+    def test_stale_agreement_is_ignored(self):
+        cache = get_tos_cache()
+        # Outside the rollover window, now that user1 has agreed
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+        # Cached for another TOS, so the database has the final say
+        cache.set(f'django:tos:agreed:{self.user2.id}', stamp(True, self.tos2.pk))
+
+        self.client.force_login(self.user2)
+
+        response = self.client.get(reverse('index'))
 
-        key_version = cache.get('django:tos:key_version')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(cache.get(f'django:tos:agreed:{self.user2.id}'), stamp(False, self.tos1.pk))
 
-        invalidate_cached_agreements(TermsOfService)
+    def test_invalidate_cached_agreements(self):
+        cache = get_tos_cache()
 
-        self.assertEqual(cache.get('django:tos:key_version'), key_version+1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+        self.assertEqual(cache.get('django:tos:active_tos'), (self.tos1.pk, None))
+
+        TermsOfService.objects.filter(pk=self.tos1.pk).update(active=False)
+        TermsOfService.objects.filter(pk=self.tos2.pk).update(active=True)
 
         invalidate_cached_agreements(TermsOfService, raw=True)
 
-        self.assertEqual(cache.get('django:tos:key_version'), key_version+1)
+        self.assertEqual(cache.get('django:tos:active_tos'), (self.tos1.pk, None))
+
+        with override_settings(TOS_ROLLOVER_WINDOW=0), self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+        self.assertEqual(cache.get('django:tos:active_tos'), (self.tos2.pk, None))
 
     def test_invalidate_cached_agreements_signal(self):
         cache = caches[getattr(settings, 'TOS_CACHE_NAME', 'default')]
 
-        pre_save.connect(
-            invalidate_cached_agreements,
-            sender=TermsOfService,
-            dispatch_uid='invalidate_cached_agreements',
+        cache.set(f'django:tos:skip_tos_check:{self.user1.id}', True)
+
+        self.tos2.active = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tos2.save()
+
+        tos_id, no_agreements_until = cache.get('django:tos:active_tos')
+        self.assertEqual(tos_id, self.tos2.pk)
+        self.assertIsNotNone(no_agreements_until)
+
+        # Staff don't need to be cached again
+        self.assertTrue(cache.get(f'django:tos:skip_tos_check:{self.user1.id}'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tos2.delete()
+
+        self.assertEqual(cache.get('django:tos:active_tos'), (None, None))
+
+    def test_rollover_doesnt_query_agreements(self):
+        cache = get_tos_cache()
+        cache.set(f'django:tos:agreed:{self.user1.id}', stamp(True, self.tos1.pk))
+
+        self.tos2.active = True
+        self.tos2.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=self.tos2)
+
+        self.client.force_login(self.user1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse([query for query in queries if 'tos_useragreement' in query['sql']])
+
+        # Agreeing is cached for the new TOS once it commits
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        self.assertEqual(cache.get(f'django:tos:agreed:{self.user1.id}'), stamp(True, self.tos2.pk))
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_LOCAL_CACHE_SIZE=100, TOS_LOCAL_CACHE_TIMEOUT=60)
+class TestLocalCache(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
         )
+        self.tos2 = TermsOfService.objects.create(
+            content="second edition of the terms of service",
+            active=False
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_agreement_served_from_local_cache(self):
+        self.cache.set(f'django:tos:agreed:{self.user1.id}', stamp(True, self.tos1.pk))
+
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+        # The shared cache no longer knows about the user, but this process
+        # still does
+        self.cache.delete(f'django:tos:agreed:{self.user1.id}')
+
+        with self.assertNumQueries(1):  # Only the session lookup
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
 
-        key_version = cache.get('django:tos:key_version')
+    def test_skip_served_from_local_cache(self):
+        self.cache.set(f'django:tos:skip_tos_check:{self.user1.id}', True)
+
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+        self.cache.delete(f'django:tos:skip_tos_check:{self.user1.id}')
+
+        with self.assertNumQueries(1):  # Only the session lookup
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(TOS_LOCAL_CACHE_TIMEOUT=0)
+    def test_rollover_noticed_after_timeout(self):
+        self.cache.set(f'django:tos:agreed:{self.user1.id}', stamp(True, self.tos1.pk))
+
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
 
         self.tos2.active = True
         self.tos2.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=self.tos2)
+
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 302)
+
+
+async def async_get_response(request):
+    return HttpResponse('index')
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+class TestAsyncMiddleware(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        # User that has agreed to TOS
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        # User that has not agreed to TOS
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(
+                terms_of_service=self.tos1,
+                user=self.user1
+            )
+
+        self.middleware = UserAgreementMiddleware(async_get_response)
+
+    def make_request(self, user):
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session.save()
+
+        request = AsyncRequestFactory().get(reverse('index'))
+        # A fresh store, so the middleware has to load the session itself
+        request.session = SessionStore(session.session_key)
+        return request
+
+    def test_async_capable(self):
+        self.assertTrue(UserAgreementMiddleware.sync_capable)
+        self.assertTrue(UserAgreementMiddleware.async_capable)
+        self.assertTrue(iscoroutinefunction(self.middleware))
+        self.assertFalse(iscoroutinefunction(UserAgreementMiddleware(lambda request: None)))
+
+    async def test_agreed_user(self):
+        request = await sync_to_async(self.make_request)(self.user1)
+
+        response = await self.middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            await self.cache.aget(f'django:tos:agreed:{self.user1.pk}'),
+            stamp(True, self.tos1.pk),
+        )
+
+    async def test_not_agreed_user(self):
+        request = await sync_to_async(self.make_request)(self.user2)
+
+        response = await self.middleware(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, f"{reverse('tos_check_tos')}?{REDIRECT_FIELD_NAME}={reverse('index')}")
+        self.assertEqual(request.session['tos_user'], str(self.user2.pk))
+
+    async def test_cached_agreement(self):
+        await self.cache.aset('django:tos:active_tos', (self.tos1.pk, None))
+        await self.cache.aset(f'django:tos:agreed:{self.user2.pk}', stamp(True, self.tos1.pk))
+        request = await sync_to_async(self.make_request)(self.user2)
+
+        with count_tos_cache_calls() as counting_cache:
+            response = await self.middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(counting_cache.calls), {'aget_many': 1})
+
+    @override_settings(TOS_AGREEMENT_COOKIE=True)
+    async def test_agreement_cookie(self):
+        await self.cache.aset('django:tos:active_tos', (self.tos1.pk, None))
+        middleware = UserAgreementMiddleware(async_get_response)
+        request = await sync_to_async(self.make_request)(self.user1)
+
+        response = await middleware(request)
+        request.COOKIES['tos_agreed'] = response.cookies['tos_agreed'].value
+
+        with count_tos_cache_calls() as counting_cache:
+            response = await middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(counting_cache.calls), {'aget': 1})
+
+    async def test_anonymous_user(self):
+        request = AsyncRequestFactory().get(reverse('index'))
+        request.session = SessionStore()
+
+        response = await self.middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_client(self):
+        await sync_to_async(self.async_client.force_login)(self.user2)
 
-        self.assertEqual(cache.get('django:tos:key_version'), key_version+1)
+        response = await self.async_client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+
+class SlowAgreementQuery:
+    """
+    Stands in for UserAgreement.objects, counting the queries made and taking
+    a while to answer them
+    """
+    def __init__(self, user_agreed=True, delay=0.2):
+        self.user_agreed = user_agreed
+        self.delay = delay
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def filter(self, **kwargs):
+        return self
+
+    def exists(self):
+        with self.lock:
+            self.queries += 1
+        time.sleep(self.delay)
+        return self.user_agreed
+
+    async def aexists(self):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+        return self.user_agreed
+
+
+@override_settings(TOS_CACHE_MISS_LOCK_TIMEOUT=5, TOS_CACHE_MISS_WAIT=2)
+class TestCacheMissLock(SimpleTestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+        self.query = SlowAgreementQuery()
+
+        patcher = mock.patch('tos.middleware.UserAgreement.objects', self.query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_concurrently(self, count=8):
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [
+                executor.submit(self.middleware.get_and_cache_agreement_from_db, 1, 2)
+                for _ in range(count)
+            ]
+            return [future.result() for future in futures]
+
+    def test_concurrent_misses_query_once(self):
+        self.assertEqual(self.run_concurrently(), [True] * 8)
+
+        self.assertEqual(self.query.queries, 1)
+        self.assertEqual(self.cache.get('django:tos:agreed:1'), stamp(True, 2))
+        # The lease is released
+        self.assertIsNone(self.cache.get('django:tos:agreed:1:lock'))
+
+    @override_settings(TOS_CACHE_MISS_LOCK_TIMEOUT=0)
+    def test_disabled(self):
+        self.assertEqual(self.run_concurrently(), [True] * 8)
+
+        self.assertEqual(self.query.queries, 8)
+
+    @override_settings(TOS_CACHE_MISS_WAIT=0.05)
+    def test_falls_back_to_database_when_the_lease_holder_is_slow(self):
+        # Another request holds the lease, but never caches anything
+        self.cache.add('django:tos:agreed:1:lock', True, 5)
+
+        self.assertTrue(self.middleware.get_and_cache_agreement_from_db(1, 2))
+
+        self.assertEqual(self.query.queries, 1)
+        # The lease isn't ours to release
+        self.assertTrue(self.cache.get('django:tos:agreed:1:lock'))
+
+    @override_settings(TOS_CACHE_MISS_SERVE_STALE=True)
+    def test_serve_stale(self):
+        self.cache.add('django:tos:agreed:1:lock', True, 5)
+        self.cache.set('django:tos:agreed:1', stamp(True, 1))
+        self.query.user_agreed = False
+
+        with override_settings(TOS_CACHE_MISS_SERVE_STALE=False, TOS_CACHE_MISS_WAIT=0):
+            self.assertFalse(self.middleware.get_and_cache_agreement_from_db(1, 2))
+        self.assertEqual(self.query.queries, 1)
+
+        self.cache.set('django:tos:agreed:1', stamp(True, 1))
+
+        # The agreement to the previous TOS is good enough while the lease
+        # holder asks the database
+        self.assertTrue(self.middleware.get_and_cache_agreement_from_db(1, 2))
+        self.assertEqual(self.query.queries, 1)
+
+    async def test_concurrent_async_misses_query_once(self):
+        results = await asyncio.gather(*[
+            self.middleware.aget_and_cache_agreement_from_db(1, 2)
+            for _ in range(8)
+        ])
+
+        self.assertEqual(results, [True] * 8)
+        self.assertEqual(self.query.queries, 1)
+        self.assertIsNone(await self.cache.aget('django:tos:agreed:1:lock'))
+
+
+class UntouchableSession:
+    def __getattr__(self, name):
+        raise AssertionError("The session was accessed")
+
+    def __getitem__(self, key):
+        raise AssertionError("The session was accessed")
+
+
+@override_settings(TOS_EXEMPT_PATHS=[
+    '/static/',
+    '/healthz',
+    re.compile(r'/api/v\d+/'),
+    re.compile(r'/hooks/[a-z]+/$', re.IGNORECASE),
+])
+class TestExemptPaths(SimpleTestCase):
+    def setUp(self):
+        self.middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+
+    def get(self, path):
+        request = RequestFactory().get(path)
+        request.session = UntouchableSession()
+        return self.middleware(request)
+
+    def test_exempt_paths(self):
+        with count_tos_cache_calls() as counting_cache:
+            for path in ['/static/app.css', '/healthz', '/healthz/db', '/api/v2/users/', '/hooks/GitHub/']:
+                with self.subTest(path=path):
+                    self.assertEqual(self.get(path).status_code, 200)
+
+        self.assertEqual(counting_cache.round_trips, 0)
+
+    def test_other_paths(self):
+        for path in ['/', '/app/static/', '/api/users/', '/hooks/github/extra']:
+            with self.subTest(path=path):
+                with self.assertRaisesMessage(AssertionError, "The session was accessed"):
+                    self.get(path)
+
+    def test_compile_exempt_paths(self):
+        self.assertEqual(compile_exempt_paths([]), ((), None))
+
+        prefixes, pattern = compile_exempt_paths(['/a/', re.compile('/b/'), re.compile('/c/', re.I)])
+        self.assertEqual(prefixes, ('/a/',))
+        self.assertEqual(pattern.pattern, '(?:/b/)|(?i:/c/)')
+
+        with self.assertRaises(ImproperlyConfigured):
+            compile_exempt_paths([b'/bytes/'])
+
+    def test_invalid_exempt_pattern(self):
+        # Group names have to be unique once the patterns are combined
+        rules = [re.compile('/c/'), re.compile('/(?P<id>a)/'), re.compile('/(?P<id>b)/')]
+
+        with self.assertRaisesMessage(ImproperlyConfigured, "Invalid TOS_EXEMPT_PATHS pattern '/(?P<id>b)/'"):
+            compile_exempt_paths(rules)
+
+        with override_settings(TOS_EXEMPT_PATHS=rules):
+            with self.assertRaises(ImproperlyConfigured):
+                UserAgreementMiddleware(lambda request: HttpResponse())
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_AGREEMENT_COOKIE=True)
+class TestAgreementCookie(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_cookie_skips_user_state_lookup(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tos_agreed', response.cookies)
+
+        with count_tos_cache_calls() as counting_cache:
+            response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        # Only the active TOS is looked up
+        self.assertEqual(dict(counting_cache.calls), {'get': 1})
+        self.assertNotIn('tos_agreed', response.cookies)
+
+    @override_settings(TOS_LOCAL_CACHE_SIZE=100)
+    def test_cookie_with_local_cache(self):
+        middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        request.session = {SESSION_KEY: str(self.user1.pk), BACKEND_SESSION_KEY: 'backend'}
+
+        response = middleware(request)
+        request.COOKIES['tos_agreed'] = response.cookies['tos_agreed'].value
+        middleware.local_cache.delete(('agreed', self.tos1.pk, str(self.user1.pk)))
+
+        with count_tos_cache_calls() as counting_cache:
+            self.assertEqual(middleware(request).status_code, 200)
+
+        self.assertEqual(counting_cache.round_trips, 0)
+
+    def test_new_tos_invalidates_cookie(self):
+        self.client.force_login(self.user1)
+        self.client.get(reverse('index'))
+
+        tos2 = TermsOfService.objects.create(content="second edition", active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=tos2)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_cookie_for_another_user_is_ignored(self):
+        self.client.force_login(self.user1)
+        self.client.get(reverse('index'))
+        cookie = self.client.cookies['tos_agreed'].value
+
+        self.client.force_login(self.user2)
+        self.client.cookies['tos_agreed'] = cookie
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.force_login(self.user2)
+        self.client.cookies['tos_agreed'] = f'{self.user2.pk}:{self.tos1.pk}:forged'
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_logout_in_view(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('logout'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('tos_agreed', response.cookies)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+@override_settings(TOS_SESSION_AGREEMENT=True)
+class TestSessionAgreement(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_session_skips_user_state_lookup(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.session['tos_agreed'], self.tos1.pk)
+
+        with count_tos_cache_calls() as counting_cache, CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        # Only the active TOS is looked up, and the session isn't saved again
+        self.assertEqual(dict(counting_cache.calls), {'get': 1})
+        self.assertFalse([q for q in ctx.captured_queries if 'tos_useragreement' in q['sql']])
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')])
+
+    def test_new_tos_invalidates_session_agreement(self):
+        self.client.force_login(self.user1)
+        self.client.get(reverse('index'))
+
+        tos2 = TermsOfService.objects.create(content="second edition", active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=tos2)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_not_agreed(self):
+        self.client.force_login(self.user2)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('tos_agreed', self.client.session)
+
+    def test_logout_in_view(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('logout'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('tos_agreed', self.client.session)
+
+    def test_login_as_another_user_in_view(self):
+        middleware = UserAgreementMiddleware(self.login_user2)
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.session[SESSION_KEY] = str(self.user1.pk)
+        request.session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+
+        self.assertEqual(middleware(request).status_code, 200)
+        self.assertNotIn('tos_agreed', request.session)
+
+    def login_user2(self, request):
+        request.session.flush()
+        request.session[SESSION_KEY] = str(self.user2.pk)
+        return HttpResponse()
@@ -1,13 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from tos.models import (
     NoActiveTermsOfService,
     TermsOfService,
     UserAgreement,
     has_user_agreed_latest_tos,
+    users_agreed_latest_tos,
 )
+from tos.signal_handlers import invalidate_cached_agreements
+from tos.utils import get_tos_cache, stamp
+
+from .utils import count_tos_cache_calls
 
 
 class TestModels(TestCase):
@@ -101,6 +115,91 @@ class TestModels(TestCase):
         self.assertEqual(str(ua_u3_tos2), f"{self.user3.username} agreed to TOS: {ua_u3_tos2.terms_of_service.created}: active")
 
 
+class TestUsersAgreedLatestTos(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'user{i}') for i in range(5)])
+        self.user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        self.tos2 = TermsOfService.objects.create(content="second edition", active=False)
+
+        # The first three users agreed, and the last one agreed to tos2
+        UserAgreement.objects.bulk_create(
+            [UserAgreement(terms_of_service=self.tos1, user_id=user_id) for user_id in self.user_ids[:3]]
+            + [UserAgreement(terms_of_service=self.tos2, user_id=self.user_ids[4])]
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+    def test_from_database(self):
+        with self.assertNumQueries(1):
+            agreed = users_agreed_latest_tos(self.user_ids)
+
+        self.assertEqual(agreed, set(self.user_ids[:3]))
+        # And cached for next time
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{self.user_ids[0]}'), stamp(True, self.tos1.pk))
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{self.user_ids[4]}'), stamp(False, self.tos1.pk))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(users_agreed_latest_tos(self.user_ids), set(self.user_ids[:3]))
+
+    def test_only_misses_are_queried(self):
+        # Cached agreements win, and stale ones are ignored
+        self.cache.set(f'django:tos:agreed:{self.user_ids[0]}', stamp(False, self.tos1.pk))
+        self.cache.set(f'django:tos:agreed:{self.user_ids[3]}', stamp(True, self.tos1.pk))
+        self.cache.set(f'django:tos:agreed:{self.user_ids[4]}', stamp(True, self.tos2.pk))
+
+        with CaptureQueriesContext(connection) as ctx:
+            agreed = users_agreed_latest_tos(self.user_ids)
+
+        self.assertEqual(agreed, {self.user_ids[1], self.user_ids[2], self.user_ids[3]})
+        self.assertEqual(len(ctx.captured_queries), 1)
+        # Only the misses are cached again
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{self.user_ids[0]}'), stamp(False, self.tos1.pk))
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{self.user_ids[4]}'), stamp(False, self.tos1.pk))
+
+    def test_chunks(self):
+        with count_tos_cache_calls() as counting_cache, self.assertNumQueries(3):
+            agreed = users_agreed_latest_tos(self.user_ids + self.user_ids[:2], chunk_size=2)
+
+        self.assertEqual(agreed, set(self.user_ids[:3]))
+        self.assertEqual(dict(counting_cache.calls), {'get': 1, 'get_many': 3, 'set_many': 3})
+
+    def test_activation_without_middleware(self):
+        self.assertNotIn('tos.middleware.UserAgreementMiddleware', settings.MIDDLEWARE)
+        user1 = get_user_model().objects.get(pk=self.user_ids[0])
+
+        self.assertEqual(users_agreed_latest_tos(self.user_ids), set(self.user_ids[:3]))
+
+        self.tos2.active = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tos2.save()
+
+        self.assertFalse(has_user_agreed_latest_tos(user1))
+        self.assertEqual(users_agreed_latest_tos(self.user_ids), {self.user_ids[4]})
+
+    def test_rollover(self):
+        self.tos2.active = True
+        self.tos2.save()
+        UserAgreement.objects.filter(terms_of_service=self.tos2).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService, instance=self.tos2)
+
+        # Nobody has agreed to tos2 yet, so nobody is looked up
+        with self.assertNumQueries(0):
+            self.assertEqual(users_agreed_latest_tos(self.user_ids), set())
+
+    def test_no_active_tos(self):
+        TermsOfService.objects.update(active=False)
+        self.cache.clear()
+
+        self.assertEqual(users_agreed_latest_tos(self.user_ids), set())
+
+
 class TestManager(TestCase):
     def test_terms_of_service_manager(self):
 
@@ -150,3 +249,239 @@ class TestNoActiveTOS(TestCase):
     def test_get_current_tos_raises_exception(self):
         with self.assertRaises(NoActiveTermsOfService):
             TermsOfService.objects.get_current_tos()
+
+
+class TestUniqueUserAgreement(TestCase):
+    def test_duplicate_agreement_not_allowed(self):
+        user = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        tos = TermsOfService.objects.create(content="first edition", active=True)
+
+        UserAgreement.objects.create(terms_of_service=tos, user=user)
+
+        with self.assertRaises(IntegrityError):
+            UserAgreement.objects.create(terms_of_service=tos, user=user)
+
+
+class TestSingleActiveTermsOfService(TestCase):
+    def setUp(self):
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        self.tos2 = TermsOfService.objects.create(content="second edition", active=True)
+
+    def test_second_active_not_allowed(self):
+        with self.assertRaises(IntegrityError):
+            TermsOfService.objects.filter(pk=self.tos1.pk).update(active=True)
+
+    def test_activation_only_updates_active_row(self):
+        for i in range(5):
+            TermsOfService.objects.create(content=f"edition {i}", active=False)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.tos1.active = True
+            self.tos1.save()
+
+        update = next(q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE') and 'SET "active"' in q['sql'])
+        self.assertIn('"active"', update.split('WHERE', 1)[1])
+        self.assertEqual(list(TermsOfService.objects.filter(active=True)), [self.tos1])
+
+    def test_activation_retried(self):
+        tos3 = TermsOfService(content="third edition", active=True)
+        save = TermsOfService.save_base
+        attempts = []
+
+        def concurrent_activation(*args, **kwargs):
+            # Another TOS is activated between deactivating tos2 and saving tos3
+            if not attempts:
+                TermsOfService.objects.filter(pk=self.tos1.pk).update(active=True)
+            attempts.append(1)
+            return save(tos3, *args, **kwargs)
+
+        with mock.patch.object(tos3, 'save_base', concurrent_activation):
+            tos3.save()
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(list(TermsOfService.objects.filter(active=True)), [tos3])
+
+    def test_active_row_locked_without_partial_indexes(self):
+        # MySQL doesn't enforce the partial unique constraint
+        with mock.patch.object(connection.features, 'supports_partial_indexes', False), \
+                CaptureQueriesContext(connection) as ctx:
+            self.tos1.active = True
+            self.tos1.save()
+
+        # SQLite leaves out the FOR UPDATE, but the active row is still read
+        # before it is deactivated
+        queries = [q['sql'] for q in ctx.captured_queries]
+        self.assertTrue(queries[1].startswith('SELECT "tos_termsofservice"."id"'))
+        self.assertIn('"active"', queries[1].split('WHERE', 1)[1])
+        self.assertTrue(queries[2].startswith('UPDATE'))
+        self.assertEqual(list(TermsOfService.objects.filter(active=True)), [self.tos1])
+
+
+class TestConcurrentActivation(TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Each thread gets its own connection, and in-memory SQLite
+            # databases fail instead of waiting for the other writers
+            self.skipTest("Needs a database that allows concurrent connections")
+
+    def test_concurrent_activations(self):
+        TermsOfService.objects.create(content="first edition", active=True)
+        editions = [
+            TermsOfService.objects.create(content=f"edition {i}", active=False)
+            for i in range(8)
+        ]
+
+        def activate(tos):
+            try:
+                tos.active = True
+                tos.save()
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(editions)) as executor:
+            list(executor.map(activate, editions))
+
+        self.assertEqual(TermsOfService.objects.filter(active=True).count(), 1)
+
+
+class TestDeduplicateUserAgreements(TransactionTestCase):
+    """
+    Duplicates can only exist before the unique constraint is added, so these
+    tests run against the database as it was before that migration
+    """
+    before = [('tos', '0001_initial')]
+    after = [('tos', '0002_useragreement_unique_user_tos')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.addCleanup(self.migrate_to_latest)
+
+        old_apps = executor.loader.project_state(self.before).apps
+        TermsOfService = old_apps.get_model('tos', 'TermsOfService')
+        UserAgreement = old_apps.get_model('tos', 'UserAgreement')
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        tos1 = TermsOfService.objects.create(content="first edition", active=False)
+        tos2 = TermsOfService.objects.create(content="second edition", active=True)
+        self.old_user_agreement = UserAgreement
+        self.tos2_id = tos2.pk
+
+        self.kept = [
+            UserAgreement.objects.create(terms_of_service=tos1, user_id=self.user1.pk).pk,
+            UserAgreement.objects.create(terms_of_service=tos2, user_id=self.user1.pk).pk,
+            UserAgreement.objects.create(terms_of_service=tos1, user_id=self.user2.pk).pk,
+        ]
+        UserAgreement.objects.bulk_create([
+            UserAgreement(terms_of_service=tos1, user_id=self.user1.pk),
+            UserAgreement(terms_of_service=tos1, user_id=self.user1.pk),
+            UserAgreement(terms_of_service=tos1, user_id=self.user2.pk),
+        ])
+
+    def migrate_to_latest(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes('tos'))
+
+    def kept_pks(self):
+        return sorted(UserAgreement.objects.values_list('pk', flat=True))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('deduplicate_user_agreements', batch_size=1, stdout=out)
+
+        self.assertIn("Successfully deleted 3 duplicate user agreements", out.getvalue())
+        # The oldest agreements are kept
+        self.assertEqual(self.kept_pks(), self.kept)
+
+        out = StringIO()
+        call_command('deduplicate_user_agreements', stdout=out)
+
+        self.assertIn("Successfully deleted 0 duplicate user agreements", out.getvalue())
+
+    def test_command_keeps_cached_agreements(self):
+        self.old_user_agreement.objects.create(terms_of_service_id=self.tos2_id, user_id=self.user1.pk)
+        cache = get_tos_cache()
+        cache.clear()
+        cache.set('django:tos:active_tos', (self.tos2_id, None))
+        cache.set(f'django:tos:agreed:{self.user1.pk}', stamp(True, self.tos2_id))
+
+        call_command('deduplicate_user_agreements', stdout=StringIO())
+
+        # The user still has their oldest agreement to the active TOS
+        self.assertEqual(cache.get(f'django:tos:agreed:{self.user1.pk}'), stamp(True, self.tos2_id))
+
+    def test_migration(self):
+        MigrationExecutor(connection).migrate(self.after)
+
+        self.assertEqual(self.kept_pks(), self.kept)
+
+
+class TestCurrentTosCache(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        self.tos2 = TermsOfService.objects.create(
+            content="second edition of the terms of service",
+            active=False
+        )
+
+    def get_current_tos(self):
+        # The current TOS is only cached once the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return TermsOfService.objects.get_current_tos()
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_current_tos(), self.tos1)
+
+        with self.assertNumQueries(0):
+            tos = self.get_current_tos()
+
+        self.assertEqual(tos, self.tos1)
+        self.assertEqual(tos.content, self.tos1.content)
+
+    def test_not_cached_before_commit(self):
+        TermsOfService.objects.get_current_tos()
+
+        self.assertIsNone(self.cache.get('django:tos:current_tos'))
+
+    def test_invalidated_on_save(self):
+        self.get_current_tos()
+
+        self.tos2.active = True
+        self.tos2.save()
+
+        self.assertIsNone(self.cache.get('django:tos:current_tos'))
+        self.assertEqual(self.get_current_tos(), self.tos2)
+
+    def test_invalidated_on_delete(self):
+        self.get_current_tos()
+
+        self.tos1.delete()
+
+        self.assertIsNone(self.cache.get('django:tos:current_tos'))
+        self.assertRaises(NoActiveTermsOfService, self.get_current_tos)
+
+    @override_settings(TOS_LOCAL_CACHE_SIZE=10)
+    def test_local_cache(self):
+        self.get_current_tos()
+
+        # Another process forgot the current TOS, but this one remembers
+        self.cache.delete('django:tos:current_tos')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_current_tos(), self.tos1)
+
+        # Changes made in this process are noticed right away
+        self.tos2.active = True
+        self.tos2.save()
+
+        self.assertEqual(self.get_current_tos(), self.tos2)
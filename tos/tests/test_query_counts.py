@@ -0,0 +1,256 @@
+"""
+Query and cache round trip budgets for every path through the views and the
+middleware. If one of these fails, a change has added a query or a cache
+call to a hot path: either remove it, or update the budget on purpose.
+"""
+from contextlib import contextmanager
+
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.contrib.sites.shortcuts import get_current_site
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from tos.middleware import UserAgreementMiddleware
+from tos.models import TermsOfService, UserAgreement
+from tos.signal_handlers import invalidate_cached_agreements
+from tos.utils import get_tos_cache, stamp
+from tos.views import TosView, check_tos, login
+
+from .utils import count_tos_cache_calls
+
+BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BudgetTestCase(TestCase):
+    def setUp(self):
+        self.cache = get_tos_cache()
+        self.cache.clear()
+
+        self.agreed = get_user_model().objects.create_user('agreed', 'agreed@example.com', 'agreedpass')
+        self.not_agreed = get_user_model().objects.create_user('not_agreed', 'not_agreed@example.com', 'notpass')
+        self.staff = get_user_model().objects.create_user('staff', 'staff@example.com', 'staffpass', is_staff=True)
+
+        self.tos = TermsOfService.objects.create(content="first edition of the terms of service", active=True)
+        UserAgreement.objects.create(terms_of_service=self.tos, user=self.agreed)
+
+        # Warm the active TOS, the current TOS and the current site, as they
+        # would be on a running site
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+        with self.captureOnCommitCallbacks(execute=True):
+            TermsOfService.objects.get_current_tos()
+            TermsOfService.objects.get_current_tos_version()
+        get_current_site(RequestFactory().get('/'))
+
+    def make_request(self, request, user=None, **session):
+        # Signed cookie sessions and cookie messages keep the session and
+        # messages frameworks out of the counts
+        request.session = SessionStore()
+        if user is not None:
+            request.session[SESSION_KEY] = str(user.pk)
+            request.session[BACKEND_SESSION_KEY] = BACKEND
+        request.session.update(session)
+        request._messages = CookieStorage(request)
+        request._dont_enforce_csrf_checks = True
+        return request
+
+    def get(self, path='/', user=None, **session):
+        return self.make_request(RequestFactory().get(path), user, **session)
+
+    def post(self, path, data, user=None, **session):
+        return self.make_request(RequestFactory().post(path, data), user, **session)
+
+    @contextmanager
+    def assertBudget(self, queries, cache_calls):
+        with count_tos_cache_calls() as counting_cache, \
+                CaptureQueriesContext(connection) as ctx, \
+                self.captureOnCommitCallbacks(execute=True):
+            yield
+
+        self.assertEqual(
+            len(ctx.captured_queries), queries,
+            '\n'.join(query['sql'] for query in ctx.captured_queries),
+        )
+        self.assertEqual(dict(counting_cache.calls), cache_calls)
+
+
+class TestViewBudgets(BudgetTestCase):
+    def test_tos(self):
+        with self.assertBudget(0, {'get': 2}):
+            response = TosView.as_view()(self.get('/'))
+            response.render()
+        self.assertEqual(response.status_code, 200)
+
+    def test_tos_not_modified(self):
+        etag = TosView.as_view()(self.get('/'))['ETag']
+        request = self.get('/')
+        request.META['HTTP_IF_NONE_MATCH'] = etag
+
+        with self.assertBudget(0, {'get': 1}):
+            response = TosView.as_view()(request)
+        self.assertEqual(response.status_code, 304)
+
+    def test_tos_cold(self):
+        self.cache.clear()
+
+        # The version and the content, cached for the next request (the
+        # version twice, as loading the content caches it as well)
+        with self.assertBudget(2, {'get': 2, 'set': 3}):
+            response = TosView.as_view()(self.get('/'))
+            response.render()
+        self.assertEqual(response.status_code, 200)
+
+    def test_check_tos(self):
+        with self.assertBudget(0, {'get': 1}):
+            response = check_tos(self.get('/tos/confirm/'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_check_tos_accept(self):
+        request = self.post(
+            '/tos/confirm/', {'accept': 'accept'},
+            tos_user=self.not_agreed.pk, tos_backend=BACKEND,
+        )
+
+        # The user, the agreement (in a savepoint, as the test runs in a
+        # transaction) and the user's last_login
+        with self.assertBudget(5, {'get': 1, 'set_many': 1}):
+            response = check_tos(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(UserAgreement.objects.filter(user=self.not_agreed, terms_of_service=self.tos).exists())
+
+    def test_check_tos_accept_again(self):
+        request = self.post(
+            '/tos/confirm/', {'accept': 'accept'},
+            tos_user=self.agreed.pk, tos_backend=BACKEND,
+        )
+
+        # The INSERT fails and is rolled back to the savepoint
+        with self.assertBudget(6, {'get': 1, 'set': 1}):
+            response = check_tos(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(UserAgreement.objects.filter(user=self.agreed).count(), 1)
+
+    def test_check_tos_reject(self):
+        request = self.post(
+            '/tos/confirm/', {'accept': 'reject'},
+            tos_user=self.not_agreed.pk, tos_backend=BACKEND,
+        )
+
+        with self.assertBudget(0, {'get': 1}):
+            response = check_tos(request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_form(self):
+        with self.assertBudget(0, {}):
+            response = login(self.get('/login/'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_agreed(self):
+        request = self.post('/login/', {'username': 'agreed', 'password': 'agreedpass'})
+
+        # The user, the agreement and the user's last_login
+        with self.assertBudget(3, {}):
+            response = login(request)
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(TOS_SESSION_AGREEMENT=True)
+    def test_login_agreed_session_agreement(self):
+        request = self.post('/login/', {'username': 'agreed', 'password': 'agreedpass'})
+
+        with self.assertBudget(3, {'get': 1}):
+            response = login(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(request.session['tos_agreed'], self.tos.pk)
+
+    def test_login_not_agreed(self):
+        request = self.post('/login/', {'username': 'not_agreed', 'password': 'notpass'})
+
+        # The user and the agreement
+        with self.assertBudget(2, {'get': 1}):
+            response = login(request)
+        self.assertContains(response, "first edition of the terms of service")
+
+
+class TestMiddlewareBudgets(BudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+
+    def test_anonymous(self):
+        with self.assertBudget(0, {}):
+            response = self.middleware(self.get('/'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_get(self):
+        with self.assertBudget(0, {}):
+            response = self.middleware(self.post('/', {}, self.not_agreed))
+        self.assertEqual(response.status_code, 200)
+
+    def test_check_page(self):
+        with self.assertBudget(0, {}):
+            response = self.middleware(self.get('/tos/confirm/', self.not_agreed))
+        self.assertEqual(response.status_code, 200)
+
+    def test_staff(self):
+        self.cache.set(f'django:tos:skip_tos_check:{self.staff.pk}', True)
+
+        with self.assertBudget(0, {'get_many': 1}):
+            response = self.middleware(self.get('/', self.staff))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_agreement(self):
+        self.cache.set(f'django:tos:agreed:{self.agreed.pk}', stamp(True, self.tos.pk))
+
+        with self.assertBudget(0, {'get_many': 1}):
+            response = self.middleware(self.get('/', self.agreed))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cache_miss(self):
+        with self.assertBudget(1, {'get_many': 1, 'set': 1}):
+            response = self.middleware(self.get('/', self.agreed))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cache.get(f'django:tos:agreed:{self.agreed.pk}'), stamp(True, self.tos.pk))
+
+    @override_settings(TOS_CACHE_MISS_LOCK_TIMEOUT=5)
+    def test_cache_miss_lock(self):
+        middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+
+        # Taking the lease, the agreement query, caching it and releasing
+        # the lease
+        with self.assertBudget(1, {'get_many': 1, 'add': 1, 'set': 1, 'delete': 1}):
+            response = middleware(self.get('/', self.agreed))
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_agreed(self):
+        self.cache.set(f'django:tos:agreed:{self.not_agreed.pk}', stamp(False, self.tos.pk))
+
+        with self.assertBudget(0, {'get_many': 1}):
+            response = self.middleware(self.get('/', self.not_agreed))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(TOS_SESSION_AGREEMENT=True)
+    def test_session_agreement(self):
+        middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+        request = self.get('/', self.agreed, tos_agreed=self.tos.pk)
+
+        with self.assertBudget(0, {'get': 1}):
+            response = middleware(request)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_cached_agreement(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        middleware = UserAgreementMiddleware(get_response)
+        await self.cache.aset(f'django:tos:agreed:{self.agreed.pk}', stamp(True, self.tos.pk))
+        request = self.make_request(AsyncRequestFactory().get('/'), self.agreed)
+
+        with count_tos_cache_calls() as counting_cache:
+            response = await middleware(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(counting_cache.calls), {'aget_many': 1})
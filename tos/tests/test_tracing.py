@@ -0,0 +1,172 @@
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user_model
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import modify_settings
+from django.urls import reverse
+
+from tos.middleware import UserAgreementMiddleware
+from tos.models import TermsOfService, UserAgreement
+from tos.tracing import Tracer, _spans, get_tracer, span, traced_view
+from tos.utils import get_tos_cache, invalidate_cached_agreements
+
+recorded = []
+
+
+def record_spans(request, spans):
+    recorded.append([name for name, seconds in spans])
+
+
+def span_names(response):
+    return [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+
+
+class TracingTestCase(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+        recorded.clear()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cached_agreements(TermsOfService)
+
+
+@modify_settings(
+    MIDDLEWARE={
+        'append': 'tos.middleware.UserAgreementMiddleware',
+    },
+)
+class TestMiddlewareTracing(TracingTestCase):
+    @override_settings(TOS_SERVER_TIMING=True)
+    def test_server_timing(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(span_names(response), ['tos-cache', 'tos-db', 'tos-check'])
+        self.assertRegex(response['Server-Timing'], r'^tos-cache;dur=\d+\.\d{3}, ')
+
+        # Cached now
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(span_names(response), ['tos-cache', 'tos-check'])
+
+    @override_settings(TOS_TRACER=record_spans)
+    def test_hook(self):
+        self.client.force_login(self.user2)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(recorded, [['tos-cache', 'tos-db', 'tos-check']])
+
+    @override_settings(TOS_SERVER_TIMING=True, TOS_SESSION_AGREEMENT=True)
+    def test_remembered(self):
+        self.client.force_login(self.user1)
+        self.client.get(reverse('index'))
+
+        response = self.client.get(reverse('index'))
+
+        self.assertEqual(span_names(response), ['tos-remembered', 'tos-check'])
+
+    def test_disabled(self):
+        self.client.force_login(self.user1)
+
+        response = self.client.get(reverse('index'))
+
+        self.assertNotIn('Server-Timing', response)
+
+        # Nothing is wrapped
+        middleware = UserAgreementMiddleware(lambda request: HttpResponse())
+        self.assertIsNone(middleware.tracer)
+        self.assertNotIn('get_user_state', vars(middleware))
+        self.assertNotIn('process_request', vars(middleware))
+
+    @override_settings(TOS_SERVER_TIMING=True)
+    async def test_async(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        middleware = UserAgreementMiddleware(get_response)
+        request = AsyncRequestFactory().get(reverse('index'))
+        request.session = {SESSION_KEY: str(self.user1.pk), BACKEND_SESSION_KEY: 'backend'}
+
+        response = await middleware(request)
+
+        self.assertEqual(span_names(response), ['tos-cache', 'tos-db', 'tos-check'])
+
+
+@override_settings(TOS_SERVER_TIMING=True)
+class TestViewTracing(TracingTestCase):
+    def test_login(self):
+        response = self.client.post(reverse('login'), {'username': 'user1', 'password': 'user1pass'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(span_names(response), ['tos-agreement'])
+
+    def test_check_tos(self):
+        self.client.post(reverse('login'), {'username': 'user2', 'password': 'user2pass'})
+
+        response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(span_names(response), ['tos-current', 'tos-agree'])
+
+
+class TestTracer(SimpleTestCase):
+    def test_span_outside_of_a_trace(self):
+        with span('tos-test'):
+            pass
+
+        self.assertIsNone(_spans.get())
+
+    def test_failed_view(self):
+        @traced_view
+        def view(request):
+            with span('tos-test'):
+                raise ValueError
+
+        with override_settings(TOS_TRACER=record_spans):
+            recorded.clear()
+            with self.assertRaises(ValueError):
+                view(RequestFactory().get('/'))
+
+        # The spans are still reported, and the trace is over
+        self.assertEqual(recorded, [['tos-test']])
+        self.assertIsNone(_spans.get())
+
+    @override_settings(TOS_TRACER='tos.tests.test_tracing.record_spans')
+    def test_dotted_path_hook(self):
+        self.assertEqual(get_tracer().hook.__name__, 'record_spans')
+
+    def test_tracer_is_cached(self):
+        self.assertIsNone(get_tracer())
+
+        with override_settings(TOS_SERVER_TIMING=True):
+            tracer = get_tracer()
+            self.assertIsNotNone(tracer)
+            self.assertIs(get_tracer(), tracer)
+
+        self.assertIsNone(get_tracer())
+
+    def test_existing_server_timing(self):
+        tracer = Tracer(server_timing=True)
+        response = HttpResponse()
+        response['Server-Timing'] = 'db;dur=1.000'
+
+        token = tracer.start()
+        # Nested traces are reported by the outermost one
+        self.assertIsNone(tracer.start())
+        with span('tos-test'):
+            pass
+        tracer.finish(token, None, response)
+
+        self.assertEqual(span_names(response), ['db', 'tos-test'])
@@ -1,15 +1,24 @@
 from django.contrib import admin
+from django.contrib.auth import logout
+from django.http import HttpResponse
 from django.urls import include, path, re_path
 from django.views.generic import TemplateView
 
 from tos import views
 
 
+def logout_view(request):
+    logout(request)
+    return HttpResponse()
+
+
 urlpatterns = [
     re_path(r'^$', TemplateView.as_view(template_name='index.html'), name='index'),
 
     re_path(r'^login/$', views.login, {}, 'login'),
+    re_path(r'^logout/$', logout_view, name='logout'),
     re_path(r'^tos/', include('tos.urls')),
+    re_path(r'^tos/', include('tos.agreed_urls')),
 
     path('admin/', admin.site.urls),
 ]
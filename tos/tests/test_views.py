@@ -1,14 +1,22 @@
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
-from django.urls import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve, reverse
+from django.utils.http import http_date
 
 from tos.models import TermsOfService, UserAgreement, has_user_agreed_latest_tos
+from tos.utils import get_tos_cache
+from tos.views import AsyncTosView, acheck_tos, alogin
 
 
 class TestViews(TestCase):
 
     def setUp(self):
+        get_tos_cache().clear()
+
         # User that has agreed to TOS
         self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
 
@@ -97,6 +105,25 @@ class TestViews(TestCase):
         response = self.client.get(self.login_url)
         self.assertContains(response, "Dummy login template.")
 
+    def test_cached_tos_not_queried(self):
+        # Cache the current TOS
+        with self.captureOnCommitCallbacks(execute=True):
+            TermsOfService.objects.get_current_tos()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.login_url, {'username': 'user2', 'password': 'user2pass'})
+            self.assertContains(response, "first edition of the terms of service")
+
+            response = self.client.get(reverse('tos'))
+            self.assertContains(response, "first edition of the terms of service")
+
+        # The agreement check joins the active TOS, but it is never looked up
+        # on its own
+        self.assertFalse([
+            query for query in queries
+            if 'tos_termsofservice' in query['sql'] and 'tos_useragreement' not in query['sql']
+        ])
+
     def test_root_tos_view(self):
 
         response = self.client.get('/tos/')
@@ -131,6 +158,31 @@ class TestViews(TestCase):
         response = self.client.post(url, {'accept': 'accept'})
 
         self.assertTrue(has_user_agreed_latest_tos(self.user2))
+        self.assertNotIn('tos_agreed', response.cookies)
+
+    @override_settings(TOS_AGREEMENT_COOKIE=True)
+    def test_accept_agreement_sets_cookie(self):
+        self.client.post(self.login_url, {'username': 'user2', 'password': 'user2pass'})
+        response = self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.cookies['tos_agreed']['httponly'])
+        self.assertEqual(
+            self.client.cookies['tos_agreed'].value.split(':')[:2],
+            [str(self.user2.pk), str(self.tos1.pk)],
+        )
+
+    @override_settings(TOS_SESSION_AGREEMENT=True)
+    def test_session_agreement(self):
+        self.client.post(self.login_url, {'username': 'user2', 'password': 'user2pass'})
+        self.assertNotIn('tos_agreed', self.client.session)
+
+        self.client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        self.assertEqual(self.client.session['tos_agreed'], self.tos1.pk)
+
+        self.client.logout()
+        self.client.post(self.login_url, {'username': 'user1', 'password': 'user1pass'})
+        self.assertEqual(self.client.session['tos_agreed'], self.tos1.pk)
 
     def test_bump_new_agreement(self):
 
@@ -149,3 +201,208 @@ class TestViews(TestCase):
         response = self.client.post(url, {'accept': 'accept'})
 
         self.assertTrue(has_user_agreed_latest_tos(self.user1))
+
+
+class TestTosViewConditionalGet(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        self.tos2 = TermsOfService.objects.create(
+            content="second edition of the terms of service",
+            active=False
+        )
+
+    def test_etag_and_last_modified(self):
+        response = self.client.get(reverse('tos'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.tos1.pk}-{self.tos1.modified.timestamp()}-en-us"')
+        self.assertEqual(response['Last-Modified'], http_date(self.tos1.modified.timestamp()))
+
+    def test_not_modified(self):
+        response = self.client.get(reverse('tos'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('tos'), headers={'If-None-Match': response['ETag']})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # The content isn't loaded at all
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('content', queries[0]['sql'])
+
+    def test_not_modified_from_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(reverse('tos'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('tos'), headers={'If-Modified-Since': response['Last-Modified']})
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_modified_after_rollover(self):
+        response = self.client.get(reverse('tos'))
+
+        self.tos2.active = True
+        self.tos2.save()
+
+        response = self.client.get(reverse('tos'), headers={'If-None-Match': response['ETag']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "second edition of the terms of service")
+
+
+class TestAgreedUsersView(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+
+        User = get_user_model()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', 'user2pass')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'adminpass')
+
+        self.tos1 = TermsOfService.objects.create(content="first edition", active=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+
+        self.url = reverse('tos_agreed_users')
+
+    def test_opt_in(self):
+        for urlconf in ['tos.urls', 'tos.async_urls']:
+            with self.assertRaises(Resolver404):
+                resolve('/agreed/', urlconf=urlconf)
+
+    def test_permission(self):
+        response = self.client.get(self.url, {'user_ids': self.user1.pk})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.user1)
+        response = self.client.get(self.url, {'user_ids': self.user1.pk})
+        self.assertEqual(response.status_code, 403)
+
+    def test_get(self):
+        self.client.force_login(self.admin)
+
+        response = self.client.get(self.url, {'user_ids': f'{self.user2.pk},{self.user1.pk},{self.user1.pk}'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'agreed': [self.user1.pk]})
+
+    def test_post(self):
+        self.client.force_login(self.admin)
+        user_ids = [self.user1.pk, self.user2.pk, self.admin.pk]
+
+        response = self.client.post(self.url, {'user_ids': user_ids}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'agreed': [self.user1.pk]})
+
+    def test_invalid(self):
+        self.client.force_login(self.admin)
+
+        response = self.client.get(self.url, {'user_ids': 'one,two'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url, {'ids': [1]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url, 'user_ids', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(TOS_AGREED_USERS_LIMIT=1):
+            response = self.client.get(self.url, {'user_ids': f'{self.user1.pk},{self.user2.pk}'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(ROOT_URLCONF='tos.tests.async_urls')
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        get_tos_cache().clear()
+
+        self.user1 = get_user_model().objects.create_user('user1', 'user1@example.com', 'user1pass')
+        self.user2 = get_user_model().objects.create_user('user2', 'user2@example.com', 'user2pass')
+
+        self.tos1 = TermsOfService.objects.create(
+            content="first edition of the terms of service",
+            active=True
+        )
+        UserAgreement.objects.create(terms_of_service=self.tos1, user=self.user1)
+
+    def test_async_views(self):
+        self.assertTrue(iscoroutinefunction(acheck_tos))
+        self.assertTrue(iscoroutinefunction(alogin))
+        self.assertTrue(AsyncTosView.view_is_async)
+
+    async def test_login(self):
+        response = await self.async_client.post('/login/', {'username': 'user1', 'password': 'user1pass'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], settings.LOGIN_REDIRECT_URL)
+
+    async def test_login_form(self):
+        response = await self.async_client.get('/login/')
+
+        self.assertContains(response, "Dummy login template.")
+
+    async def test_need_agreement(self):
+        response = await self.async_client.post('/login/', {'username': 'user2', 'password': 'user2pass'})
+        self.assertContains(response, "first edition of the terms of service")
+
+        response = await self.async_client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await UserAgreement.objects.filter(user=self.user2, terms_of_service=self.tos1).aexists())
+
+        # Agreeing again doesn't record another agreement, but still stores it
+        await get_tos_cache().aclear()
+        response = await self.async_client.post(reverse('tos_check_tos'), {'accept': 'accept'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(await UserAgreement.objects.filter(user=self.user2).acount(), 1)
+        self.assertEqual(await get_tos_cache().aget(f'django:tos:agreed:{self.user2.pk}'), {self.tos1.pk: True})
+
+    def test_agreement_written_through(self):
+        # A sync test, so the on commit callbacks are captured on the
+        # connection the view used
+        async_to_sync(self.async_client.post)('/login/', {'username': 'user2', 'password': 'user2pass'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(self.async_client.post)(reverse('tos_check_tos'), {'accept': 'accept'})
+
+        self.assertEqual(get_tos_cache().get(f'django:tos:agreed:{self.user2.pk}'), {self.tos1.pk: True})
+
+    async def test_reject_agreement(self):
+        await self.async_client.post('/login/', {'username': 'user2', 'password': 'user2pass'})
+
+        response = await self.async_client.post(reverse('tos_check_tos'), {'accept': 'reject'})
+
+        self.assertContains(response, "first edition of the terms of service")
+        self.assertFalse(await UserAgreement.objects.filter(user=self.user2).aexists())
+
+    @override_settings(TOS_SESSION_AGREEMENT=True)
+    async def test_session_agreement(self):
+        await self.async_client.post('/login/', {'username': 'user1', 'password': 'user1pass'})
+
+        session = self.async_client.session
+        self.assertEqual(await sync_to_async(session.get)('tos_agreed'), self.tos1.pk)
+
+    async def test_tos(self):
+        response = await self.async_client.get(reverse('tos'))
+
+        self.assertContains(response, "first edition of the terms of service")
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+        response = await self.async_client.get(reverse('tos'), headers={'If-None-Match': response['ETag']})
+
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(TOS_SERVER_TIMING=True)
+    async def test_server_timing(self):
+        response = await self.async_client.get(reverse('tos_check_tos'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tos-current;dur=', response['Server-Timing'])
@@ -0,0 +1,121 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from unittest import mock
+
+from tos.utils import get_tos_cache
+
+
+class CountingCache:
+    """
+    Wrap a cache backend and count the calls (round trips) made to it,
+    optionally adding some latency to each call to simulate a network cache
+    """
+    def __init__(self, cache, latency=0):
+        self.cache = cache
+        self.latency = latency
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.cache, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            return attr(*args, **kwargs)
+        return wrapper
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+
+
+@contextmanager
+def count_tos_cache_calls(latency=0):
+    """
+    Replace the TOS cache used throughout ``tos`` with a CountingCache
+    """
+    counting_cache = CountingCache(get_tos_cache(), latency)
+    with mock.patch('tos.utils.cache', counting_cache), \
+            mock.patch('tos.models.cache', counting_cache), \
+            mock.patch('tos.backends.cache', counting_cache), \
+            mock.patch('tos.middleware.cache', counting_cache), \
+            mock.patch('tos.views.cache', counting_cache):
+        yield counting_cache
+
+
+class FakeRedis:
+    """
+    An in-memory stand-in for the parts of ``redis.Redis`` used by
+    tos.backends.RedisAgreementBackend, counting the round trips
+    """
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        self.round_trips += 1
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def _sismember(self, key, member):
+        return member in self.data.get(key, set())
+
+    def _sadd(self, key, member):
+        members = self.data.setdefault(key, set())
+        added = member not in members
+        members.add(member)
+        return int(added)
+
+    def _srem(self, key, member):
+        members = self.data.get(key, set())
+        removed = member in members
+        members.discard(member)
+        return int(removed)
+
+    def _getbit(self, key, offset):
+        bits = self.data.get(key, bytearray())
+        byte = offset // 8
+        if byte >= len(bits):
+            return 0
+        return (bits[byte] >> (7 - offset % 8)) & 1
+
+    def _setbit(self, key, offset, value):
+        bits = self.data.setdefault(key, bytearray())
+        byte = offset // 8
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        old = self._getbit(key, offset)
+        if value:
+            bits[byte] |= 1 << (7 - offset % 8)
+        else:
+            bits[byte] &= ~(1 << (7 - offset % 8)) & 0xFF
+        return old
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, f'_{name}')
+
+        def queue(*args):
+            self.commands.append((command, args))
+            return self
+        return queue
+
+    def execute(self):
+        self.client.round_trips += 1
+        results = [command(*args) for command, args in self.commands]
+        self.commands = []
+        return results
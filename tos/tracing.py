@@ -0,0 +1,157 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# The (name, seconds) spans recorded for the current request, or None when
+# nothing is being traced
+_spans = ContextVar('tos_spans', default=None)
+
+
+class Tracer:
+    """
+    Collect span timings for a request, and report them in a
+    ``Server-Timing`` header and/or to a hook
+    """
+    def __init__(self, server_timing=False, hook=None):
+        self.server_timing = server_timing
+        self.hook = hook
+
+    def start(self):
+        """
+        Start collecting spans, unless they are already being collected for
+        this request. Returns a token for finish(), or None.
+        """
+        if _spans.get() is not None:
+            return None
+        return _spans.set([])
+
+    def finish(self, token, request, response=None):
+        """
+        Stop collecting spans and report them, if start() returned a token.
+        The response is None if the request failed.
+        """
+        if token is None:
+            return
+        spans = _spans.get()
+        _spans.reset(token)
+
+        if self.server_timing and spans and response is not None:
+            header = ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in spans)
+            if response.get('Server-Timing'):
+                header = f"{response['Server-Timing']}, {header}"
+            response['Server-Timing'] = header
+
+        if self.hook is not None:
+            self.hook(request, spans)
+
+    def wrap(self, name, func):
+        """Record a span for every call to the (sync or async) function"""
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record_span(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_span(name, time.perf_counter() - start)
+        return wrapper
+
+
+@lru_cache(maxsize=None)
+def get_tracer():
+    """
+    Return a Tracer if ``TOS_SERVER_TIMING`` or ``TOS_TRACER`` are set, or
+    None if tracing is disabled
+
+    The tracer is only created once, as the traced views would otherwise
+    look up the settings on every request.
+    """
+    server_timing = getattr(settings, 'TOS_SERVER_TIMING', False)
+    hook = getattr(settings, 'TOS_TRACER', None)
+    if isinstance(hook, str):
+        hook = import_string(hook)
+
+    if not server_timing and hook is None:
+        return None
+    return Tracer(server_timing, hook)
+
+
+@receiver(setting_changed)
+def _reset_tracer(setting, **kwargs):
+    if setting in ('TOS_SERVER_TIMING', 'TOS_TRACER'):
+        get_tracer.cache_clear()
+
+
+def record_span(name, seconds):
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name):
+    """
+    Time the block as a span of the request being traced, if any
+    """
+    if _spans.get() is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def traced_view(view):
+    """
+    Report the spans recorded while the (sync or async) view runs, when
+    tracing is enabled
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            tracer = get_tracer()
+            if tracer is None:
+                return await view(request, *args, **kwargs)
+
+            token = tracer.start()
+            response = None
+            try:
+                response = await view(request, *args, **kwargs)
+                return response
+            finally:
+                tracer.finish(token, request, response)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        tracer = get_tracer()
+        if tracer is None:
+            return view(request, *args, **kwargs)
+
+        token = tracer.start()
+        response = None
+        try:
+            response = view(request, *args, **kwargs)
+            return response
+        finally:
+            tracer.finish(token, request, response)
+    return wrapper
@@ -1,12 +1,15 @@
 from django.urls import re_path
 
-from tos.views import check_tos, TosView
+from tos.views import check_tos, metrics, TosView
 
 
 urlpatterns = [
     # Terms of Service conform
     re_path(r'^confirm/$', check_tos, name='tos_check_tos'),
 
+    # Middleware metrics of the current process, for staff users
+    re_path(r'^metrics/$', metrics, name='tos_metrics'),
+
     # Terms of service simple display
     re_path(r'^$', TosView.as_view(), name='tos'),
 ]
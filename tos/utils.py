@@ -1,13 +1,25 @@
+import asyncio
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from itertools import islice
 from typing import TYPE_CHECKING
 
+from asgiref.sync import sync_to_async
 from django.apps import AppConfig, apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Count, Min, Q
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
+from django.utils.module_loading import import_string
 
 if TYPE_CHECKING:
     from django.contrib.auth.models import AbstractUser
@@ -20,50 +32,706 @@ def get_tos_cache():
 cache = get_tos_cache()
 
 
-def initialize_cache_version():
-    if not cache.get('django:tos:key_version', False):
-        # The function is a signal handler, so it needs a sender argument, but
-        # it doesn't actually use it at all, so it can be None
-        invalidate_cached_agreements(sender=None)
+class LocalCache:
+    """
+    A small per-process LRU cache whose entries expire after ``timeout``
+    seconds
 
+    This sits in front of the TOS cache so that hot lookups don't need a
+    network round trip. Since it can't be invalidated from other processes,
+    ``timeout`` is also the longest time a process can take to notice
+    changes made elsewhere.
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
 
-def invalidate_cached_agreements(sender, **kwargs):
-    # Set the key version to 0 if it doesn't exist and leave it
-    # alone if it does
-    cache.add('django:tos:key_version', 0)
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
 
-    # This key will be used to version the rest of the TOS keys
-    # Incrementing it will effectively invalidate all previous keys
-    cache.incr('django:tos:key_version')
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_local_cache():
+    """
+    Return a new per-process cache configured from the settings, or None if
+    the local cache is disabled
+    """
+    max_size = getattr(settings, 'TOS_LOCAL_CACHE_SIZE', 0)
+    if not max_size:
+        return None
+
+    return LocalCache(max_size, getattr(settings, 'TOS_LOCAL_CACHE_TIMEOUT', 5))
+
+
+# The current TOS is kept in this process as well, if the local cache is enabled
+current_tos_local_cache = LocalCache(max_size=2, timeout=5)
+
+# The current TOS itself, and just its (pk, modified) version
+CURRENT_TOS_KEYS = ['django:tos:current_tos', 'django:tos:current_tos_version']
+
+
+def get_cached_current_tos(key='django:tos:current_tos'):
+    """
+    Get the current TOS (or its version) from the local cache or the TOS
+    cache, or None if it isn't cached
+    """
+    local = getattr(settings, 'TOS_LOCAL_CACHE_SIZE', 0)
+    if local:
+        value = current_tos_local_cache.get(key)
+        if value is not None:
+            return value
+
+    value = cache.get(key)
+    if value is not None and local:
+        current_tos_local_cache.set(key, value, getattr(settings, 'TOS_LOCAL_CACHE_TIMEOUT', 5))
+    return value
+
+
+async def aget_cached_current_tos(key='django:tos:current_tos'):
+    """
+    Async version of get_cached_current_tos
+    """
+    local = getattr(settings, 'TOS_LOCAL_CACHE_SIZE', 0)
+    if local:
+        value = current_tos_local_cache.get(key)
+        if value is not None:
+            return value
+
+    value = await cache.aget(key)
+    if value is not None and local:
+        current_tos_local_cache.set(key, value, getattr(settings, 'TOS_LOCAL_CACHE_TIMEOUT', 5))
+    return value
+
+
+def _set_current_tos(key, value):
+    cache.set(key, value)
+    if getattr(settings, 'TOS_LOCAL_CACHE_SIZE', 0):
+        current_tos_local_cache.set(key, value, getattr(settings, 'TOS_LOCAL_CACHE_TIMEOUT', 5))
+
+
+def cache_current_tos(value, key='django:tos:current_tos'):
+    # Inside a transaction, the TOS may have been changed by that very
+    # transaction, so don't cache it unless the transaction is committed
+    transaction.on_commit(lambda: _set_current_tos(key, value))
+
+
+async def acache_current_tos(value, key='django:tos:current_tos'):
+    """
+    Async version of cache_current_tos
+    """
+    # The transaction state can only be checked from a sync context
+    await sync_to_async(cache_current_tos)(value, key)
+
+
+def _delete_current_tos():
+    cache.delete_many(CURRENT_TOS_KEYS)
+    current_tos_local_cache.clear()
+
+
+def invalidate_current_tos(*args, **kwargs):
+    """
+    Forget the cached current TOS whenever any TOS is saved or deleted
+    """
+    _delete_current_tos()
+
+    # Another request could have cached the previous TOS again before the
+    # change was committed, so forget it once more after the commit
+    transaction.on_commit(_delete_current_tos)
+
+
+def stamp(value, tos_id):
+    """
+    Stamp a per-user cache value with the ID of the TOS it is valid for
+    """
+    return {tos_id: value}
+
+
+def unstamp(stamped, tos_id):
+    """
+    Return the value for a TOS from a stamped cache value, or None if it is
+    missing or was stamped for other TOS
+    """
+    if isinstance(stamped, dict):
+        return stamped.get(tos_id)
+    return None
+
+
+def get_active_tos_id():
+    from .models import TermsOfService
+
+    return TermsOfService.objects.filter(active=True).values_list('pk', flat=True).first()
+
+
+def cache_active_tos():
+    """
+    Look up the active TOS in the database and cache its ID
+    """
+    active_tos = (get_active_tos_id(), None)
+    cache.set('django:tos:active_tos', active_tos)
+    return active_tos
+
+
+def get_cached_active_tos_id():
+    """
+    Return the ID of the active TOS from the TOS cache, looking it up if it
+    isn't cached
+    """
+    active_tos = cache.get('django:tos:active_tos')
+    if active_tos is None:
+        active_tos = cache_active_tos()
+    return active_tos[0]
+
+
+async def acache_active_tos():
+    """
+    Async version of cache_active_tos
+    """
+    from .models import TermsOfService
+
+    active_tos = (
+        await TermsOfService.objects.filter(active=True).values_list('pk', flat=True).afirst(),
+        None,
+    )
+    await cache.aset('django:tos:active_tos', active_tos)
+    return active_tos
+
+
+def _user_state_keys(user_id, agreement=True):
+    keys = [
+        'django:tos:active_tos',
+        f'django:tos:skip_tos_check:{user_id}',
+    ]
+    if agreement:
+        keys.append(f'django:tos:agreed:{user_id}')
+    if use_compact_staff_cache() and staff_ids_local_cache.get('fresh') is None:
+        keys.append('django:tos:staff_ids')
+    return keys
+
+
+def _user_state_from_values(values, user_id, active_tos):
+    tos_id, no_agreements_until = active_tos
+
+    user_agreed = unstamp(values.get(f'django:tos:agreed:{user_id}'), tos_id)
+
+    # Right after a new TOS is activated nobody has agreed to it yet, so
+    # there's no need to ask the database
+    if user_agreed is None and no_agreements_until is not None and time.time() < no_agreements_until:
+        user_agreed = False
+
+    can_skip = values.get(f'django:tos:skip_tos_check:{user_id}') is True
+    if not can_skip and use_compact_staff_cache():
+        can_skip = _staff_ids_contain(values, user_id)
+
+    return tos_id, can_skip, user_agreed
+
+
+def get_cached_user_state(user_id):
+    """
+    Get the active TOS ID, the skip flag and the agreement for a user from
+    the cache in a single round trip
+
+    Agreements are stamped with the ID of the TOS they were cached for, so
+    activating another TOS doesn't need to touch them. The skip flags aren't
+    tied to any TOS at all.
+
+    Returns a ``(tos_id, can_skip, user_agreed)`` tuple, where
+    ``user_agreed`` is None if the agreement isn't cached.
+    """
+    values = cache.get_many(_user_state_keys(user_id))
+
+    active_tos = values.get('django:tos:active_tos')
+    if active_tos is None:
+        active_tos = cache_active_tos()
+
+    return _user_state_from_values(values, user_id, active_tos)
+
+
+async def aget_cached_user_state(user_id):
+    """
+    Async version of get_cached_user_state
+    """
+    values = await cache.aget_many(_user_state_keys(user_id))
+
+    active_tos = values.get('django:tos:active_tos')
+    if active_tos is None:
+        active_tos = await acache_active_tos()
+
+    return _user_state_from_values(values, user_id, active_tos)
+
+
+async def aget_session_value(session, key, default=None):
+    """
+    Get a value from the session without blocking the event loop when the
+    session has to be loaded from its backend
+    """
+    if hasattr(session, 'aget'):  # Django 5.1+
+        return await session.aget(key, default)
+    return await sync_to_async(session.get)(key, default)
+
+
+def use_session_agreement():
+    return getattr(settings, 'TOS_SESSION_AGREEMENT', False)
+
+
+AGREEMENT_COOKIE_SALT = 'tos.agreement'
+
+
+def use_agreement_cookie():
+    return getattr(settings, 'TOS_AGREEMENT_COOKIE', False)
+
+
+def set_agreement_cookie(response, user_id, tos_id):
+    """
+    Set a signed cookie on the response saying the user agreed to the TOS
+    """
+    response.set_signed_cookie(
+        getattr(settings, 'TOS_AGREEMENT_COOKIE_NAME', 'tos_agreed'),
+        f'{user_id}:{tos_id}',
+        salt=AGREEMENT_COOKIE_SALT,
+        max_age=getattr(settings, 'TOS_AGREEMENT_COOKIE_AGE', 60 * 60 * 24 * 30),
+        domain=settings.SESSION_COOKIE_DOMAIN,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+
+
+def get_agreement_cookie_tos_id(request, user_id):
+    """
+    Return the ID of the TOS the signed agreement cookie says the user agreed
+    to, or None if there is no valid cookie for this user
+    """
+    value = request.get_signed_cookie(
+        getattr(settings, 'TOS_AGREEMENT_COOKIE_NAME', 'tos_agreed'),
+        default=None,
+        salt=AGREEMENT_COOKIE_SALT,
+        max_age=getattr(settings, 'TOS_AGREEMENT_COOKIE_AGE', 60 * 60 * 24 * 30),
+    )
+    if value is None:
+        return None
+
+    # Another user may have logged in with the same browser
+    cookie_user_id, _, tos_id = value.rpartition(':')
+    if cookie_user_id != str(user_id):
+        return None
+
+    try:
+        return int(tos_id)
+    except ValueError:
+        return None
+
+
+# How often to check whether a value computed by someone else has been cached
+CACHE_MISS_POLL_INTERVAL = 0.02
+
+
+@contextmanager
+def cache_miss_lock(key):
+    """
+    Take a short lease on computing a missing cache value
+
+    Yields True if the caller should compute (and cache) the value, or False
+    if another request is already doing that. The lease is only taken when
+    ``TOS_CACHE_MISS_LOCK_TIMEOUT`` is set, and expires after that many
+    seconds in case its holder dies.
+    """
+    lock_timeout = getattr(settings, 'TOS_CACHE_MISS_LOCK_TIMEOUT', 0)
+    if not lock_timeout:
+        yield True
+        return
+
+    lock_key = f'{key}:lock'
+    acquired = cache.add(lock_key, True, lock_timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+@asynccontextmanager
+async def acache_miss_lock(key):
+    """
+    Async version of cache_miss_lock
+    """
+    lock_timeout = getattr(settings, 'TOS_CACHE_MISS_LOCK_TIMEOUT', 0)
+    if not lock_timeout:
+        yield True
+        return
+
+    lock_key = f'{key}:lock'
+    acquired = await cache.aadd(lock_key, True, lock_timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            await cache.adelete(lock_key)
+
+
+def _stale_value(stamped):
+    if getattr(settings, 'TOS_CACHE_MISS_SERVE_STALE', False) and isinstance(stamped, dict) and stamped:
+        return next(reversed(stamped.values()))
+    return None
+
+
+def poll_cached_value(key, tos_id):
+    """
+    Wait up to ``TOS_CACHE_MISS_WAIT`` seconds for the holder of a cache miss
+    lease to cache the value for a TOS
+
+    With ``TOS_CACHE_MISS_SERVE_STALE``, a value cached for a previous TOS is
+    returned right away instead. Returns None if nothing showed up.
+    """
+    deadline = time.monotonic() + getattr(settings, 'TOS_CACHE_MISS_WAIT', 0.5)
+    while True:
+        stamped = cache.get(key)
+        value = unstamp(stamped, tos_id)
+        if value is None:
+            value = _stale_value(stamped)
+        if value is not None or time.monotonic() >= deadline:
+            return value
+        time.sleep(CACHE_MISS_POLL_INTERVAL)
+
+
+async def apoll_cached_value(key, tos_id):
+    """
+    Async version of poll_cached_value
+    """
+    deadline = time.monotonic() + getattr(settings, 'TOS_CACHE_MISS_WAIT', 0.5)
+    while True:
+        stamped = await cache.aget(key)
+        value = unstamp(stamped, tos_id)
+        if value is None:
+            value = _stale_value(stamped)
+        if value is not None or time.monotonic() >= deadline:
+            return value
+        await asyncio.sleep(CACHE_MISS_POLL_INTERVAL)
+
+
+def invalidate_cached_agreements(sender, instance=None, **kwargs):
+    """
+    Point the agreement cache at the active TOS
+
+    Cached agreements are stamped with the ID of their TOS, so once another
+    TOS is active they are simply ignored. If nobody has agreed to the
+    active TOS yet, that is cached as well for ``TOS_ROLLOVER_WINDOW``
+    seconds, so the rush of users after a rollover doesn't all have to ask
+    the database.
+    """
+    from .models import UserAgreement
+
+    if instance is not None and instance.active:
+        tos_id = instance.pk
+    else:
+        tos_id = get_active_tos_id()
+
+    no_agreements_until = None
+    rollover_window = getattr(settings, 'TOS_ROLLOVER_WINDOW', 300)
+    if tos_id is not None and rollover_window and \
+            not UserAgreement.objects.filter(terms_of_service_id=tos_id).exists():
+        no_agreements_until = time.time() + rollover_window
+
+    # Requests shouldn't see the new active TOS before the change is committed
+    transaction.on_commit(lambda: cache.set('django:tos:active_tos', (tos_id, no_agreements_until)))
+
+
+STAFF_CACHE_CHUNK_SIZE = 1000
+
+
+def use_compact_staff_cache():
+    return getattr(settings, 'TOS_STAFF_CACHE_COMPACT', False)
+
+
+def check_compact_staff_cache():
+    """
+    Raise ImproperlyConfigured unless the user model has an integer primary
+    key, which TOS_STAFF_CACHE_COMPACT needs
+    """
+    pk = get_user_model()._meta.pk
+    if pk.is_relation:
+        pk = pk.target_field
+    if not isinstance(pk, models.IntegerField):
+        raise ImproperlyConfigured(
+            'TOS_STAFF_CACHE_COMPACT needs a user model with an integer '
+            f'primary key, not a {pk.get_internal_type()}'
+        )
+
+
+def pack_user_ids(user_ids):
+    """
+    Pack integer user IDs, in ascending order, into 8 bytes each
+    """
+    return array('q', user_ids).tobytes()
+
+
+def unpack_user_ids(packed):
+    """
+    Return the set of user IDs in a pack_user_ids() value
+    """
+    return frozenset(memoryview(packed).cast('q'))
+
+
+# The decoded staff IDs are kept in this process, so the packed set only has
+# to be fetched from the TOS cache once it is stale. 'fresh' expires first,
+# so the IDs are still there whenever the packed set isn't fetched.
+staff_ids_local_cache = LocalCache(max_size=2, timeout=5)
+
+
+def _remember_staff_ids(staff_ids):
+    timeout = getattr(settings, 'TOS_LOCAL_CACHE_TIMEOUT', 5)
+    staff_ids_local_cache.set('staff_ids', staff_ids, 2 * timeout + 1)
+    staff_ids_local_cache.set('fresh', True, timeout)
+
+
+def _staff_ids_contain(values, user_id):
+    packed = values.get('django:tos:staff_ids')
+    if packed is not None:
+        staff_ids = unpack_user_ids(packed)
+        _remember_staff_ids(staff_ids)
+    else:
+        staff_ids = staff_ids_local_cache.get('staff_ids', frozenset())
+
+    try:
+        return int(user_id) in staff_ids
+    except (TypeError, ValueError):
+        return False
+
+
+def _staff_user_ids():
+    return get_user_model().objects\
+        .filter(Q(is_staff=True) | Q(is_superuser=True))\
+        .order_by('pk')\
+        .values_list('pk', flat=True)\
+        .iterator(chunk_size=STAFF_CACHE_CHUNK_SIZE)
 
 
 def add_staff_users_to_tos_cache(*args, **kwargs):
     if kwargs.get('raw', False):
         return
 
-    # Get the cache prefix
-    key_version = cache.get('django:tos:key_version')
+    # Cache all of the users who are allowed to skip the TOS agreement check,
+    # without loading them all into memory at once
+    user_ids = _staff_user_ids()
+
+    if use_compact_staff_cache():
+        check_compact_staff_cache()
+        packed = pack_user_ids(user_ids)
+        cache.set('django:tos:staff_ids', packed)
+        _remember_staff_ids(unpack_user_ids(packed))
+        return
+
+    while True:
+        chunk = list(islice(user_ids, STAFF_CACHE_CHUNK_SIZE))
+        if not chunk:
+            break
+        cache.set_many({
+            f'django:tos:skip_tos_check:{user_id}': True
+            for user_id in chunk
+        })
+
+
+def _set_staff_in_compact_cache(instance):
+    check_compact_staff_cache()
+
+    packed = cache.get('django:tos:staff_ids')
+    if packed is None:
+        add_staff_users_to_tos_cache()
+        return
+
+    # Staff changes are rare, so a plain read-modify-write will do
+    user_ids = array('q')
+    user_ids.frombytes(packed)
+    is_staff = instance.is_staff or instance.is_superuser
+    i = bisect_left(user_ids, instance.pk)
+    cached = i < len(user_ids) and user_ids[i] == instance.pk
+
+    if is_staff and not cached:
+        insort(user_ids, instance.pk)
+    elif cached and not is_staff:
+        del user_ids[i]
+    else:
+        return
 
-    # Efficiently cache all of the users who are allowed to skip the TOS
-    # agreement check
-    cache.set_many({
-        f'django:tos:skip_tos_check:{staff_user.id}': True
-        for staff_user in get_user_model().objects.filter(
-            Q(is_staff=True) | Q(is_superuser=True))
-    }, version=key_version)
+    cache.set('django:tos:staff_ids', user_ids.tobytes())
+    _remember_staff_ids(frozenset(user_ids))
 
 
 def set_staff_in_cache_for_tos(*, instance: 'AbstractUser', **kwargs):
     if kwargs.get('raw', False):
         return
 
-    # Get the cache prefix
-    key_version = cache.get('django:tos:key_version')
+    if use_compact_staff_cache():
+        _set_staff_in_compact_cache(instance)
+        return
 
     # If the user is staff allow them to skip the TOS agreement check
     if instance.is_staff or instance.is_superuser:
-        cache.set(f'django:tos:skip_tos_check:{instance.id}', True, version=key_version)
+        cache.set(f'django:tos:skip_tos_check:{instance.id}', True)
 
     # But if they aren't make sure we invalidate them from the cache
     elif cache.get(f'django:tos:skip_tos_check:{instance.id}', False):
-        cache.delete(f'django:tos:skip_tos_check:{instance.id}', version=key_version)
+        cache.delete(f'django:tos:skip_tos_check:{instance.id}')
+
+
+def deduplicate_user_agreements(batch_size=1000):
+    """
+    Delete duplicate user agreements, keeping the oldest agreement of each
+    user to each TOS
+
+    Works through the duplicates ``batch_size`` (user, TOS) pairs at a time, so
+    it can be run against large tables before the unique constraint on
+    ``UserAgreement`` is added. Returns the number of deleted agreements.
+    """
+    model = apps.get_model('tos', 'UserAgreement')
+
+    deleted = 0
+    while True:
+        # Deleted duplicates drop out of this query, so just keep taking the
+        # first batch until there are none left
+        duplicates = list(
+            model.objects
+            .values('user_id', 'terms_of_service_id')
+            .annotate(keep_id=Min('pk'), count=Count('pk'))
+            .filter(count__gt=1)
+            .order_by()[:batch_size]
+        )
+        if not duplicates:
+            return deleted
+
+        # Keep each DELETE statement well under the query parameter limits
+        for i in range(0, len(duplicates), 200):
+            rows = Q()
+            for duplicate in duplicates[i:i + 200]:
+                rows |= Q(
+                    user_id=duplicate['user_id'],
+                    terms_of_service_id=duplicate['terms_of_service_id'],
+                    pk__gt=duplicate['keep_id'],
+                )
+
+            # The base manager skips the write-through of removed agreements,
+            # as each user keeps their oldest agreement
+            batch_deleted, _ = model._base_manager.filter(rows).delete()
+            deleted += batch_deleted
+
+
+def add_user_agreements(tos, user_ids):
+    """
+    Record that the given users agreed to a TOS, skipping users who already
+    have, and cache their agreements if the TOS is the active one
+    """
+    UserAgreement = apps.get_model('tos', 'UserAgreement')
+
+    UserAgreement.objects.bulk_create(
+        [UserAgreement(terms_of_service=tos, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+    # bulk_create doesn't send post_save, so write the agreements through
+    # here
+    cache_user_agreements(tos.pk, user_ids, True, active=tos.active)
+
+
+def cache_user_agreements(tos_id, user_ids, agreed, active=None):
+    """
+    Write whether the given users agreed to a TOS through to the agreement
+    backend (see ``TOS_AGREEMENT_BACKEND``) once the transaction commits
+
+    ``active`` says whether the TOS is the active one, if the caller knows.
+    """
+    from .backends import get_agreement_backend
+
+    agreements = dict.fromkeys(user_ids, agreed)
+    if not agreements:
+        return
+
+    transaction.on_commit(lambda: get_agreement_backend().set_many_agreed(tos_id, agreements, active=active))
+
+
+def recently_active_user_ids(since):
+    """
+    Return the IDs of the users who have logged in since the given datetime
+    """
+    return get_user_model().objects\
+        .filter(last_login__gte=since)\
+        .order_by('pk')\
+        .values_list('pk', flat=True)\
+        .iterator()
+
+
+def get_warm_cache_user_ids(since):
+    """
+    Return the IDs of the users whose agreements should be cached ahead of
+    activating a TOS, using the ``TOS_WARM_CACHE_USERS`` hook (a callable or
+    its dotted path) if it is set
+    """
+    hook = getattr(settings, 'TOS_WARM_CACHE_USERS', recently_active_user_ids)
+    if isinstance(hook, str):
+        hook = import_string(hook)
+    return hook(since)
+
+
+def warm_agreement_cache(tos, user_ids, chunk_size=1000):
+    """
+    Store whether each of the given users agreed to a TOS in the agreement
+    backend, so the middleware doesn't have to ask the database once it is
+    active
+
+    Takes one query and one write to the backend per chunk of users. The TOS
+    doesn't have to be active yet: the agreements to the active TOS are kept.
+    Returns the number of users.
+    """
+    from .backends import get_agreement_backend
+
+    UserAgreement = apps.get_model('tos', 'UserAgreement')
+    backend = get_agreement_backend()
+
+    total = 0
+    user_ids = iter(user_ids)
+    while True:
+        chunk = list(islice(user_ids, chunk_size))
+        if not chunk:
+            return total
+
+        agreed = set(
+            UserAgreement.objects
+            .filter(terms_of_service=tos, user_id__in=chunk)
+            .values_list('user_id', flat=True)
+        )
+        backend.set_many_agreed(tos.pk, {user_id: user_id in agreed for user_id in chunk})
+
+        total += len(chunk)
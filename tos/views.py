@@ -1,5 +1,10 @@
+import json
 import re
+from calendar import timegm
+from functools import wraps
 
+from asgiref.sync import sync_to_async
+from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login as auth_login
@@ -8,20 +13,77 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.cache import caches
-from django.http import HttpResponseRedirect
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import IntegrityError, transaction
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
-from django.utils.translation import gettext_lazy as _
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.cache import add_never_cache_headers, get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
+from django.utils.translation import get_language, gettext_lazy as _
 from django.views.decorators.cache import never_cache
-from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition, require_http_methods
 from django.views.generic import TemplateView
 
-from tos.models import has_user_agreed_latest_tos, TermsOfService, UserAgreement
-from .utils import get_tos_cache
+from tos.backends import get_agreement_backend
+from tos.metrics import get_metrics
+from tos.models import (
+    ahas_user_agreed_latest_tos,
+    has_user_agreed_latest_tos,
+    TermsOfService,
+    UserAgreement,
+    users_agreed_latest_tos,
+)
+from tos.tracing import span, traced_view
+from .utils import (
+    aget_session_value,
+    get_tos_cache,
+    set_agreement_cookie,
+    use_agreement_cookie,
+    use_session_agreement,
+)
+
+try:
+    from django.contrib.auth import alogin as auth_alogin
+except ImportError:  # Django < 5.0
+    auth_alogin = sync_to_async(auth_login)
 
 
 cache = get_tos_cache()
 
 
+def _get_tos_version(request):
+    # Both the ETag and the Last-Modified header need this, so only look it
+    # up once per request
+    if not hasattr(request, '_tos_version'):
+        request._tos_version = TermsOfService.objects.get_current_tos_version()
+    return request._tos_version
+
+
+def _tos_etag(request, *args, **kwargs):
+    version = _get_tos_version(request)
+    if version is None:
+        return None
+
+    pk, modified = version
+    # The content can be translated (see tos_i18n), so it depends on the
+    # language as well
+    return f'"{pk}-{modified.timestamp()}-{get_language()}"'
+
+
+def _tos_last_modified(request, *args, **kwargs):
+    version = _get_tos_version(request)
+    if version is None:
+        return None
+
+    return version[1]
+
+
+# Clients with a current copy of the terms get a 304 without the TOS
+# content being loaded or rendered
+@method_decorator(condition(etag_func=_tos_etag, last_modified_func=_tos_last_modified), name='dispatch')
 class TosView(TemplateView):
     template_name = "tos/tos.html"
 
@@ -31,6 +93,68 @@ class TosView(TemplateView):
         return context
 
 
+if DJANGO_VERSION >= (5, 0):
+    _acsrf_protect = csrf_protect
+    _anever_cache = never_cache
+else:  # pragma: no cover
+    # Django 4.2's decorators can't wrap async views
+    def _acsrf_protect(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            middleware = CsrfViewMiddleware(view)
+            response = middleware.process_request(request)
+            if response is None:
+                response = middleware.process_view(request, view, args, kwargs)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            return middleware.process_response(request, response)
+        return wrapper
+
+    def _anever_cache(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            response = await view(request, *args, **kwargs)
+            add_never_cache_headers(response)
+            return response
+        return wrapper
+
+
+class AsyncTosView(TemplateView):
+    """
+    Async version of TosView, for ASGI
+    """
+    template_name = "tos/tos.html"
+
+    async def get(self, request, *args, **kwargs):
+        # Like the condition() decorator on TosView
+        version = await TermsOfService.objects.aget_current_tos_version()
+        request._tos_version = version
+        etag = _tos_etag(request)
+        last_modified = _tos_last_modified(request)
+        last_modified = int(timegm(last_modified.utctimetuple())) if last_modified is not None else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            context = self.get_context_data(**kwargs)
+            context['tos'] = await TermsOfService.objects.aget_current_tos()
+            response = self.render_to_response(context)
+
+        if last_modified is not None and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(last_modified)
+        if etag is not None:
+            response.headers.setdefault('ETag', etag)
+        return response
+
+
+async def _aload_user(request):
+    # Templates often show the user, which would otherwise be loaded from
+    # the database on the event loop while rendering
+    if hasattr(request, 'auser'):  # Django 5.0+
+        request.user = await request.auser()
+    elif hasattr(request, 'user'):
+        await sync_to_async(lambda: request.user.is_authenticated)()
+
+
 def _redirect_to(redirect_to):
     """ Moved redirect_to logic here to avoid duplication in views"""
 
@@ -47,31 +171,49 @@ def _redirect_to(redirect_to):
     return redirect_to
 
 
+def _agree(tos, user):
+    # Save the user agreement to the new TOS, which writes it through to the
+    # agreement backend
+    try:
+        with transaction.atomic():
+            UserAgreement.objects.create(terms_of_service=tos, user=user)
+    except IntegrityError:
+        # Already agreed, e.g. the form was submitted twice. Store it anyway,
+        # as the middleware may have sent the user here because it assumed
+        # nobody agreed to a newly active TOS.
+        get_agreement_backend().set_agreed(tos.pk, user.pk, True)
+
+
+@traced_view
 @csrf_protect
 @never_cache
 def check_tos(request, template_name='tos/tos_check.html',
               redirect_field_name=REDIRECT_FIELD_NAME,):
 
     redirect_to = _redirect_to(request.POST.get(redirect_field_name, request.GET.get(redirect_field_name, '')))
-    tos = TermsOfService.objects.get_current_tos()
+    with span('tos-current'):
+        tos = TermsOfService.objects.get_current_tos()
     if request.method == "POST":
         if request.POST.get("accept", "") == "accept":
             user = get_user_model().objects.get(pk=request.session['tos_user'])
             user.backend = request.session['tos_backend']
 
-            # Save the user agreement to the new TOS
-            UserAgreement.objects.get_or_create(terms_of_service=tos, user=user)
-
-            key_version = cache.get('django:tos:key_version')
-            cache.delete(f'django:tos:agreed:{user.pk}', version=key_version)
+            with span('tos-agree'):
+                _agree(tos, user)
 
             # Log the user in
             auth_login(request, user)
 
+            if use_session_agreement():
+                request.session['tos_agreed'] = tos.pk
+
             if request.session.test_cookie_worked():
                 request.session.delete_test_cookie()
 
-            return HttpResponseRedirect(redirect_to)
+            response = HttpResponseRedirect(redirect_to)
+            if use_agreement_cookie():
+                set_agreement_cookie(response, user.pk, tos.pk)
+            return response
         else:
             messages.error(
                 request,
@@ -85,6 +227,55 @@ def check_tos(request, template_name='tos/tos_check.html',
     return render(request, template_name, context)
 
 
+@traced_view
+@_acsrf_protect
+@_anever_cache
+async def acheck_tos(request, template_name='tos/tos_check.html',
+                     redirect_field_name=REDIRECT_FIELD_NAME,):
+    """Async version of check_tos, for ASGI"""
+
+    # Load the session, so it can be used without blocking below
+    await aget_session_value(request.session, 'tos_user')
+
+    redirect_to = _redirect_to(request.POST.get(redirect_field_name, request.GET.get(redirect_field_name, '')))
+    with span('tos-current'):
+        tos = await TermsOfService.objects.aget_current_tos()
+    if request.method == "POST":
+        if request.POST.get("accept", "") == "accept":
+            user = await get_user_model().objects.aget(pk=request.session['tos_user'])
+            user.backend = request.session['tos_backend']
+
+            with span('tos-agree'):
+                # transaction.atomic() can't be used in async code
+                await sync_to_async(_agree)(tos, user)
+
+            await auth_alogin(request, user)
+
+            if use_session_agreement():
+                request.session['tos_agreed'] = tos.pk
+
+            if request.session.test_cookie_worked():
+                request.session.delete_test_cookie()
+
+            response = HttpResponseRedirect(redirect_to)
+            if use_agreement_cookie():
+                set_agreement_cookie(response, user.pk, tos.pk)
+            return response
+        else:
+            messages.error(
+                request,
+                _("You cannot login without agreeing to the terms of this site.")
+            )
+    context = {
+        'tos': tos,
+        'redirect_field_name': redirect_field_name,
+        'next': redirect_to,
+    }
+    await _aload_user(request)
+    return render(request, template_name, context)
+
+
+@traced_view
 @csrf_protect
 @never_cache
 def login(request, template_name='registration/login.html',
@@ -103,11 +294,16 @@ def login(request, template_name='registration/login.html',
             # Okay, security checks complete. Check to see if user agrees
             # to terms
             user = form.get_user()
-            if has_user_agreed_latest_tos(user):
+            with span('tos-agreement'):
+                user_agreed = has_user_agreed_latest_tos(user)
+            if user_agreed:
 
                 # Log the user in.
                 auth_login(request, user)
 
+                if use_session_agreement():
+                    request.session['tos_agreed'] = TermsOfService.objects.get_current_tos().pk
+
                 if request.session.test_cookie_worked():
                     request.session.delete_test_cookie()
 
@@ -144,3 +340,124 @@ def login(request, template_name='registration/login.html',
         'site_name': current_site.name,
     }
     return render(request, template_name, context)
+
+
+@traced_view
+@_acsrf_protect
+@_anever_cache
+async def alogin(request, template_name='registration/login.html',
+                 redirect_field_name=REDIRECT_FIELD_NAME,
+                 authentication_form=AuthenticationForm):
+    """Async version of login, for ASGI"""
+
+    redirect_to = request.POST.get(redirect_field_name, request.GET.get(redirect_field_name, ''))
+
+    # Load the session, so it can be used without blocking below
+    await aget_session_value(request.session, 'tos_user')
+
+    if request.method == "POST":
+        form = authentication_form(data=request.POST)
+        # Authenticating queries the database and hashes the password
+        if await sync_to_async(form.is_valid)():
+
+            redirect_to = _redirect_to(redirect_to)
+
+            user = form.get_user()
+            with span('tos-agreement'):
+                user_agreed = await ahas_user_agreed_latest_tos(user)
+            if user_agreed:
+
+                await auth_alogin(request, user)
+
+                if use_session_agreement():
+                    request.session['tos_agreed'] = (await TermsOfService.objects.aget_current_tos()).pk
+
+                if request.session.test_cookie_worked():
+                    request.session.delete_test_cookie()
+
+                return HttpResponseRedirect(redirect_to)
+
+            else:
+                # See login
+                request.session['tos_user'] = user.pk
+                request.session['tos_backend'] = user.backend
+
+                context = {
+                    'redirect_field_name': redirect_to,
+                    'tos': await TermsOfService.objects.aget_current_tos()
+                }
+
+                await _aload_user(request)
+                return render(request, 'tos/tos_check.html', context)
+    else:
+        form = authentication_form(request)
+
+    request.session.set_test_cookie()
+
+    current_site = await sync_to_async(get_current_site)(request)
+
+    context = {
+        'form': form,
+        'redirect_field_name': redirect_to,
+        'site': current_site,
+        'site_name': current_site.name,
+    }
+    await _aload_user(request)
+    return render(request, template_name, context)
+
+
+@never_cache
+def metrics(request):
+    """Dump the middleware metrics of this process as JSON, for staff users"""
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    backend = get_metrics()
+    return JsonResponse({
+        'backend': f'{backend.__class__.__module__}.{backend.__class__.__name__}' if backend is not None else None,
+        'metrics': backend.snapshot() if backend is not None else {},
+    })
+
+
+def _bad_request(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+# Nothing is changed, so a POST is only a way to send more user IDs than fit
+# in a URL, and other services don't need a CSRF token
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+@never_cache
+def agreed_users(request):
+    """
+    Return which of the given users have agreed to the active TOS as JSON,
+    for users with the ``tos.view_useragreement`` permission
+
+    The user IDs are taken from a comma separated ``user_ids`` query
+    parameter, or from a ``{"user_ids": [...]}`` JSON body when POSTed.
+    """
+    if not request.user.has_perm('tos.view_useragreement'):
+        raise PermissionDenied
+
+    if request.method == 'POST':
+        try:
+            user_ids = json.loads(request.body)['user_ids']
+        except (ValueError, KeyError, TypeError):
+            user_ids = None
+        if not isinstance(user_ids, list):
+            return _bad_request('Expected a JSON object with a "user_ids" list')
+    else:
+        user_ids = [user_id for user_id in request.GET.get('user_ids', '').split(',') if user_id]
+
+    limit = getattr(settings, 'TOS_AGREED_USERS_LIMIT', 50000)
+    if len(user_ids) > limit:
+        return _bad_request(f'At most {limit} user IDs can be checked at once')
+
+    to_python = get_user_model()._meta.pk.to_python
+    try:
+        user_ids = list(dict.fromkeys(to_python(user_id) for user_id in user_ids))
+    except (ValidationError, TypeError):
+        return _bad_request('Invalid user ID')
+
+    agreed = users_agreed_latest_tos(user_ids)
+    return JsonResponse({'agreed': [user_id for user_id in user_ids if user_id in agreed]})